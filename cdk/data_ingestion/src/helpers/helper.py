@@ -1,12 +1,12 @@
 import logging
 import boto3
 from typing import Dict, Optional
-import psycopg2
 
 from langchain_aws import BedrockEmbeddings
 from langchain_postgres import PGVector
 from langchain.indexes import SQLRecordManager
 
+from db_pool import build_connection_string, get_engine
 from processing.documents import process_documents
 s3 = boto3.client('s3')
 
@@ -39,15 +39,16 @@ def get_vectorstore(
     Optional[PGVector]: The initialized PGVector instance, or None if an error occurred.
     """
     try:
-        connection_string = (
-            f"postgresql+psycopg://{user}:{password}@{host}:{port}/{dbname}"
+        # The same URL as the metadata queries, so both share one connection pool
+        connection_string = build_connection_string(
+            {"username": user, "password": password, "port": port, "dbname": dbname}, host
         )
 
         logger.info("Initializing the VectorStore")
         vectorstore = PGVector(
             embeddings=embeddings,
             collection_name=collection_name,
-            connection=connection_string,
+            connection=get_engine(connection_string),
             use_jsonb=True
         )
 
@@ -89,7 +90,7 @@ def store_group_data(
         # define record manager
         namespace = f"pgvector/{vectorstore_config_dict['collection_name']}"
         record_manager = SQLRecordManager(
-            namespace, db_url=connection_string
+            namespace, engine=get_engine(connection_string)
         )
         record_manager.create_schema()
 
@@ -1,7 +1,9 @@
 import os
 import json
 import boto3
-import psycopg2
+import psycopg
+from config_loader import get_secret, get_parameter
+from db_pool import db_connection
 import logging
 from datetime import datetime, timezone
 from typing import NamedTuple
@@ -22,15 +24,8 @@ RDS_PROXY_ENDPOINT = os.environ["RDS_PROXY_ENDPOINT"]
 EMBEDDING_MODEL_PARAM = os.environ["EMBEDDING_MODEL_PARAM"]
 
 # AWS Clients
-secrets_manager_client = boto3.client("secretsmanager")
-ssm_client = boto3.client("ssm")
 bedrock_runtime = boto3.client("bedrock-runtime", region_name=REGION)
 
-# Cached resources
-connection = None
-db_secret = None
-EMBEDDING_MODEL_ID = None
-
 # Set up class to represent parsed file path
 class ParsedFilePath(NamedTuple):
     simulation_group_id: str
@@ -39,54 +34,6 @@ class ParsedFilePath(NamedTuple):
     file_name: str
     file_type: str
 
-def get_secret():
-    global db_secret
-    if db_secret is None:
-        try:
-            response = secrets_manager_client.get_secret_value(SecretId=DB_SECRET_NAME)["SecretString"]
-            db_secret = json.loads(response)
-        except Exception as e:
-            logger.error(f"Error fetching secret {DB_SECRET_NAME}: {e}")
-            raise
-    return db_secret
-
-def get_parameter():
-    """
-    Fetch a parameter value from Systems Manager Parameter Store.
-    """
-    global EMBEDDING_MODEL_ID
-    if EMBEDDING_MODEL_ID is None:
-        try:
-            response = ssm_client.get_parameter(Name=EMBEDDING_MODEL_PARAM, WithDecryption=True)
-            EMBEDDING_MODEL_ID = response["Parameter"]["Value"]
-        except Exception as e:
-            logger.error(f"Error fetching parameter {EMBEDDING_MODEL_PARAM}: {e}")
-            raise
-    return EMBEDDING_MODEL_ID
-
-def connect_to_db():
-    global connection
-    if connection is None or connection.closed:
-        try:
-            secret = get_secret()
-            connection_params = {
-                'dbname': secret["dbname"],
-                'user': secret["username"],
-                'password': secret["password"],
-                'host': RDS_PROXY_ENDPOINT,
-                'port': secret["port"]
-            }
-            connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
-            connection = psycopg2.connect(connection_string)
-            logger.info("Connected to the database!")
-        except Exception as e:
-            logger.error(f"Failed to connect to database: {e}")
-            if connection:
-                connection.rollback()
-                connection.close()
-            raise
-    return connection
-
 def get_embedding_count(patient_id):
     """
     Queries the database for the number of embeddings associated with a specific patient.
@@ -97,45 +44,88 @@ def get_embedding_count(patient_id):
     Returns:
         int: The count of embeddings found for the patient.
     """
-    connection = connect_to_db()
-    if connection is None:
-        logger.error("Database connection failed. Unable to query embeddings.")
-        raise
+    with db_connection(DB_SECRET_NAME, RDS_PROXY_ENDPOINT) as connection:
+        try:
+            cur = connection.cursor()
+
+            # Query to count embeddings for the patient
+            query = """
+            SELECT COUNT(*)
+            FROM langchain_pg_embedding e
+            JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+            WHERE c.name = %s;
+            """
+            cur.execute(query, (patient_id,))
+            result = cur.fetchone()
 
-    try:
-        cur = connection.cursor()
-
-        # Query to count embeddings for the patient
-        query = """
-        SELECT COUNT(*)
-        FROM langchain_pg_embedding e
-        JOIN langchain_pg_collection c ON e.collection_id = c.uuid
-        WHERE c.name = %s;
-        """
-        cur.execute(query, (patient_id,))
-        result = cur.fetchone()
-
-        connection.commit()
-        cur.close()
-
-        if result and result[0] > 0:
-            logger.info(f"Current embedding count for patient {patient_id}: {result[0]}")
-            return result[0]
-        else:
-            logger.info(f"No embeddings found for patient {patient_id}. This may be a new collection.")
+            connection.commit()
+            cur.close()
+
+            if result and result[0] > 0:
+                logger.info(f"Current embedding count for patient {patient_id}: {result[0]}")
+                return result[0]
+            else:
+                logger.info(f"No embeddings found for patient {patient_id}. This may be a new collection.")
+                return 0
+
+        except psycopg.errors.UndefinedTable as e:
+            # Handles case where tables do not exist yet (first patient)
+            logger.warning(f"LangChain tables do not exist yet as this might be the first patient being created. Returning 0 embeddings for patient {patient_id}.")
             return 0
 
-    except psycopg2.errors.UndefinedTable as e:
-        # Handles case where tables do not exist yet (first patient)
-        logger.warning(f"LangChain tables do not exist yet as this might be the first patient being created. Returning 0 embeddings for patient {patient_id}.")
-        return 0
+        except Exception as e:
+            if cur:
+                cur.close()
+            connection.rollback()
+            logger.error(f"Error retrieving embedding count for patient {patient_id}: {e}")
+            raise
 
-    except Exception as e:
-        if cur:
+def update_collection_stats(patient_id):
+    """
+    Records the chunk count, an estimated token count and a version stamp on the patient's
+    vectorstore collection (langchain_pg_collection.cmetadata).
+
+    The text generation Lambda reads these to decide, without touching the embeddings,
+    whether a patient's whole corpus fits in the prompt and whether its caches are stale.
+
+    Args:
+        patient_id (str): The patient ID (collection name in the vectorstore).
+    """
+    with db_connection(DB_SECRET_NAME, RDS_PROXY_ENDPOINT) as connection:
+        cur = None
+        try:
+            cur = connection.cursor()
+
+            # Token counts are estimated at about four characters per token
+            cur.execute("""
+            UPDATE langchain_pg_collection c
+            SET cmetadata = (COALESCE(c.cmetadata::jsonb, '{}'::jsonb) || jsonb_build_object(
+                'chunk_count', stats.chunk_count,
+                'token_count', stats.token_count,
+                'version', %s
+            ))::json
+            FROM (
+                SELECT COUNT(e.id) AS chunk_count,
+                       COALESCE(SUM(LENGTH(e.document) / 4 + 1), 0) AS token_count
+                FROM langchain_pg_collection c2
+                LEFT JOIN langchain_pg_embedding e ON e.collection_id = c2.uuid
+                WHERE c2.name = %s
+            ) stats
+            WHERE c.name = %s
+            RETURNING stats.chunk_count, stats.token_count;
+            """, (datetime.now(timezone.utc).isoformat(), patient_id, patient_id))
+            result = cur.fetchone()
+
+            connection.commit()
             cur.close()
-        connection.rollback()
-        logger.error(f"Error retrieving embedding count for patient {patient_id}: {e}")
-        raise
+
+            if result:
+                logger.info(f"Collection stats for patient {patient_id}: {result[0]} chunks, ~{result[1]} tokens")
+        except Exception as e:
+            if cur:
+                cur.close()
+            connection.rollback()
+            logger.error(f"Error updating collection stats for patient {patient_id}: {e}")
 
 def update_ingestion_status(patient_id: str, file_path: str, status: str):
     """
@@ -146,32 +136,28 @@ def update_ingestion_status(patient_id: str, file_path: str, status: str):
         file_path (str): The full file path stored in the database.
         status (str): The status to update ('completed' or 'error').
     """
-    connection = connect_to_db()
-    if connection is None:
-        logger.error("Database connection failed. Unable to update ingestion status.")
-        return
-
-    try:
-        cur = connection.cursor()
+    with db_connection(DB_SECRET_NAME, RDS_PROXY_ENDPOINT) as connection:
+        try:
+            cur = connection.cursor()
 
-        update_query = """
-        UPDATE "patient_data"
-        SET ingestion_status = %s
-        WHERE patient_id = %s
-        AND filepath = %s;
-        """
-        cur.execute(update_query, (status, patient_id, file_path))
-        connection.commit()
-        cur.close()
+            update_query = """
+            UPDATE "patient_data"
+            SET ingestion_status = %s
+            WHERE patient_id = %s
+            AND filepath = %s;
+            """
+            cur.execute(update_query, (status, patient_id, file_path))
+            connection.commit()
+            cur.close()
 
-        logger.info(f"Ingestion status for {file_path} updated to '{status}' for patient {patient_id}.")
+            logger.info(f"Ingestion status for {file_path} updated to '{status}' for patient {patient_id}.")
 
-    except Exception as e:
-        if cur:
-            cur.close()
-        connection.rollback()
-        logger.error(f"Error updating ingestion status for patient {patient_id}, file {file_path}: {e}")
-        raise
+        except Exception as e:
+            if cur:
+                cur.close()
+            connection.rollback()
+            logger.error(f"Error updating ingestion status for patient {patient_id}, file {file_path}: {e}")
+            raise
 
 def parse_s3_file_path(file_key):
     # Assuming the file path is of the format: {simulation_group_id}/{patient_id}/{documents or info}/{file_name}.{file_type}
@@ -206,79 +192,67 @@ def parse_s3_file_path(file_key):
         }
 
 def insert_file_into_db(patient_id, file_name, file_type, file_path, bucket_name, file_category):    
-    connection = connect_to_db()
-    if connection is None:
-        logger.error("No database connection available.")
-        return {
-            "statusCode": 500,
-            "body": json.dumps("Database connection failed.")
-        }
+    with db_connection(DB_SECRET_NAME, RDS_PROXY_ENDPOINT) as connection:
+        try:
+            cur = connection.cursor()
 
-    try:
-        cur = connection.cursor()
-
-        select_query = """
-        SELECT * FROM "patient_data"
-        WHERE patient_id = %s
-        AND filename = %s
-        AND filetype = %s;
-        """
-        cur.execute(select_query, (patient_id, file_name, file_type))
-        existing_file = cur.fetchone()
-
-        timestamp = datetime.now(timezone.utc)
-        ingestion_status = "processing" if file_category == "documents" else "not processing"
-
-        if existing_file:
-            # Update the existing record
-            update_query = """
-                UPDATE "patient_data"
-                SET s3_bucket_reference = %s,
-                    filepath = %s,
-                    time_uploaded = %s,
-                    ingestion_status = %s
-                WHERE patient_id = %s
-                AND filename = %s
-                AND filetype = %s;
-            """
-            cur.execute(update_query, (
-                bucket_name, file_path, timestamp, ingestion_status, patient_id, file_name, file_type
-            ))
-            logger.info(f"Successfully updated file {file_name}.{file_type} in database for patient {patient_id}, ingestion set to '{ingestion_status}'.")
-        else:
-            # Insert a new record
-            insert_query = """
-                INSERT INTO "patient_data" 
-                (patient_id, filetype, s3_bucket_reference, filepath, filename, time_uploaded, metadata, ingestion_status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+            select_query = """
+            SELECT * FROM "patient_data"
+            WHERE patient_id = %s
+            AND filename = %s
+            AND filetype = %s;
             """
-            cur.execute(insert_query, (
-                patient_id, file_type, bucket_name, file_path, file_name, timestamp, "", ingestion_status
-            ))
-            logger.info(f"Successfully inserted new file {file_name}.{file_type} for patient {patient_id}, ingestion set to '{ingestion_status}'.")
-
-        connection.commit()
-        cur.close()
-    except Exception as e:
-        if cur:
+            cur.execute(select_query, (patient_id, file_name, file_type))
+            existing_file = cur.fetchone()
+
+            timestamp = datetime.now(timezone.utc)
+            ingestion_status = "processing" if file_category == "documents" else "not processing"
+
+            if existing_file:
+                # Update the existing record
+                update_query = """
+                    UPDATE "patient_data"
+                    SET s3_bucket_reference = %s,
+                        filepath = %s,
+                        time_uploaded = %s,
+                        ingestion_status = %s
+                    WHERE patient_id = %s
+                    AND filename = %s
+                    AND filetype = %s;
+                """
+                cur.execute(update_query, (
+                    bucket_name, file_path, timestamp, ingestion_status, patient_id, file_name, file_type
+                ))
+                logger.info(f"Successfully updated file {file_name}.{file_type} in database for patient {patient_id}, ingestion set to '{ingestion_status}'.")
+            else:
+                # Insert a new record
+                insert_query = """
+                    INSERT INTO "patient_data" 
+                    (patient_id, filetype, s3_bucket_reference, filepath, filename, time_uploaded, metadata, ingestion_status)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+                """
+                cur.execute(insert_query, (
+                    patient_id, file_type, bucket_name, file_path, file_name, timestamp, "", ingestion_status
+                ))
+                logger.info(f"Successfully inserted new file {file_name}.{file_type} for patient {patient_id}, ingestion set to '{ingestion_status}'.")
+
+            connection.commit()
             cur.close()
-        connection.rollback()
-        logger.error(f"Error inserting file {file_name}.{file_type} into database: {e}")
-        raise
+        except Exception as e:
+            if cur:
+                cur.close()
+            connection.rollback()
+            logger.error(f"Error inserting file {file_name}.{file_type} into database: {e}")
+            raise
 
 def update_vectorstore_from_s3(bucket, simulation_group_id, patient_id, file_path):
-    connection = connect_to_db()
-    if connection is None:
-        logger.error("Database connection failed. Unable to query embeddings.")
-        raise
-    
     embeddings = BedrockEmbeddings(
-        model_id=get_parameter(), 
+        model_id=get_parameter(EMBEDDING_MODEL_PARAM), 
         client=bedrock_runtime,
         region_name=REGION
     )
 
-    secret = get_secret()
+    secret = get_secret(DB_SECRET_NAME)
 
     vectorstore_config_dict = {
         'collection_name': f'{patient_id}',
@@ -290,14 +264,15 @@ def update_vectorstore_from_s3(bucket, simulation_group_id, patient_id, file_pat
     }
 
     try:
-        update_vectorstore(
-            bucket=bucket,
-            group=simulation_group_id,
-            patient_id=patient_id,
-            vectorstore_config_dict=vectorstore_config_dict,
-            embeddings=embeddings,
-            connection=connection
-        )
+        with db_connection(DB_SECRET_NAME, RDS_PROXY_ENDPOINT) as connection:
+            update_vectorstore(
+                bucket=bucket,
+                group=simulation_group_id,
+                patient_id=patient_id,
+                vectorstore_config_dict=vectorstore_config_dict,
+                embeddings=embeddings,
+                connection=connection
+            )
 
     except Exception as e:
         error_message = str(e)
@@ -378,6 +353,11 @@ def handler(event, context):
                     "statusCode": 500,
                     "body": json.dumps(f"File inserted, but error updating vectorstore: {e}")
                 }
+            finally:
+                # Uploads and deletions (ObjectRemoved) both change the collection, and a failed
+                # re-index may have removed chunks already, so the stats and version are always
+                # recomputed from what is stored
+                update_collection_stats(patient_id)
         else:            
             logger.info(f"{file_name}.{file_type} in {file_category} folder is not ingested")
         
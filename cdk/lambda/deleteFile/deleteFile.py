@@ -2,6 +2,7 @@ import os
 import json
 import boto3
 import psycopg2
+from config_loader import connect_with_secret
 from aws_lambda_powertools import Logger
 
 logger = Logger()
@@ -11,34 +12,25 @@ BUCKET = os.environ["BUCKET"]
 DB_SECRET_NAME = os.environ["SM_DB_CREDENTIALS"]
 RDS_PROXY_ENDPOINT = os.environ["RDS_PROXY_ENDPOINT"]
 
-# AWS Clients
-secrets_manager_client = boto3.client('secretsmanager')
-
 # Global variables for caching
 connection = None
-db_secret = None
 
-def get_secret():
-    global db_secret
-    if not db_secret:
-        response = secrets_manager_client.get_secret_value(SecretId=DB_SECRET_NAME)["SecretString"]
-        db_secret = json.loads(response)
-    return db_secret
+def open_connection(secret):
+    connection_params = {
+        'dbname': secret["dbname"],
+        'user': secret["username"],
+        'password': secret["password"],
+        'host': RDS_PROXY_ENDPOINT,
+        'port': secret["port"]
+    }
+    connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
+    return psycopg2.connect(connection_string)
 
 def connect_to_db():
     global connection
     if connection is None or connection.closed:
         try:
-            secret = get_secret()
-            connection_params = {
-                'dbname': secret["dbname"],
-                'user': secret["username"],
-                'password': secret["password"],
-                'host': RDS_PROXY_ENDPOINT,
-                'port': secret["port"]
-            }
-            connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
-            connection = psycopg2.connect(connection_string)
+            connection = connect_with_secret(DB_SECRET_NAME, open_connection)
             logger.info("Connected to the database!")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
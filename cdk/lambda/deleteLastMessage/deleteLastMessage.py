@@ -3,65 +3,38 @@ import boto3
 import json
 import logging
 import psycopg2
+from config_loader import get_parameter, connect_with_secret
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # AWS Clients
 dynamodb_client = boto3.client('dynamodb')
-secrets_manager_client = boto3.client('secretsmanager')
-ssm_client = boto3.client("ssm")
 
 # Global variables for caching
 connection = None
-db_secret = None
-TABLE_NAME = None
 
 DB_SECRET_NAME = os.environ["SM_DB_CREDENTIALS"]
 RDS_PROXY_ENDPOINT = os.environ["RDS_PROXY_ENDPOINT"]
+# "item" keeps each session's history in one list item; "message" stores one item per message
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "item").lower()
 
-def get_secret(secret_name, expect_json=True):
-    global db_secret
-    if db_secret is None:
-        try:
-            response = secrets_manager_client.get_secret_value(SecretId=secret_name)["SecretString"]
-            db_secret = json.loads(response) if expect_json else response
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode JSON for secret {secret_name}: {e}")
-            raise ValueError(f"Secret {secret_name} is not properly formatted as JSON.")
-        except Exception as e:
-            logger.error(f"Error fetching secret {secret_name}: {e}")
-            raise
-    return db_secret
-
-def get_parameter(param_name):
-    """
-    Fetch a parameter value from Systems Manager Parameter Store.
-    """
-    global TABLE_NAME
-    if TABLE_NAME is None:
-        try:
-            response = ssm_client.get_parameter(Name=param_name, WithDecryption=True)
-            TABLE_NAME = response["Parameter"]["Value"]
-        except Exception as e:
-            logger.error(f"Error fetching parameter {param_name}: {e}")
-            raise
-    return TABLE_NAME
+def open_connection(secret):
+    connection_params = {
+        'dbname': secret["dbname"],
+        'user': secret["username"],
+        'password': secret["password"],
+        'host': RDS_PROXY_ENDPOINT,
+        'port': secret["port"]
+    }
+    connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
+    return psycopg2.connect(connection_string)
 
 def connect_to_db():
     global connection
     if connection is None or connection.closed:
         try:
-            secret = get_secret(DB_SECRET_NAME)
-            connection_params = {
-                'dbname': secret["dbname"],
-                'user': secret["username"],
-                'password': secret["password"],
-                'host': RDS_PROXY_ENDPOINT,
-                'port': secret["port"]
-            }
-            connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
-            connection = psycopg2.connect(connection_string)
+            connection = connect_with_secret(DB_SECRET_NAME, open_connection)
             logger.info("Connected to the database!")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
@@ -76,33 +49,36 @@ def delete_last_two_db_messages(session_id):
     if connection is None:
         logger.error("No database connection available.")
         return None
+    cur = None
     try:
         cur = connection.cursor()
 
+        # Pick and delete the newest two messages in one statement. Nothing is deleted
+        # unless both exist, and concurrent deletes cannot remove more than one exchange.
         cur.execute("""
-            SELECT message_id 
-            FROM "messages" 
-            WHERE session_id = %s
-            ORDER BY time_sent DESC
-            LIMIT 2;
+            WITH last_two AS (
+                SELECT message_id
+                FROM "messages"
+                WHERE session_id = %s
+                ORDER BY time_sent DESC
+                LIMIT 2
+                FOR UPDATE
+            )
+            DELETE FROM "messages" m
+            USING last_two
+            WHERE m.message_id = last_two.message_id
+              AND (SELECT COUNT(*) FROM last_two) = 2
+            RETURNING m.message_id;
         """, (session_id,))
-        
-        messages = cur.fetchall()
 
-        if len(messages) < 2:
-            logger.info(f"Not enough messages to delete for session_id: {session_id}")
-            cur.close()
-            return False
-        
-        message_ids = tuple([msg[0] for msg in messages])
-        
-        cur.execute("""
-            DELETE FROM "messages"
-            WHERE message_id IN %s;
-        """, (message_ids,))
-        
+        deleted = cur.fetchall()
         connection.commit()
         cur.close()
+
+        if len(deleted) < 2:
+            logger.info(f"Not enough messages to delete for session_id: {session_id}")
+            return False
+
         logger.info(f"Successfully deleted the last two messages for session_id: {session_id}")
         return True
 
@@ -113,6 +89,158 @@ def delete_last_two_db_messages(session_id):
         connection.rollback()
         return False
 
+def get_history_length(table_name, session_id):
+    """
+    Return the number of messages in a session's History list, or None if there is no history.
+
+    Items written by the text generation function carry a MessageCount attribute, so only
+    that number is read. Older items without it fall back to reading the list once.
+    """
+    item = dynamodb_client.get_item(
+        TableName=table_name, Key={'SessionId': {'S': session_id}}, ProjectionExpression="MessageCount"
+    ).get('Item')
+    if item and 'MessageCount' in item:
+        return int(item['MessageCount']['N'])
+    return read_history_length(table_name, session_id)
+
+def read_history_length(table_name, session_id):
+    """
+    Return the length of a session's History list by reading it, or None if there is no history.
+    """
+    item = dynamodb_client.get_item(
+        TableName=table_name, Key={'SessionId': {'S': session_id}}, ProjectionExpression="History"
+    ).get('Item')
+    if not item or 'History' not in item:
+        return None
+    return len(item['History']['L'])
+
+def delete_last_two_history_items(table_name, session_id, length):
+    """
+    Remove the last student and AI messages from a session's History list in one update.
+
+    The update only applies if the list still has the expected length, so a message
+    added or deleted concurrently makes it fail instead of removing the wrong elements.
+
+    Returns:
+    bool: True if the messages were removed, False if the history changed in the meantime.
+    """
+    try:
+        dynamodb_client.update_item(
+            TableName=table_name,
+            Key={'SessionId': {'S': session_id}},
+            UpdateExpression=f"REMOVE History[{length - 1}], History[{length - 2}] SET MessageCount = :remaining",
+            ConditionExpression="size(History) = :length",
+            ExpressionAttributeValues={
+                ":length": {"N": str(length)},
+                ":remaining": {"N": str(length - 2)}
+            }
+        )
+        return True
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"History for session_id {session_id} changed while deleting the last messages")
+        return False
+
+def delete_last_two_dynamodb_messages(table_name, session_id):
+    """
+    Delete the last student and AI messages from the per-message history table.
+
+    Only the two newest items are read, and both are deleted in one transaction that
+    requires them to still exist, so a concurrent delete cannot leave half an exchange
+    behind or remove an older message instead.
+
+    Returns:
+    bool: True if the messages were deleted, False if there are fewer than two, or None
+    if the history changed while deleting.
+    """
+    message_table = f"{table_name}-Messages"
+    response = dynamodb_client.query(
+        TableName=message_table,
+        KeyConditionExpression="SessionId = :session AND Seq > :header",
+        ExpressionAttributeValues={":session": {"S": session_id}, ":header": {"N": "0"}},
+        ScanIndexForward=False,
+        Limit=2
+    )
+    items = response.get("Items", [])
+    if len(items) < 2:
+        return False
+
+    try:
+        dynamodb_client.transact_write_items(TransactItems=[
+            {"Delete": {
+                "TableName": message_table,
+                "Key": {"SessionId": item["SessionId"], "Seq": item["Seq"]},
+                "ConditionExpression": "attribute_exists(Seq)",
+            }}
+            for item in items
+        ])
+    except dynamodb_client.exceptions.TransactionCanceledException:
+        logger.info(f"History for session_id {session_id} changed while deleting the last messages")
+        return None
+    return True
+
+def decrement_student_turns(table_name, session_id):
+    """
+    Take the deleted exchange off the session's student turn counter, kept by the text
+    generation function on the "<session_id>#meta" item. Deleting the first exchange
+    brings the counter back to 0, so the next student turn names the session again.
+    """
+    try:
+        dynamodb_client.update_item(
+            TableName=table_name,
+            Key={'SessionId': {'S': f"{session_id}#meta"}},
+            UpdateExpression="ADD StudentTurns :minus_one",
+            ConditionExpression="StudentTurns > :zero",
+            ExpressionAttributeValues={":minus_one": {"N": "-1"}, ":zero": {"N": "0"}}
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        # Only the opening turn was deleted, or the session predates the counter
+        pass
+    except Exception as e:
+        logger.error(f"Error updating the student turn counter for session_id {session_id}: {e}")
+
+def finish_rds_delete(session_id):
+    """
+    Delete the last exchange from RDS once DynamoDB has been updated and build the response.
+    """
+    logger.info(f"Successfully deleted the last human and AI messages in DynamoDB for session_id: {session_id}")
+
+    if delete_last_two_db_messages(session_id):
+        logger.info(f"Successfully deleted the last human and AI messages in RDS for session_id: {session_id}")
+        return {
+            'statusCode': 200,
+            "headers": {
+                "Content-Type": "application/json",
+                "Access-Control-Allow-Headers": "*",
+                "Access-Control-Allow-Origin": "*",
+                "Access-Control-Allow-Methods": "*",
+            },
+            'body': json.dumps(f"Successfully deleted the last human and AI messages for session_id: {session_id}")
+        }
+    else:
+        logger.error(f"Failed to delete the last human and AI messages in RDS for session_id: {session_id}")
+        return {
+            'statusCode': 500,
+            "headers": {
+                "Content-Type": "application/json",
+                "Access-Control-Allow-Headers": "*",
+                "Access-Control-Allow-Origin": "*",
+                "Access-Control-Allow-Methods": "*",
+            },
+            'body': json.dumps(f"Error deleting last messages from the database for session_id: {session_id}")
+        }
+
+def history_changed_response(session_id):
+    return {
+        'statusCode': 409,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Headers": "*",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "*",
+        },
+        'body': json.dumps(f"Conversation history changed while deleting for session_id: {session_id}, please retry")
+    }
+
 def lambda_handler(event, context):
     query_params = event.get("queryStringParameters", {})
 
@@ -132,18 +260,30 @@ def lambda_handler(event, context):
         }
     
     try:
-        # Fetch the conversation history from DynamoDB
         table_name = get_parameter(os.environ["TABLE_NAME_PARAM"])
-        response = dynamodb_client.get_item(
-            TableName=table_name,
-            Key={
-                'SessionId': {
-                    'S': session_id
+
+        if HISTORY_BACKEND == "message":
+            deleted = delete_last_two_dynamodb_messages(table_name, session_id)
+            if deleted is None:
+                return history_changed_response(session_id)
+            if not deleted:
+                logger.info("Not enough messages to delete.")
+                return {
+                    'statusCode': 400,
+                    "headers": {
+                        "Content-Type": "application/json",
+                        "Access-Control-Allow-Headers": "*",
+                        "Access-Control-Allow-Origin": "*",
+                        "Access-Control-Allow-Methods": "*",
+                    },
+                    'body': json.dumps(f"Not enough messages to delete for session_id: {session_id}")
                 }
-            }
-        )
+            decrement_student_turns(table_name, session_id)
+            return finish_rds_delete(session_id)
+
+        length = get_history_length(table_name, session_id)
 
-        if 'Item' not in response or 'History' not in response['Item']:
+        if length is None:
             logger.error(f"No conversation history found for session_id: {session_id}")
             return {
                 'statusCode': 400,
@@ -156,10 +296,8 @@ def lambda_handler(event, context):
                 'body': json.dumps(f"No conversation history found for session_id: {session_id}")
             }
 
-        history = response['Item']['History']['L']
-        
         # There must be 2 messages in the history, 1 from AI and 1 from student
-        if len(history) < 2:
+        if length < 2:
             logger.info("Not enough messages to delete.")
             return {
                 'statusCode': 400,
@@ -172,50 +310,16 @@ def lambda_handler(event, context):
                 'body': json.dumps(f"Not enough messages to delete for session_id: {session_id}")
             }
 
-        # Remove the last AI and human messages by popping the last two elements
-        history.pop()
-        history.pop()
-
-        # Update the conversation history in DynamoDB
-        dynamodb_client.update_item(
-            TableName=table_name,
-            Key={
-                'SessionId': {
-                    'S': session_id
-                }
-            },
-            UpdateExpression="SET History = :history",
-            ExpressionAttributeValues={
-                ":history": {"L": history}
-            }
-        )
-
-        logger.info(f"Successfully deleted the last human and AI messages in DynamoDB for session_id: {session_id}")
+        # Remove the last AI and human messages by index
+        if not delete_last_two_history_items(table_name, session_id, length):
+            # MessageCount may not match the list (e.g. it was seeded after the list was
+            # written), so retry once with the real length, which also corrects the count
+            length = read_history_length(table_name, session_id)
+            if length is None or length < 2 or not delete_last_two_history_items(table_name, session_id, length):
+                return history_changed_response(session_id)
 
-        if delete_last_two_db_messages(session_id):
-            logger.info(f"Successfully deleted the last human and AI messages in RDS for session_id: {session_id}")
-            return {
-                'statusCode': 200,
-                "headers": {
-                    "Content-Type": "application/json",
-                    "Access-Control-Allow-Headers": "*",
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "*",
-                },
-                'body': json.dumps(f"Successfully deleted the last human and AI messages for session_id: {session_id}")
-            }
-        else:
-            logger.error(f"Failed to delete the last human and AI messages in RDS for session_id: {session_id}")
-            return {
-                'statusCode': 500,
-                "headers": {
-                    "Content-Type": "application/json",
-                    "Access-Control-Allow-Headers": "*",
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "*",
-                },
-                'body': json.dumps(f"Error deleting last messages from the database for session_id: {session_id}")
-            }
+        decrement_student_turns(table_name, session_id)
+        return finish_rds_delete(session_id)
 
     except Exception as e:
         logger.error(f"Error deleting last message: {e}")
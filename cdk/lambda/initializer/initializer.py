@@ -141,6 +141,67 @@ def handler(event, context):
                 "engagement_details" text
             );
 
+            -- One row per model call made by text generation, written in batches
+            CREATE TABLE IF NOT EXISTS "model_usage" (
+                "usage_id" uuid PRIMARY KEY DEFAULT (uuid_generate_v4()),
+                "session_id" uuid,
+                "simulation_group_id" uuid,
+                "patient_id" uuid,
+                "model_id" varchar,
+                "call_type" varchar,
+                "input_tokens" integer,
+                "output_tokens" integer,
+                "latency_ms" integer,
+                "cost_usd" numeric(12, 6),
+                "time_recorded" timestamp
+            );
+
+            CREATE INDEX IF NOT EXISTS "model_usage_simulation_group_idx" ON "model_usage" ("simulation_group_id", "time_recorded");
+            CREATE INDEX IF NOT EXISTS "model_usage_session_idx" ON "model_usage" ("session_id");
+
+            CREATE OR REPLACE VIEW "session_model_usage" AS
+                SELECT session_id, simulation_group_id, patient_id,
+                       COUNT(*) AS model_calls, SUM(input_tokens) AS input_tokens,
+                       SUM(output_tokens) AS output_tokens, SUM(cost_usd) AS cost_usd,
+                       MIN(time_recorded) AS first_call, MAX(time_recorded) AS last_call
+                FROM "model_usage"
+                GROUP BY session_id, simulation_group_id, patient_id;
+
+            CREATE OR REPLACE VIEW "patient_model_usage" AS
+                SELECT patient_id, simulation_group_id, call_type, model_id,
+                       COUNT(*) AS model_calls, COUNT(DISTINCT session_id) AS sessions,
+                       SUM(input_tokens) AS input_tokens, SUM(output_tokens) AS output_tokens,
+                       SUM(cost_usd) AS cost_usd, AVG(latency_ms) AS avg_latency_ms
+                FROM "model_usage"
+                GROUP BY patient_id, simulation_group_id, call_type, model_id;
+
+            CREATE OR REPLACE VIEW "simulation_group_model_usage" AS
+                SELECT simulation_group_id, date_trunc('day', time_recorded) AS day,
+                       COUNT(*) AS model_calls, COUNT(DISTINCT session_id) AS sessions,
+                       SUM(input_tokens) AS input_tokens, SUM(output_tokens) AS output_tokens,
+                       SUM(cost_usd) AS cost_usd
+                FROM "model_usage"
+                GROUP BY simulation_group_id, date_trunc('day', time_recorded);
+
+            -- Bumped on every edit, so the text generation function can tell its cached
+            -- copy of a patient or simulation group prompt is stale
+            ALTER TABLE "simulation_groups" ADD COLUMN IF NOT EXISTS "config_version" integer NOT NULL DEFAULT 0;
+            ALTER TABLE "patients" ADD COLUMN IF NOT EXISTS "config_version" integer NOT NULL DEFAULT 0;
+
+            CREATE OR REPLACE FUNCTION bump_config_version() RETURNS trigger AS $$
+            BEGIN
+                NEW.config_version := OLD.config_version + 1;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS simulation_groups_config_version ON "simulation_groups";
+            CREATE TRIGGER simulation_groups_config_version BEFORE UPDATE ON "simulation_groups"
+                FOR EACH ROW EXECUTE FUNCTION bump_config_version();
+            DROP TRIGGER IF EXISTS patients_config_version ON "patients";
+            CREATE TRIGGER patients_config_version BEFORE UPDATE ON "patients"
+                FOR EACH ROW EXECUTE FUNCTION bump_config_version();
+
             -- Add foreign key constraints
             ALTER TABLE "user_engagement_log" ADD FOREIGN KEY ("enrolment_id") REFERENCES "enrolments" ("enrolment_id") ON DELETE CASCADE ON UPDATE CASCADE;
             ALTER TABLE "user_engagement_log" ADD FOREIGN KEY ("user_id") REFERENCES "users" ("user_id") ON DELETE CASCADE ON UPDATE CASCADE;
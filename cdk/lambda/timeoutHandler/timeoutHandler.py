@@ -3,6 +3,7 @@ import json
 import boto3
 import logging
 import psycopg2
+from config_loader import connect_with_secret
 from aws_lambda_powertools import Logger
 
 logger = Logger()
@@ -11,41 +12,25 @@ logger = Logger()
 DB_SECRET_NAME = os.environ["SM_DB_CREDENTIALS"]
 RDS_PROXY_ENDPOINT = os.environ["RDS_PROXY_ENDPOINT"]
 
-# AWS Clients
-secrets_manager_client = boto3.client('secretsmanager')
-
 # Global variables for caching
 connection = None
-db_secret = None
 
-def get_secret(secret_name):
-    global db_secret
-    if db_secret is None:
-        try:
-            response = secrets_manager_client.get_secret_value(SecretId=secret_name)["SecretString"]
-            db_secret = json.loads(response)
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode JSON for secret {secret_name}: {e}")
-            raise ValueError(f"Secret {secret_name} is not properly formatted as JSON.")
-        except Exception as e:
-            logger.error(f"Error fetching secret {secret_name}: {e}")
-            raise
-    return db_secret
+def open_connection(secret):
+    connection_params = {
+        'dbname': secret["dbname"],
+        'user': secret["username"],
+        'password': secret["password"],
+        'host': RDS_PROXY_ENDPOINT,
+        'port': secret["port"]
+    }
+    connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
+    return psycopg2.connect(connection_string)
 
 def connect_to_db():
     global connection
     if connection is None or connection.closed:
         try:
-            secret = get_secret(DB_SECRET_NAME)
-            connection_params = {
-                'dbname': secret["dbname"],
-                'user': secret["username"],
-                'password': secret["password"],
-                'host': RDS_PROXY_ENDPOINT,
-                'port': secret["port"]
-            }
-            connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
-            connection = psycopg2.connect(connection_string)
+            connection = connect_with_secret(DB_SECRET_NAME, open_connection)
             logger.info("Connected to the database!")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
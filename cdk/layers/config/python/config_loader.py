@@ -0,0 +1,180 @@
+"""
+Shared configuration loading for the Python Lambdas.
+
+SSM parameters are fetched in batches with get_parameters and Secrets Manager secrets
+are cached with a TTL, so a warm container serves both from memory while still
+picking up rotated credentials. Deployed as a Lambda layer for the zip-packaged
+functions and copied into the text generation and data ingestion images.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+# How long values are served from memory before being fetched again
+PARAMETER_TTL_SECONDS = float(os.environ.get("PARAMETER_TTL_SECONDS", "900"))
+SECRET_TTL_SECONDS = float(os.environ.get("SECRET_TTL_SECONDS", "300"))
+
+# get_parameters accepts at most 10 names per call
+SSM_BATCH_SIZE = 10
+
+# Optional JSON file of the form {"parameters": {name: value}, "secrets": {name: value}}
+# whose values are used instead of SSM and Secrets Manager, for running outside AWS
+CONFIG_OVERRIDES_FILE = os.environ.get("CONFIG_OVERRIDES_FILE")
+
+# Substrings of database errors that mean the credentials are no longer valid
+AUTH_ERROR_MARKERS = ("password authentication failed", "authentication failed", "invalid password")
+
+# Clients are created on first use so importing this module costs nothing
+clients = {}
+
+# name -> (value, fetched_at)
+parameter_cache = {}
+secret_cache = {}
+cache_lock = threading.Lock()
+
+overrides = None
+
+def get_overrides() -> dict:
+    global overrides
+    if overrides is None:
+        overrides = {}
+        if CONFIG_OVERRIDES_FILE:
+            with open(CONFIG_OVERRIDES_FILE) as f:
+                overrides = json.load(f)
+            logger.info(f"Using configuration overrides from {CONFIG_OVERRIDES_FILE}")
+    return overrides
+
+def get_client(service: str):
+    if service not in clients:
+        clients[service] = boto3.client(service, region_name=os.environ.get("REGION"))
+    return clients[service]
+
+def is_fresh(entry, ttl_seconds: float) -> bool:
+    return entry is not None and time.monotonic() - entry[1] < ttl_seconds
+
+def get_parameters(names, force_refresh: bool = False) -> dict:
+    """
+    Fetch several SSM parameters, using as few get_parameters calls as possible.
+
+    Args:
+    names (list): The parameter names.
+    force_refresh (bool): Ignore cached values.
+
+    Returns:
+    dict: Parameter name to value.
+
+    Raises:
+    KeyError: If any of the parameters does not exist.
+    """
+    local = get_overrides().get("parameters", {})
+    with cache_lock:
+        cached = {name: parameter_cache.get(name) for name in names if name not in local}
+    missing = [name for name, entry in cached.items() if force_refresh or not is_fresh(entry, PARAMETER_TTL_SECONDS)]
+
+    if missing:
+        start = time.perf_counter()
+        fetched_at = time.monotonic()
+        for i in range(0, len(missing), SSM_BATCH_SIZE):
+            try:
+                response = get_client("ssm").get_parameters(
+                    Names=missing[i:i + SSM_BATCH_SIZE], WithDecryption=True
+                )
+            except Exception as e:
+                logger.error(f"Error fetching parameters {missing[i:i + SSM_BATCH_SIZE]}: {e}")
+                raise
+            if response.get("InvalidParameters"):
+                raise KeyError(f"SSM parameters not found: {response['InvalidParameters']}")
+            with cache_lock:
+                for parameter in response["Parameters"]:
+                    entry = (parameter["Value"], fetched_at)
+                    parameter_cache[parameter["Name"]] = entry
+                    cached[parameter["Name"]] = entry
+        logger.info(f"Loaded {len(missing)} SSM parameters in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    values = {name: entry[0] for name, entry in cached.items()}
+    values.update({name: local[name] for name in names if name in local})
+    return values
+
+def get_parameter(name: str) -> str:
+    """
+    Fetch a single SSM parameter through the shared cache.
+    """
+    return get_parameters([name])[name]
+
+def get_secret(secret_name: str, expect_json: bool = True, force_refresh: bool = False):
+    """
+    Fetch a Secrets Manager secret, served from memory for SECRET_TTL_SECONDS.
+
+    Args:
+    secret_name (str): The secret name or ARN.
+    expect_json (bool): Parse the secret string as JSON.
+    force_refresh (bool): Ignore the cached value, e.g. after an authentication failure.
+
+    Returns:
+    dict or str: The secret value.
+    """
+    local = get_overrides().get("secrets", {})
+    if secret_name in local:
+        return local[secret_name]
+
+    key = (secret_name, expect_json)
+    with cache_lock:
+        entry = secret_cache.get(key)
+    if not force_refresh and is_fresh(entry, SECRET_TTL_SECONDS):
+        return entry[0]
+
+    try:
+        response = get_client("secretsmanager").get_secret_value(SecretId=secret_name)["SecretString"]
+        value = json.loads(response) if expect_json else response
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to decode JSON for secret {secret_name}: {e}")
+        raise ValueError(f"Secret {secret_name} is not properly formatted as JSON.")
+    except Exception as e:
+        logger.error(f"Error fetching secret {secret_name}: {e}")
+        raise
+
+    with cache_lock:
+        secret_cache[key] = (value, time.monotonic())
+    return value
+
+def invalidate_secret(secret_name: str) -> None:
+    """
+    Drop a cached secret so the next get_secret call fetches the current version.
+    """
+    with cache_lock:
+        for key in [key for key in secret_cache if key[0] == secret_name]:
+            del secret_cache[key]
+
+def is_auth_error(error: Exception) -> bool:
+    """
+    Check whether a database error was caused by rejected credentials.
+    """
+    message = str(error).lower()
+    return any(marker in message for marker in AUTH_ERROR_MARKERS)
+
+def connect_with_secret(secret_name: str, connect):
+    """
+    Open a database connection with credentials from a secret, retrying once with a
+    freshly fetched secret if the cached credentials were rotated.
+
+    Args:
+    secret_name (str): The database credentials secret.
+    connect (callable): Takes the secret dict and returns an open connection.
+
+    Returns:
+    The connection returned by connect.
+    """
+    try:
+        return connect(get_secret(secret_name))
+    except Exception as e:
+        if not is_auth_error(e):
+            raise
+        logger.warning(f"Database authentication failed, refreshing secret {secret_name}")
+        invalidate_secret(secret_name)
+        return connect(get_secret(secret_name, force_refresh=True))
@@ -0,0 +1,113 @@
+"""
+One bounded psycopg3 connection pool per container for the image-based Lambdas.
+
+The SQLAlchemy engine created here is used directly by PGVector and SQLRecordManager,
+and plain DB-API connections for metadata queries are checked out of the same pool
+with db_connection(), so a warm container holds at most DB_POOL_SIZE connections to
+RDS Proxy in total. Connections are pinged before every checkout, so a connection
+dropped by the proxy is replaced transparently instead of failing the request.
+"""
+import os
+import logging
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL, Engine
+
+from config_loader import get_secret, connect_with_secret
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT_SECONDS = float(os.environ.get("DB_POOL_TIMEOUT_SECONDS", "10"))
+# RDS Proxy closes client connections idle for longer than its idle timeout
+DB_POOL_RECYCLE_SECONDS = int(os.environ.get("DB_POOL_RECYCLE_SECONDS", "1800"))
+
+engines = {}
+engines_lock = threading.Lock()
+
+def build_connection_string(secret: dict, host: str) -> str:
+    """
+    Build the psycopg3 SQLAlchemy URL for a database credentials secret.
+    """
+    return URL.create(
+        "postgresql+psycopg",
+        username=secret["username"],
+        password=secret["password"],
+        host=host,
+        port=int(secret["port"]),
+        database=secret["dbname"],
+    ).render_as_string(hide_password=False)
+
+def create_pooled_engine(connection_string: str) -> Engine:
+    """
+    Create an engine with the container's pool settings (see get_engine).
+    """
+    return create_engine(
+        connection_string,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=0,
+        pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+        pool_recycle=DB_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=True,
+    )
+
+def get_engine(connection_string: str) -> Engine:
+    """
+    Return the pooled engine for a connection string, creating it on first use.
+
+    When the connection string changes (the credentials were rotated), engines for the
+    old string are disposed so their connections are not kept open.
+
+    Args:
+    connection_string (str): The SQLAlchemy connection URL.
+
+    Returns:
+    Engine: The shared engine.
+    """
+    engine = engines.get(connection_string)
+    if engine is not None:
+        return engine
+    with engines_lock:
+        engine = engines.get(connection_string)
+        if engine is None:
+            for stale in [key for key in engines if key != connection_string]:
+                engines.pop(stale).dispose()
+            engine = create_pooled_engine(connection_string)
+            engines[connection_string] = engine
+    return engine
+
+def get_database_engine(secret_name: str, host: str) -> Engine:
+    """
+    Return the pooled engine for the credentials currently stored in a secret.
+    """
+    return get_engine(build_connection_string(get_secret(secret_name), host))
+
+@contextmanager
+def db_connection(secret_name: str, host: str):
+    """
+    Check a DB-API connection out of the pool for the duration of a with block.
+
+    The connection has the usual cursor(), commit() and rollback() methods. It is
+    returned to the pool (with any open transaction rolled back) when the block exits.
+    If the cached credentials were rotated, the secret is refreshed and the checkout
+    retried once.
+    """
+    connection = connect_with_secret(
+        secret_name,
+        lambda secret: get_engine(build_connection_string(secret, host)).raw_connection()
+    )
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+def get_pool_status() -> dict:
+    """
+    Return how many connections each engine currently holds, for logging.
+    """
+    return {
+        engine.url.host: {"size": engine.pool.size(), "checked_out": engine.pool.checkedout()}
+        for engine in list(engines.values())
+    }
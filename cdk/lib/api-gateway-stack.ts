@@ -111,6 +111,16 @@ export class ApiGatewayStack extends cdk.Stack {
       description: "Lambda layer containing the psycopg2 Python library",
     });
 
+    /**
+     *
+     * Create Lambda layer for the shared SSM parameter and secret loader
+     */
+    const configLoaderLayer = new LayerVersion(this, "configLoaderLayer", {
+      code: Code.fromAsset("./layers/config"),
+      compatibleRuntimes: [Runtime.PYTHON_3_9, Runtime.PYTHON_3_11],
+      description: "Lambda layer containing the shared config_loader Python module",
+    });
+
     // powertoolsLayer does not follow the format of layerList
     const powertoolsLayer = lambda.LayerVersion.fromLayerVersionArn(
       this,
@@ -877,6 +887,11 @@ export class ApiGatewayStack extends cdk.Stack {
       stringValue: "DynamoDB-Conversation-Table",
     });
 
+    // Chat history layout shared by the text generation and deleteLastMessage functions:
+    // "item" keeps one History list per session, "message" stores one item per message
+    // (run text_generation/migrate_history.py before switching)
+    const historyBackend = "item";
+
     /**
      *
      * Create Lambda with container image for text generation workflow in RAG pipeline
@@ -885,7 +900,11 @@ export class ApiGatewayStack extends cdk.Stack {
       this,
       `${id}-TextGenLambdaDockerFunction`,
       {
-        code: lambda.DockerImageCode.fromImageAsset("./text_generation"),
+        code: lambda.DockerImageCode.fromImageAsset(".", {
+          // Built from the cdk directory so the image can include layers/config
+          file: "text_generation/Dockerfile",
+          exclude: ["node_modules", "cdk.out", "test", "layers/*.zip"],
+        }),
         memorySize: 512,
         timeout: cdk.Duration.seconds(300),
         vpc: vpcStack.vpc, // Pass the VPC
@@ -897,6 +916,7 @@ export class ApiGatewayStack extends cdk.Stack {
           BEDROCK_LLM_PARAM: bedrockLLMParameter.parameterName,
           EMBEDDING_MODEL_PARAM: embeddingModelParameter.parameterName,
           TABLE_NAME_PARAM: tableNameParameter.parameterName,
+          HISTORY_BACKEND: historyBackend,
         },
       }
     );
@@ -950,22 +970,37 @@ export class ApiGatewayStack extends cdk.Stack {
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
         actions: [
-          "dynamodb:ListTables",
           "dynamodb:CreateTable",
           "dynamodb:DescribeTable",
           "dynamodb:PutItem",
           "dynamodb:GetItem",
           "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem",
+          "dynamodb:Query",
+          "dynamodb:BatchWriteItem",
+          // Expiry of the rate limiter's bucket windows (RATE_LIMIT_BACKEND=dynamodb)
+          "dynamodb:UpdateTimeToLive",
         ],
         resources: [`arn:aws:dynamodb:${this.region}:${this.account}:table/*`],
       })
     );
 
+    // Allow the function to invoke itself asynchronously for background session naming
+    textGenLambdaDockerFunc.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["lambda:InvokeFunction"],
+        resources: [
+          `arn:aws:lambda:${this.region}:${this.account}:function:${id}-TextGenLambdaDockerFunction`,
+        ],
+      })
+    );
+
     // Grant access to SSM Parameter Store for specific parameters
     textGenLambdaDockerFunc.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
-        actions: ["ssm:GetParameter"],
+        actions: ["ssm:GetParameter", "ssm:GetParameters"],
         resources: [
           bedrockLLMParameter.parameterArn,
           embeddingModelParameter.parameterArn,
@@ -1047,7 +1082,11 @@ export class ApiGatewayStack extends cdk.Stack {
       this,
       `${id}-DataIngestLambdaDockerFunction`,
       {
-        code: lambda.DockerImageCode.fromImageAsset("./data_ingestion"),
+        code: lambda.DockerImageCode.fromImageAsset(".", {
+          // Built from the cdk directory so the image can include layers/config
+          file: "data_ingestion/Dockerfile",
+          exclude: ["node_modules", "cdk.out", "test", "layers/*.zip"],
+        }),
         memorySize: 3008,
         timeout: cdk.Duration.seconds(900),
         vpc: vpcStack.vpc, // Pass the VPC
@@ -1131,7 +1170,7 @@ export class ApiGatewayStack extends cdk.Stack {
     dataIngestLambdaDockerFunc.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
-        actions: ["ssm:GetParameter"],
+        actions: ["ssm:GetParameter", "ssm:GetParameters"],
         resources: [embeddingModelParameter.parameterArn],
       })
     );
@@ -1189,7 +1228,7 @@ export class ApiGatewayStack extends cdk.Stack {
         RDS_PROXY_ENDPOINT: db.rdsProxyEndpoint,
       },
       functionName: `${id}-TimeoutHandlerLambda`,
-      layers: [psycopgLayer, powertoolsLayer],
+      layers: [psycopgLayer, powertoolsLayer, configLoaderLayer],
       role: lambdaRole,
     });
   
@@ -1226,7 +1265,7 @@ export class ApiGatewayStack extends cdk.Stack {
         REGION: this.region,
       },
       functionName: `${id}-GetFilesFunction`,
-      layers: [psycopgLayer, powertoolsLayer],
+      layers: [psycopgLayer, powertoolsLayer, configLoaderLayer],
     });
 
     // Override the Logical ID of the Lambda Function to get ARN in OpenAPI
@@ -1276,7 +1315,7 @@ export class ApiGatewayStack extends cdk.Stack {
         REGION: this.region,
       },
       functionName: `${id}-GetFilesFunctionStudent`,
-      layers: [psycopgLayer, powertoolsLayer],
+      layers: [psycopgLayer, powertoolsLayer, configLoaderLayer],
     });
 
     // Override the Logical ID of the Lambda Function to get ARN in OpenAPI
@@ -1326,7 +1365,7 @@ export class ApiGatewayStack extends cdk.Stack {
         REGION: this.region,
       },
       functionName: `${id}-GetProfilePictures`,
-      layers: [psycopgLayer, powertoolsLayer],
+      layers: [psycopgLayer, powertoolsLayer, configLoaderLayer],
     });
 
     // Override the Logical ID of the Lambda Function to get ARN in OpenAPI
@@ -1376,7 +1415,7 @@ export class ApiGatewayStack extends cdk.Stack {
         REGION: this.region,
       },
       functionName: `${id}-GetProfilePicturesStudent`,
-      layers: [psycopgLayer, powertoolsLayer],
+      layers: [psycopgLayer, powertoolsLayer, configLoaderLayer],
     });
 
     // Override the Logical ID of the Lambda Function to get ARN in OpenAPI
@@ -1426,7 +1465,7 @@ export class ApiGatewayStack extends cdk.Stack {
         REGION: this.region,
       },
       functionName: `${id}-DeleteFileFunction`,
-      layers: [psycopgLayer, powertoolsLayer],
+      layers: [psycopgLayer, powertoolsLayer, configLoaderLayer],
     });
 
     // Override the Logical ID of the Lambda Function to get ARN in OpenAPI
@@ -1507,9 +1546,10 @@ export class ApiGatewayStack extends cdk.Stack {
         RDS_PROXY_ENDPOINT: db.rdsProxyEndpoint,
         TABLE_NAME_PARAM: tableNameParameter.parameterName,
         REGION: this.region,
+        HISTORY_BACKEND: historyBackend,
       },
       functionName: `${id}-DeleteLastMessage`,
-      layers: [psycopgLayer, powertoolsLayer],
+      layers: [psycopgLayer, powertoolsLayer, configLoaderLayer],
     });
 
     // Override the Logical ID of the Lambda Function to get ARN in OpenAPI
@@ -1535,7 +1575,8 @@ export class ApiGatewayStack extends cdk.Stack {
     deleteLastMessage.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
-        actions: ["dynamodb:GetItem", "dynamodb:UpdateItem"],
+        // DeleteItem covers the transactional delete of the last two messages (HISTORY_BACKEND=message)
+        actions: ["dynamodb:GetItem", "dynamodb:UpdateItem", "dynamodb:DeleteItem", "dynamodb:Query", "dynamodb:BatchWriteItem"],
         resources: [`arn:aws:dynamodb:${this.region}:${this.account}:table/*`],
       })
     );
@@ -1551,7 +1592,7 @@ export class ApiGatewayStack extends cdk.Stack {
     deleteLastMessage.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
-        actions: ["ssm:GetParameter"],
+        actions: ["ssm:GetParameter", "ssm:GetParameters"],
         resources: [
           tableNameParameter.parameterArn,
         ],
@@ -0,0 +1,102 @@
+"""
+Measure the per-turn cost of building the patient's RAG chain, with and without the
+compiled chain cache.
+
+Before the cache, every turn built the history-aware retriever (contextualize prompt
+and create_history_aware_retriever) and then compiled the conversational chain
+(ChatPromptTemplate, create_stuff_documents_chain, create_retrieval_chain and
+RunnableWithMessageHistory). With the cache, a warm turn fingerprints the chain inputs
+and looks the compiled chain up. Nothing is invoked, so no model or database is called;
+the stub chat model from helpers/stub_clients.py stands in for ChatBedrock:
+
+    python chain_cache_benchmark.py --iterations 2000
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from langchain.chains import create_history_aware_retriever
+from langchain_core.documents import Document
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableLambda
+
+from helpers.stub_clients import StubChatModel
+from helpers import chat
+
+PATIENT = {
+    "system_prompt": "Let the student lead, and only reveal the medication history when asked about it.",
+    "patient_name": "Maria",
+    "patient_age": "58",
+    "patient_prompt": "Anxious about her health, and worried the headaches mean something serious.",
+    "llm_completion": True,
+}
+
+CONTEXTUALIZE_PROMPT = (
+    "Given a chat history and the latest user question "
+    "which might reference context in the chat history, "
+    "formulate a standalone question which can be understood "
+    "without the chat history. Do NOT answer the question, "
+    "just reformulate it if needed and otherwise return it as is."
+)
+
+def build_uncached(llm, retriever, table_name: str, structured_output: bool):
+    """
+    Build the retriever and chain the way every turn did before the cache.
+    """
+    contextualize_q_prompt = ChatPromptTemplate.from_messages(
+        [("system", CONTEXTUALIZE_PROMPT), MessagesPlaceholder("chat_history"), ("human", "{input}")]
+    )
+    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+    return chat.compile_conversational_rag_chain(
+        llm=llm, history_aware_retriever=history_aware_retriever, table_name=table_name,
+        structured_output=structured_output, **PATIENT
+    )
+
+def measure(func, iterations: int) -> list:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+def summarize(timings: list) -> str:
+    timings = sorted(timings)
+    return (f"mean {statistics.mean(timings):8.1f}us, p50 {timings[len(timings) // 2]:8.1f}us, "
+            f"p99 {timings[int(len(timings) * 0.99)]:8.1f}us")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--table", default="chat-history", help="Table name baked into the chain (not accessed).")
+    args = parser.parse_args()
+
+    llm = StubChatModel(model_id="meta.llama3-70b-instruct-v1:0")
+    retriever = RunnableLambda(lambda query: [Document(page_content="Maria has had headaches for three weeks.")])
+    history_aware_retriever = create_history_aware_retriever(llm, retriever, ChatPromptTemplate.from_messages(
+        [("system", CONTEXTUALIZE_PROMPT), MessagesPlaceholder("chat_history"), ("human", "{input}")]
+    ))
+
+    for structured_output in (False, True):
+        label = "combined" if structured_output else "separate"
+        # Warm up imports and the cache entry the cached turns hit
+        build_uncached(llm, retriever, args.table, structured_output)
+        chat.build_conversational_rag_chain(
+            llm, history_aware_retriever, args.table, structured_output=structured_output, **PATIENT
+        )
+
+        uncached = measure(lambda: build_uncached(llm, retriever, args.table, structured_output), args.iterations)
+        cached = measure(lambda: chat.build_conversational_rag_chain(
+            llm, history_aware_retriever, args.table, structured_output=structured_output, **PATIENT
+        ), args.iterations)
+        print(f"{label} output, rebuilt every turn: {summarize(uncached)}")
+        print(f"{label} output, cache hit         : {summarize(cached)}")
+        print(f"{label} output, saved per turn    : {statistics.mean(uncached) - statistics.mean(cached):.1f}us "
+              f"({statistics.mean(uncached) / statistics.mean(cached):.0f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Measure the per-turn overhead the shared client registry (helpers/clients.py) removes:
+building AWS clients and models on every turn, and opening a new TLS connection for
+every Bedrock call because the clients holding the old ones were thrown away.
+
+construction - what a student turn built before the registry (a bedrock-runtime client
+               for the Nova evaluation, a ChatBedrock with its own client, and a DynamoDB
+               client for the session name) against the registry lookups that replace them.
+calls        - InvokeModel calls against a local HTTPS endpoint, with a new client per
+               call (a TCP connect and TLS handshake each time) against one shared client
+               that keeps its connection alive. The endpoint counts the connections it
+               accepts. It is on the same host, so the handshake cost here is CPU only; add
+               a network round trip or two per handshake for Bedrock itself.
+
+Nothing is sent to AWS; dummy credentials are enough:
+
+    AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x REGION=us-east-1 python client_registry_benchmark.py
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+import boto3
+import urllib3
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from langchain_aws import ChatBedrock
+
+from helpers import clients
+
+MODEL_ID = "meta.llama3-70b-instruct-v1:0"
+REPLY = {"generation": "I've been getting these headaches most afternoons.", "prompt_token_count": 900,
+         "generation_token_count": 20, "stop_reason": "stop"}
+
+# The local endpoint's certificate is self-signed
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+class InvokeModelHandler(BaseHTTPRequestHandler):
+    """
+    Answers every POST like bedrock-runtime's InvokeModel, over keep-alive HTTP/1.1.
+    """
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, delayed ACKs add ~40ms per reply
+    disable_nagle_algorithm = True
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        with InvokeModelHandler.lock:
+            InvokeModelHandler.connections += 1
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps(REPLY).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def write_self_signed_certificate(directory: str) -> tuple:
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number()).not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256())
+    )
+    cert_path, key_path = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return cert_path, key_path
+
+def start_endpoint(directory: str) -> ThreadingHTTPServer:
+    cert_path, key_path = write_self_signed_certificate(directory)
+    server = ThreadingHTTPServer(("localhost", 0), InvokeModelHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def measure(func, iterations: int) -> list:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def summarize(timings: list) -> str:
+    timings = sorted(timings)
+    return f"mean {statistics.mean(timings):7.2f}ms, p50 {timings[len(timings) // 2]:7.2f}ms, max {timings[-1]:7.2f}ms"
+
+def build_per_turn(region: str) -> None:
+    """
+    The clients and models a turn built for itself before the registry.
+    """
+    boto3.client("bedrock-runtime", region_name=region)
+    ChatBedrock(model_id=MODEL_ID, model_kwargs=dict(temperature=0), region_name=region)
+    boto3.client("dynamodb", region_name=region)
+
+def get_from_registry(region: str) -> None:
+    clients.get_client("bedrock-runtime", region)
+    clients.get_chat_model(MODEL_ID, region=region)
+    clients.get_client("dynamodb", region)
+
+def invoke(client) -> dict:
+    # Reading the body, as the engine does, returns the connection to the client's pool
+    response = client.invoke_model(modelId=MODEL_ID, body=json.dumps({"prompt": "Hello", "max_gen_len": 64}))
+    return json.loads(response["body"].read())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--region", default=os.environ.get("REGION", "us-east-1"))
+    args = parser.parse_args()
+
+    get_from_registry(args.region)
+    print(f"construction, per turn : {summarize(measure(lambda: build_per_turn(args.region), args.iterations))}")
+    print(f"construction, registry : {summarize(measure(lambda: get_from_registry(args.region), args.iterations))}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_endpoint(directory)
+        endpoint_url = f"https://localhost:{server.server_address[1]}"
+        config = clients.bedrock_client_config
+
+        def new_client():
+            return boto3.client("bedrock-runtime", region_name=args.region, endpoint_url=endpoint_url,
+                                verify=False, config=config)
+
+        InvokeModelHandler.connections = 0
+        per_call = measure(lambda: invoke(new_client()), args.iterations)
+        fresh_connections = InvokeModelHandler.connections
+
+        shared = new_client()
+        invoke(shared)
+        InvokeModelHandler.connections = 0
+        reused = measure(lambda: invoke(shared), args.iterations)
+        shared_connections = InvokeModelHandler.connections
+        server.shutdown()
+
+    print(f"calls, new client each : {summarize(per_call)}; {fresh_connections} TLS connections for {args.iterations} calls")
+    print(f"calls, shared client   : {summarize(reused)}; {shared_connections} TLS connections for {args.iterations} calls")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Measure cold-start INIT duration of the deployed text generation function.
+
+Each round changes a dummy environment variable to force Lambda onto a fresh
+container, invokes the function once with an empty event (answered with a 400 before
+any database or Bedrock call), and reads the "Init Duration" and "Duration" figures
+from the REPORT line of the invocation log:
+
+    python cold_start_benchmark.py --function <stack>-TextGenLambdaDockerFunction --rounds 5
+
+Pass --max-init-ms to exit non-zero when the median INIT duration exceeds a budget,
+so the script can gate a deploy. Set IMPORT_PROFILE=true on the function to also get
+the per-module import breakdown in its logs.
+"""
+import re
+import sys
+import json
+import uuid
+import base64
+import argparse
+import statistics
+
+import boto3
+
+REPORT_PATTERN = re.compile(r"\t(Init Duration|Duration): ([\d.]+) ms")
+
+def force_cold_start(client, function_name: str) -> None:
+    """
+    Change a dummy environment variable so the next invocation gets a new container.
+    """
+    configuration = client.get_function_configuration(FunctionName=function_name)
+    variables = configuration.get("Environment", {}).get("Variables", {})
+    variables["COLD_START_BENCHMARK_NONCE"] = str(uuid.uuid4())
+    client.update_function_configuration(FunctionName=function_name, Environment={"Variables": variables})
+    client.get_waiter("function_updated_v2").wait(FunctionName=function_name)
+
+def invoke(client, function_name: str) -> dict:
+    """
+    Invoke the function once and return the durations from its REPORT line.
+    """
+    response = client.invoke(
+        FunctionName=function_name,
+        Payload=json.dumps({}),
+        LogType="Tail",
+    )
+    log = base64.b64decode(response["LogResult"]).decode()
+    return {name: float(value) for name, value in REPORT_PATTERN.findall(log)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--function", required=True, help="The text generation function name.")
+    parser.add_argument("--region", default=None, help="AWS region of the function.")
+    parser.add_argument("--rounds", type=int, default=5, help="Number of cold starts to measure.")
+    parser.add_argument("--max-init-ms", type=float, default=None, help="Fail if the median INIT duration exceeds this.")
+    args = parser.parse_args()
+
+    client = boto3.client("lambda", region_name=args.region)
+    init_durations = []
+    for round_number in range(1, args.rounds + 1):
+        force_cold_start(client, args.function)
+        durations = invoke(client, args.function)
+        if "Init Duration" not in durations:
+            print(f"round {round_number}: no Init Duration reported (warm container?)")
+            continue
+        init_durations.append(durations["Init Duration"])
+        print(f"round {round_number}: init {durations['Init Duration']:.1f}ms, "
+              f"first request {durations.get('Duration', 0):.1f}ms")
+
+    if not init_durations:
+        print("No cold starts measured")
+        sys.exit(1)
+
+    median = statistics.median(init_durations)
+    print(f"INIT duration over {len(init_durations)} cold starts: "
+          f"min {min(init_durations):.1f}ms, median {median:.1f}ms, max {max(init_durations):.1f}ms")
+
+    if args.max_init_ms is not None and median > args.max_init_ms:
+        print(f"Median INIT duration {median:.1f}ms exceeds budget of {args.max_init_ms:.1f}ms")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Measure how configuration loading adds to a text generation cold start and to the first
+and later requests of a container, before and after the shared config loader
+(layers/config/python/config_loader.py).
+
+    before - main.py created its SSM and Secrets Manager clients at import and, on the
+             first request, fetched the three parameters with sequential get_parameter
+             calls and the database secret with get_secret_value
+    after  - load_configuration() fetches the parameters with one get_parameters call
+             and the secret during the init phase; requests read both from memory
+
+Each round starts a fresh "container" (new clients and empty caches) and reports the
+time spent in init and in the first and second requests. --rtt-ms adds a network round
+trip to every AWS call, for endpoints on the same host. Run it against real SSM and
+Secrets Manager, or against a local moto server:
+
+    AWS_ENDPOINT_URL=http://localhost:5000 python config_loading_benchmark.py --rtt-ms 20
+
+The parameters and secret are created under --prefix if they do not exist.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "layers", "config", "python"))
+
+import boto3
+
+import config_loader
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prefix", default="/config-loading-benchmark", help="Name prefix of the test parameters.")
+    parser.add_argument("--rounds", type=int, default=20, help="Cold starts to simulate per layout.")
+    parser.add_argument("--rtt-ms", type=float, default=0, help="Extra round trip added to every AWS call.")
+    parser.add_argument("--region", default=os.environ.get("REGION", "us-east-1"))
+    return parser.parse_args()
+
+def add_round_trip(client, rtt_ms: float):
+    if rtt_ms:
+        client.meta.events.register("before-send", lambda **kwargs: time.sleep(rtt_ms / 1000))
+    return client
+
+def ensure_configuration(args) -> tuple:
+    """
+    Create the three parameters and the database secret, returning their names.
+    """
+    ssm = boto3.client("ssm", region_name=args.region)
+    names = [f"{args.prefix}/{name}" for name in ("llm", "embeddings", "table")]
+    for name, value in zip(names, ["meta.llama3-70b-instruct-v1:0", "amazon.titan-embed-text-v2:0", "chat-history"]):
+        ssm.put_parameter(Name=name, Value=value, Type="String", Overwrite=True)
+    secrets = boto3.client("secretsmanager", region_name=args.region)
+    secret_name = f"{args.prefix.strip('/')}-db"
+    secret = json.dumps({"username": "postgres", "password": "postgres", "dbname": "postgres", "port": 5432})
+    try:
+        secrets.create_secret(Name=secret_name, SecretString=secret)
+    except secrets.exceptions.ResourceExistsException:
+        pass
+    return names, secret_name
+
+class Before:
+    """
+    The configuration loading main.py did before the shared loader.
+    """
+
+    def __init__(self, args, names, secret_name):
+        self.args, self.names, self.secret_name = args, names, secret_name
+
+    def init(self):
+        self.ssm = add_round_trip(boto3.client("ssm", region_name=self.args.region), self.args.rtt_ms)
+        self.secrets = add_round_trip(boto3.client("secretsmanager", region_name=self.args.region), self.args.rtt_ms)
+        self.parameters = {}
+        self.secret = None
+
+    def request(self):
+        for name in self.names:
+            if name not in self.parameters:
+                self.parameters[name] = self.ssm.get_parameter(Name=name, WithDecryption=True)["Parameter"]["Value"]
+        if self.secret is None:
+            self.secret = json.loads(self.secrets.get_secret_value(SecretId=self.secret_name)["SecretString"])
+
+class After:
+    """
+    config_loader, warmed during init the way load_configuration() does.
+    """
+
+    def __init__(self, args, names, secret_name):
+        self.args, self.names, self.secret_name = args, names, secret_name
+
+    def init(self):
+        config_loader.clients.clear()
+        config_loader.parameter_cache.clear()
+        config_loader.secret_cache.clear()
+        for service in ("ssm", "secretsmanager"):
+            add_round_trip(config_loader.get_client(service), self.args.rtt_ms)
+        self.request()
+
+    def request(self):
+        config_loader.get_parameters(self.names)
+        config_loader.get_secret(self.secret_name)
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("REGION", args.region)
+    names, secret_name = ensure_configuration(args)
+
+    print(f"{args.rounds} cold starts per layout, {args.rtt_ms:g}ms added per AWS call; median ms")
+    for layout in (Before(args, names, secret_name), After(args, names, secret_name)):
+        rounds = [(timed(layout.init), timed(layout.request), timed(layout.request)) for _ in range(args.rounds)]
+        init, first, second = (statistics.median(values) for values in zip(*rounds))
+        print(f"{type(layout).__name__.lower():<6}: init {init:6.1f}, first request {first:6.1f}, "
+              f"second request {second:6.2f}, cold start total {init + first:6.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Count the Postgres connections held while a class of students starts a simulation at once,
+with the connection layout from before the shared pool and with db_pool.
+
+Each student is served by its own simulated container (a Lambda container serves one
+request at a time, so N concurrent students means N warm containers) that makes the same
+database calls as a chat turn: the patient and session metadata queries, a vector search
+(a pg_sleep stands in for the similarity query), the model call (no database) and the
+session update. The layouts are:
+
+    before - a psycopg2 connection kept open for the metadata queries, plus a separate
+             SQLAlchemy engine for PGVector (the layout replaced by db_pool)
+    after  - one db_pool engine per container, used for both
+    server - the long-running server (src/server.py): students share processes that run
+             SERVER_MAX_CONCURRENT_TURNS turns each, with one db_pool engine per process
+
+A monitor samples pg_stat_activity throughout, and the peak and the count once every
+container is warm are reported. Run it against a Postgres whose max_connections leaves
+room for the "before" layout (two per student):
+
+    python connection_count_benchmark.py --host localhost --port 5432 --students 200
+
+Against RDS Proxy, the same numbers show up as the proxy's ClientConnections metric.
+"""
+import os
+import sys
+import time
+import math
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "layers", "config", "python"))
+
+import psycopg2
+from sqlalchemy import create_engine, text
+
+import db_pool
+
+METADATA_QUERY = "SELECT count(*) FROM pg_class WHERE relname = %s"
+VECTOR_QUERY = "SELECT pg_sleep(:seconds)"
+ACTIVITY_QUERY = """
+    SELECT count(*) FROM pg_stat_activity
+    WHERE backend_type = 'client backend' AND datname = %s AND pid <> pg_backend_pid()
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--dbname", default="postgres")
+    parser.add_argument("--students", type=int, nargs="+", default=[50, 200], help="Concurrent students to simulate.")
+    parser.add_argument("--layouts", nargs="+", default=["before", "after", "server"])
+    parser.add_argument("--turns-per-process", type=int, default=16, help="SERVER_MAX_CONCURRENT_TURNS for the server layout.")
+    parser.add_argument("--vector-seconds", type=float, default=0.05, help="Time a vector search holds its connection.")
+    parser.add_argument("--model-seconds", type=float, default=0.5, help="Time a model call takes.")
+    return parser.parse_args()
+
+def metadata_queries(connection, count: int) -> None:
+    cur = connection.cursor()
+    for _ in range(count):
+        cur.execute(METADATA_QUERY, ("model_usage",))
+        cur.fetchall()
+    connection.commit()
+    cur.close()
+
+def vector_search(engine, seconds: float) -> None:
+    with engine.connect() as connection:
+        connection.execute(text(VECTOR_QUERY), {"seconds": seconds})
+
+class BeforeContainer:
+    """
+    The layout before db_pool: a long-lived psycopg2 connection and a PGVector engine.
+    """
+
+    def __init__(self, args, connection_string: str):
+        self.args = args
+        self.connection_string = connection_string
+        self.connection = None
+        self.engine = None
+
+    def turn(self) -> None:
+        if self.connection is None:
+            self.connection = psycopg2.connect(
+                host=self.args.host, port=self.args.port, user=self.args.user,
+                password=self.args.password, dbname=self.args.dbname,
+            )
+            self.engine = create_engine(self.connection_string, pool_size=5, max_overflow=0, pool_pre_ping=True)
+        metadata_queries(self.connection, 2)
+        vector_search(self.engine, self.args.vector_seconds)
+        time.sleep(self.args.model_seconds)
+        metadata_queries(self.connection, 1)
+
+    def close(self) -> None:
+        self.connection.close()
+        self.engine.dispose()
+
+class PooledContainer:
+    """
+    The db_pool layout: one bounded engine for metadata queries and PGVector alike.
+    """
+
+    def __init__(self, args, connection_string: str):
+        self.args = args
+        self.engine = db_pool.create_pooled_engine(connection_string)
+
+    def turn(self) -> None:
+        connection = self.engine.raw_connection()
+        try:
+            metadata_queries(connection, 2)
+        finally:
+            connection.close()
+        vector_search(self.engine, self.args.vector_seconds)
+        time.sleep(self.args.model_seconds)
+        connection = self.engine.raw_connection()
+        try:
+            metadata_queries(connection, 1)
+        finally:
+            connection.close()
+
+    def close(self) -> None:
+        self.engine.dispose()
+
+class Monitor:
+    """
+    Samples the number of client connections to the benchmark database in the background.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.connection = psycopg2.connect(
+            host=args.host, port=args.port, user=args.user, password=args.password, dbname=args.dbname,
+        )
+        self.connection.autocommit = True
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def count(self) -> int:
+        cur = self.connection.cursor()
+        cur.execute(ACTIVITY_QUERY, (self.args.dbname,))
+        count = cur.fetchone()[0]
+        cur.close()
+        return count
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.count())
+            time.sleep(0.02)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+def run_layout(args, connection_string: str, layout: str, students: int) -> dict:
+    if layout == "server":
+        processes = math.ceil(students / args.turns_per_process)
+        containers = [PooledContainer(args, connection_string) for _ in range(processes)]
+        slots = [threading.Semaphore(args.turns_per_process) for _ in range(processes)]
+    else:
+        container_type = BeforeContainer if layout == "before" else PooledContainer
+        containers = [container_type(args, connection_string) for _ in range(students)]
+        slots = [threading.Semaphore(1) for _ in range(students)]
+
+    def serve(number: int) -> None:
+        index = number % len(containers)
+        with slots[index]:
+            containers[index].turn()
+
+    monitor = Monitor(args)
+    start = time.perf_counter()
+    with monitor:
+        threads = [threading.Thread(target=serve, args=(number,)) for number in range(students)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+    warm = monitor.count()
+    for container in containers:
+        container.close()
+    monitor.connection.close()
+    return {"containers": len(containers), "peak": monitor.peak, "warm": warm, "seconds": elapsed}
+
+def main():
+    args = parse_args()
+    connection_string = db_pool.build_connection_string({
+        "username": args.user, "password": args.password, "port": args.port, "dbname": args.dbname,
+    }, args.host)
+    print(f"DB_POOL_SIZE={db_pool.DB_POOL_SIZE}, vector search {args.vector_seconds}s, model call {args.model_seconds}s")
+    for students in args.students:
+        for layout in args.layouts:
+            result = run_layout(args, connection_string, layout, students)
+            print(f"{students:>4} students, {layout:<6}: {result['containers']:>3} containers/processes, "
+                  f"peak {result['peak']:>3} connections, {result['warm']:>3} held once warm, "
+                  f"{result['seconds']:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Compare the single-item and per-message chat history layouts (HISTORY_BACKEND=item and
+HISTORY_BACKEND=message) by capacity consumed and latency as a session grows.
+
+For each session length, a session is filled with that many scripted messages in each
+layout, then the report gives, per operation:
+
+    append - one student/patient exchange, as written after every turn
+    window - the last CHAT_HISTORY_LAST_N_TURNS exchanges, as read by the last_n strategy
+    full   - the whole history, as read by the full strategy
+
+Capacity units are computed from the stored item sizes with DynamoDB's on-demand rules
+(writes in 1 KB units of the larger of the old and new item, eventually consistent
+reads in 4 KB units at half a unit each, a query rounded over the items it returns), so
+they hold for any endpoint. Latency is the median of --repeats runs against the endpoint
+used, so run it against a real table for production figures:
+
+    python history_layout_benchmark.py --table chat-history --messages 10 100 500
+    AWS_ENDPOINT_URL_DYNAMODB=http://localhost:8000 python history_layout_benchmark.py --table chat-history
+
+The sessions are deleted afterwards. The message layout's companion table is created if
+it does not exist.
+"""
+import os
+import sys
+import math
+import time
+import uuid
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from langchain_core.messages import HumanMessage, AIMessage
+
+from helpers import chat, history
+
+STUDENT_LINE = "Can you tell me more about when the headaches started and what makes them worse?"
+PATIENT_LINE = ("They usually come on after lunch and get worse through the afternoon. Lying down in a dark "
+                "room helps a little, but I've been worried because my blood pressure readings are higher too.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table", required=True, help="DynamoDB chat history table.")
+    parser.add_argument("--messages", type=int, nargs="+", default=[10, 100, 500], help="Session lengths to measure.")
+    parser.add_argument("--repeats", type=int, default=10, help="Runs of each operation per length.")
+    return parser.parse_args()
+
+def scripted_messages(count: int) -> list:
+    return [
+        HumanMessage(content=f"{STUDENT_LINE} ({number})") if number % 2 == 0
+        else AIMessage(content=f"{PATIENT_LINE} ({number})")
+        for number in range(count)
+    ]
+
+def get_value_size(value: dict) -> int:
+    """
+    Return the stored size in bytes of a DynamoDB attribute value.
+    """
+    kind, data = next(iter(value.items()))
+    if kind == "S":
+        return len(data.encode("utf-8"))
+    if kind == "N":
+        return math.ceil(len(data.lstrip("-").replace(".", "").strip("0") or "0") / 2) + 1
+    if kind in ("BOOL", "NULL"):
+        return 1
+    if kind == "L":
+        return 3 + sum(get_value_size(element) + 1 for element in data)
+    if kind == "M":
+        return 3 + sum(len(name.encode("utf-8")) + get_value_size(element) + 1 for name, element in data.items())
+    raise ValueError(f"Unsupported attribute type {kind}")
+
+def get_item_size(item: dict) -> int:
+    return sum(len(name.encode("utf-8")) + get_value_size(value) for name, value in item.items())
+
+def write_units(*sizes: int) -> int:
+    return math.ceil(max(sizes) / 1024)
+
+def read_units(*sizes: int) -> float:
+    return 0.5 * math.ceil(sum(sizes) / 4096)
+
+class ItemLayout:
+    """
+    The single-item layout: the whole history is one item's History list.
+    """
+    name = "item"
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+
+    def fill(self, session_id: str, messages: list) -> None:
+        item = {
+            "SessionId": {"S": session_id},
+            "History": history.serializer.serialize([history.message_to_dict(message) for message in messages]),
+            "MessageCount": {"N": str(len(messages))},
+        }
+        history.dynamodb_client.put_item(TableName=self.table_name, Item=item)
+
+    def get_sizes(self, session_id: str) -> list:
+        item = history.dynamodb_client.get_item(TableName=self.table_name, Key={"SessionId": {"S": session_id}})["Item"]
+        return [get_item_size(item)]
+
+    def history(self, session_id: str):
+        return history.ListItemChatMessageHistory(self.table_name, session_id)
+
+    def read_window(self, session_id: str, count: int) -> list:
+        # The list is one attribute, so a window still reads the whole item
+        return self.history(session_id).messages[-count:]
+
+    def capacity(self, before: list, after: list, window: int) -> dict:
+        return {
+            "append": write_units(before[0], after[0]),
+            "window": read_units(before[0]),
+            "full": read_units(before[0]),
+        }
+
+class MessageLayout:
+    """
+    The per-message layout: a header item plus one item per message.
+    """
+    name = "message"
+
+    def __init__(self, table_name: str):
+        self.table_name = history.get_message_table_name(table_name)
+        self.base_table_name = table_name
+
+    def fill(self, session_id: str, messages: list) -> None:
+        message_history = self.history(session_id)
+        history.dynamodb_client.put_item(TableName=self.table_name, Item={
+            "SessionId": {"S": session_id}, "Seq": {"N": "0"}, "LastSeq": {"N": str(len(messages))},
+        })
+        message_history.batch_write([
+            {"PutRequest": {"Item": {
+                "SessionId": {"S": session_id},
+                "Seq": {"N": str(number + 1)},
+                "Message": {"S": history.json.dumps(history.message_to_dict(message))},
+            }}}
+            for number, message in enumerate(messages)
+        ])
+
+    def get_sizes(self, session_id: str) -> list:
+        # Header first, then the messages in sequence order
+        response = history.dynamodb_client.query(
+            TableName=self.table_name,
+            KeyConditionExpression="SessionId = :session",
+            ExpressionAttributeValues={":session": {"S": session_id}},
+        )
+        items = response["Items"]
+        while "LastEvaluatedKey" in response:
+            response = history.dynamodb_client.query(
+                TableName=self.table_name,
+                KeyConditionExpression="SessionId = :session",
+                ExpressionAttributeValues={":session": {"S": session_id}},
+                ExclusiveStartKey=response["LastEvaluatedKey"],
+            )
+            items.extend(response["Items"])
+        return [get_item_size(item) for item in items]
+
+    def history(self, session_id: str):
+        return history.MessageTableChatMessageHistory(self.base_table_name, session_id)
+
+    def read_window(self, session_id: str, count: int) -> list:
+        return self.history(session_id).last_messages(count)
+
+    def capacity(self, before: list, after: list, window: int) -> dict:
+        header, messages = after[0], after[1:]
+        return {
+            # The header's sequence counter, then one put per new message
+            "append": write_units(header) + sum(write_units(size) for size in messages[len(before) - 1:]),
+            "window": read_units(*before[1:][-window:]),
+            "full": read_units(*before[1:]),
+        }
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000
+
+def measure(layout, count: int, repeats: int) -> dict:
+    window = 2 * history.CHAT_HISTORY_LAST_N_TURNS
+    exchange = [HumanMessage(content=STUDENT_LINE), AIMessage(content=PATIENT_LINE)]
+    latencies = {"append": [], "window": [], "full": []}
+    capacity = None
+    for _ in range(repeats):
+        session_id = f"benchmark-{uuid.uuid4()}"
+        try:
+            layout.fill(session_id, scripted_messages(count))
+            latencies["window"].append(timed(layout.read_window, session_id, window))
+            latencies["full"].append(timed(lambda: layout.history(session_id).messages))
+            before = layout.get_sizes(session_id)
+            latencies["append"].append(timed(layout.history(session_id).add_messages, exchange))
+            if capacity is None:
+                capacity = layout.capacity(before, layout.get_sizes(session_id), window)
+                capacity["size_kb"] = sum(before) / 1024
+        finally:
+            layout.history(session_id).clear()
+    return {"capacity": capacity, "latency": {name: statistics.median(values) for name, values in latencies.items()}}
+
+def main():
+    args = parse_args()
+    # Make sure both layouts' tables exist
+    chat.HISTORY_BACKEND = "message"
+    chat.create_dynamodb_history_table(args.table)
+
+    print(f"Window: last {history.CHAT_HISTORY_LAST_N_TURNS} exchanges; capacity units per operation, median latency")
+    for count in args.messages:
+        for layout in (ItemLayout(args.table), MessageLayout(args.table)):
+            result = measure(layout, count, args.repeats)
+            capacity, latency = result["capacity"], result["latency"]
+            print(f"{count:>4} messages, {layout.name:<7} ({capacity['size_kb']:6.1f} KB): "
+                  f"append {capacity['append']:>3} WCU {latency['append']:6.1f}ms | "
+                  f"window {capacity['window']:>5} RCU {latency['window']:6.1f}ms | "
+                  f"full {capacity['full']:>5} RCU {latency['full']:6.1f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare the prompt size and turn latency of the CHAT_HISTORY_STRATEGY options as a
+conversation grows.
+
+For every conversation length, a session is filled with that many scripted exchanges
+(and, for the summary strategy, its rolling summary), then one more student turn is
+served through the same get_response the handler uses. The report gives the patient
+prompt's input tokens, the time spent reading and writing history, and the turn latency.
+Retrieval is replaced by a fixed patient document so only the history differs.
+
+Chat history is written to a real DynamoDB table (or DynamoDB Local through
+AWS_ENDPOINT_URL_DYNAMODB), and the sessions are deleted afterwards:
+
+    python history_window_benchmark.py --table chat-history --turns 5 20 50
+    BEDROCK_STUB=true python history_window_benchmark.py --table chat-history
+
+Without BEDROCK_STUB this calls (and pays for) Bedrock.
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
+from langchain_core.messages import HumanMessage, AIMessage
+
+from helpers import chat, history
+from helpers.timing import StageTimer
+from helpers.policy import request_deadline
+
+PATIENT_DOCUMENT = """
+Maria is 58 and has had throbbing headaches most afternoons for three weeks. She started
+ibuprofen 400 mg three times a day for knee pain a month ago and takes lisinopril for
+hypertension. Her home blood pressure readings have risen from 128/80 to 152/94.
+"""
+
+STUDENT_LINE = "Can you tell me more about when the headaches started and what makes them worse?"
+PATIENT_LINE = ("They usually come on after lunch and get worse through the afternoon. Lying down in a dark "
+                "room helps a little, but I've been worried because my blood pressure readings are higher too.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table", required=True, help="DynamoDB chat history table.")
+    parser.add_argument("--model", default="meta.llama3-70b-instruct-v1:0", help="Model that plays the patient.")
+    parser.add_argument("--turns", type=int, nargs="+", default=[5, 20, 50], help="Conversation lengths to measure.")
+    parser.add_argument("--strategies", nargs="+", default=["full", "last_n", "token_budget", "summary"])
+    return parser.parse_args()
+
+def fill_session(args, llm, session_id: str, turns: int, strategy: str) -> None:
+    """
+    Write turns scripted exchanges to the session, and its summary for the summary strategy.
+    """
+    raw_history = history.get_raw_history(args.table, session_id)
+    for number in range(turns):
+        raw_history.add_messages([
+            HumanMessage(content=f"{STUDENT_LINE} ({number})"), AIMessage(content=f"{PATIENT_LINE} ({number})")
+        ])
+    if strategy == "summary":
+        with request_deadline():
+            history.WindowedChatMessageHistory(args.table, session_id, llm=llm, strategy="summary").update_summary()
+
+def measure_turn(args, llm, retriever, turns: int, strategy: str) -> dict:
+    session_id = str(uuid.uuid4())
+    history.CHAT_HISTORY_STRATEGY = strategy
+    try:
+        fill_session(args, llm, session_id, turns, strategy)
+        timer = StageTimer()
+        start = time.perf_counter()
+        with timer.active(), request_deadline():
+            chat.get_response(
+                query=chat.get_student_query("Have you started any new medications recently?"),
+                patient_name="Maria", llm=llm, history_aware_retriever=retriever, table_name=args.table,
+                session_id=session_id, system_prompt="Answer as a worried but cooperative patient.",
+                patient_age="58", patient_prompt="Anxious about her health.", llm_completion=False,
+            )
+        seconds = time.perf_counter() - start
+        generation = [call for call in timer.model_calls_snapshot() if call["call"] == "generation"]
+        return {
+            "input_tokens": sum(call["input_tokens"] for call in generation),
+            # The full strategy uses the raw history, which is not timed as its own span
+            "history_ms": timer.span_totals().get("history"),
+            "seconds": seconds,
+        }
+    finally:
+        history.get_chat_history(args.table, session_id).clear()
+
+def main():
+    args = parse_args()
+    chat.create_dynamodb_history_table(args.table)
+    llm = chat.get_bedrock_llm(args.model)
+    retriever = RunnableLambda(lambda _: [Document(page_content=PATIENT_DOCUMENT)])
+    # The empathy evaluation is the same for every strategy, so it is left out
+    chat.CONCURRENT_EMPATHY = False
+    chat.evaluate_empathy = lambda *args: None
+
+    print(f"{'strategy':13s} {'turns':>5s} {'prompt tokens':>14s} {'history ms':>11s} {'turn s':>7s}")
+    for strategy in args.strategies:
+        for turns in args.turns:
+            result = measure_turn(args, llm, retriever, turns, strategy)
+            history_ms = "-" if result["history_ms"] is None else f"{result['history_ms']:.1f}"
+            print(f"{strategy:13s} {turns:5d} {result['input_tokens']:14d} {history_ms:>11s} {result['seconds']:7.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Load test the text generation server (src/server.py) and report throughput and latency.
+
+Run the server locally with stubbed Bedrock, a local Postgres with the pgvector extension
+and DynamoDB Local, then point this script at it:
+
+    export BEDROCK_STUB=true BEDROCK_STUB_LATENCY_SECONDS=0.5
+    export AWS_ENDPOINT_URL_DYNAMODB=http://localhost:8000
+    export CONFIG_OVERRIDES_FILE=local-config.json
+    export SM_DB_CREDENTIALS=db-secret RDS_PROXY_ENDPOINT=localhost REGION=us-east-1
+    export BEDROCK_LLM_PARAM=llm EMBEDDING_MODEL_PARAM=embeddings TABLE_NAME_PARAM=table
+    (cd src && uvicorn server:app --port 8080)
+
+    python load_test.py --url http://localhost:8080 --concurrency 32 --duration 60 \\
+        --simulation-group-id <id> --patient-id <id>
+
+local-config.json supplies the values normally read from SSM and Secrets Manager:
+
+    {"parameters": {"llm": "stub", "embeddings": "stub", "table": "chat-history"},
+     "secrets": {"db-secret": {"username": "postgres", "password": "postgres",
+                               "port": 5432, "dbname": "postgres"}}}
+
+The database needs the schema and a simulation group and patient to chat with. Every
+worker uses its own session_id, so the history of each simulated student grows turn by
+turn just as it would in production.
+"""
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import statistics
+import http.client
+from collections import Counter
+from urllib.parse import urlsplit, urlencode
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def run_worker(args, deadline, results, lock):
+    """
+    Send turns for one simulated student until the deadline or request budget is reached.
+    """
+    url = urlsplit(args.url)
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=args.timeout)
+    session_id = str(uuid.uuid4())
+    turn = 0
+    while time.monotonic() < deadline:
+        with lock:
+            if args.requests is not None and len(results) >= args.requests:
+                return
+        query = urlencode({
+            "simulation_group_id": args.simulation_group_id,
+            "patient_id": args.patient_id,
+            "session_id": session_id,
+        })
+        # The first turn of a session has no message, like the opening of a real conversation
+        body = json.dumps({"message_content": f"Load test question {turn}" if turn else ""})
+        start = time.perf_counter()
+        try:
+            connection.request("POST", f"/chat?{query}", body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except Exception as e:
+            status = type(e).__name__
+            connection.close()
+            connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=args.timeout)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with lock:
+            results.append((status, elapsed_ms))
+        turn += 1
+    connection.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080", help="Base URL of the server.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of simulated students.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run for.")
+    parser.add_argument("--requests", type=int, default=None, help="Stop after this many requests.")
+    parser.add_argument("--timeout", type=float, default=60, help="Per-request timeout in seconds.")
+    parser.add_argument("--simulation-group-id", required=True)
+    parser.add_argument("--patient-id", required=True)
+    args = parser.parse_args()
+
+    results = []
+    lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + args.duration
+    workers = [
+        threading.Thread(target=run_worker, args=(args, deadline, results, lock), daemon=True)
+        for _ in range(args.concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+
+    if not results:
+        print("No requests completed")
+        sys.exit(1)
+
+    statuses = Counter(status for status, _ in results)
+    latencies = [elapsed_ms for status, elapsed_ms in results if status == 200]
+    print(f"{len(results)} requests in {elapsed:.1f}s with concurrency {args.concurrency}: "
+          f"{len(results) / elapsed:.1f} req/s, {len(latencies) / elapsed:.1f} successful req/s")
+    print(f"status codes: {dict(statuses)}")
+    if latencies:
+        print(f"latency of successful requests: p50 {percentile(latencies, 0.50):.0f}ms, "
+              f"p95 {percentile(latencies, 0.95):.0f}ms, p99 {percentile(latencies, 0.99):.0f}ms, "
+              f"mean {statistics.mean(latencies):.0f}ms, max {max(latencies):.0f}ms")
+
+    if statuses.get(200, 0) == 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Copy chat histories from the single-item layout (one item per session with a History
+list) into the per-message layout used when HISTORY_BACKEND=message.
+
+Run this once before switching the text generation and deleteLastMessage functions to
+HISTORY_BACKEND=message:
+
+    python migrate_history.py --table DynamoDB-Conversation-Table --region us-east-1
+
+Sessions that already exist in the "<table>-Messages" table are skipped, so the script
+can safely be re-run. Source items are left untouched.
+"""
+import json
+import argparse
+import logging
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def to_message_dict(attribute: dict) -> dict:
+    """
+    Convert a History list element (DynamoDB attribute format) to a plain message dict.
+    """
+    return TypeDeserializer().deserialize(attribute)
+
+def migrate_session(client, message_table: str, session_id: str, history: list, dry_run: bool) -> bool:
+    """
+    Write one session's messages as individual items.
+
+    Returns:
+    bool: True if the session was migrated, False if it already existed.
+    """
+    if dry_run:
+        logger.info(f"[dry run] {session_id}: {len(history)} messages")
+        return True
+
+    try:
+        # Claim the session by creating its header item first
+        client.put_item(
+            TableName=message_table,
+            Item={"SessionId": {"S": session_id}, "Seq": {"N": "0"}, "LastSeq": {"N": str(len(history))}},
+            ConditionExpression="attribute_not_exists(SessionId)"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logger.info(f"{session_id}: already migrated, skipping")
+            return False
+        raise
+
+    requests = [
+        {"PutRequest": {"Item": {
+            "SessionId": {"S": session_id},
+            "Seq": {"N": str(seq)},
+            "Message": {"S": json.dumps(to_message_dict(message), default=str)},
+        }}}
+        for seq, message in enumerate(history, start=1)
+    ]
+    for start in range(0, len(requests), 25):
+        pending = {message_table: requests[start:start + 25]}
+        while pending:
+            pending = client.batch_write_item(RequestItems=pending).get("UnprocessedItems") or None
+
+    logger.info(f"{session_id}: migrated {len(history)} messages")
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table", required=True, help="The single-item history table name.")
+    parser.add_argument("--region", default=None, help="AWS region of the table.")
+    parser.add_argument("--dry-run", action="store_true", help="List sessions without writing anything.")
+    args = parser.parse_args()
+
+    client = boto3.client("dynamodb", region_name=args.region)
+    message_table = f"{args.table}-Messages"
+    migrated = skipped = 0
+
+    paginator = client.get_paginator("scan")
+    for page in paginator.paginate(TableName=args.table):
+        for item in page.get("Items", []):
+            session_id = item["SessionId"]["S"]
+            # Metadata, summary and opening-turn items are not sessions
+            if "#" in session_id or "History" not in item:
+                continue
+            if migrate_session(client, message_table, session_id, item["History"]["L"], args.dry_run):
+                migrated += 1
+            else:
+                skipped += 1
+
+    logger.info(f"Done: {migrated} sessions migrated, {skipped} skipped")
+
+if __name__ == "__main__":
+    main()
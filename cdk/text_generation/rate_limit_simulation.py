@@ -0,0 +1,136 @@
+"""
+Simulate a class of students starting the same simulation at once, with and without the
+per-simulation-group rate limiter, and report the latency of their first Bedrock call.
+Students whose call fails count as unanswered in the percentiles.
+
+Bedrock is replaced by a simulated model with an account quota: calls beyond
+--quota per second fail with ThrottlingException, exactly as the real service does.
+Every student makes its call through the same call policy as the chat engine
+(helpers/policy.py: deadline, jittered backoff, circuit breaker). With the limiter, calls
+first take a token from the group's bucket (the in-process stand-in for the DynamoDB
+backend), set slightly below the quota:
+
+    python rate_limit_simulation.py --students 50 150 500 --quota 50 --latency 0.5
+
+Nothing here calls AWS.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+import statistics
+from collections import Counter
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, nargs="+", default=[50, 150, 500], help="Class sizes to simulate.")
+    parser.add_argument("--quota", type=float, default=50, help="Bedrock calls per second before throttling.")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds per successful model call.")
+    parser.add_argument("--limit", type=float, default=None, help="Limiter rate per second. Defaults to 90%% of the quota.")
+    parser.add_argument("--deadline", type=float, default=60, help="Per-student request deadline in seconds.")
+    return parser.parse_args()
+
+args = parse_args()
+
+# Every student needs its own policy worker, and the budget comes from --deadline
+os.environ.setdefault("BEDROCK_POLICY_WORKERS", str(2 * max(args.students) + 16))
+os.environ["DEFAULT_DEADLINE_SECONDS"] = str(args.deadline)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from helpers import policy, ratelimit
+
+# The per-retry warnings would drown out the report
+logging.basicConfig(level=logging.ERROR)
+
+MODEL_ID = "simulated-model"
+
+class SimulatedBedrock:
+    """
+    A model that accepts at most quota calls per second (a token bucket of one second).
+    """
+
+    def __init__(self, quota: float, latency: float):
+        self.quota = quota
+        self.latency = latency
+        self.tokens = quota
+        self.updated = time.monotonic()
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def invoke(self) -> str:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.quota, self.tokens + (now - self.updated) * self.quota)
+            self.updated = now
+            admitted = self.tokens >= 1
+            if admitted:
+                self.tokens -= 1
+            else:
+                self.throttled += 1
+        if not admitted:
+            time.sleep(0.02)
+            raise ValueError("An error occurred (ThrottlingException) when calling the InvokeModel operation")
+        time.sleep(self.latency)
+        return "Hello, I'm the patient."
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def run(students: int, limited: bool) -> dict:
+    policy.breakers.clear()
+    policy.latencies.clear()
+    ratelimit.limiter = ratelimit.LocalRateLimiter(rate=args.limit or 0.9 * args.quota) if limited else None
+    bedrock = SimulatedBedrock(args.quota, args.latency)
+
+    results = []
+    lock = threading.Lock()
+    start_line = threading.Barrier(students)
+
+    def student():
+        start_line.wait()
+        start = time.perf_counter()
+        with policy.request_deadline(), ratelimit.rate_limit_scope("class-1"):
+            try:
+                policy.call_with_policy("generation", bedrock.invoke, model_id=MODEL_ID)
+                outcome = "ok"
+            except Exception as e:
+                outcome = type(e).__name__
+        with lock:
+            results.append((outcome, time.perf_counter() - start))
+
+    threads = [threading.Thread(target=student) for _ in range(students)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Students whose call failed were never answered, so they count as infinitely slow
+    latencies = [elapsed if outcome == "ok" else float("inf") for outcome, elapsed in results]
+    served = [elapsed for elapsed in latencies if elapsed != float("inf")]
+    return {
+        "outcomes": dict(Counter(outcome for outcome, _ in results)),
+        "throttled": bedrock.throttled,
+        "p50": percentile(latencies, 0.50),
+        "p99": percentile(latencies, 0.99),
+        "mean": statistics.mean(served) if served else None,
+    }
+
+def format_seconds(value) -> str:
+    return "unanswered" if value == float("inf") else f"{value:.2f}s"
+
+def main():
+    print(f"Bedrock quota {args.quota}/s, {args.latency}s per call, {args.deadline}s deadline")
+    for students in args.students:
+        for limited in (False, True):
+            result = run(students, limited)
+            label = "with limiter   " if limited else "without limiter"
+            latency = (f"p50 {format_seconds(result['p50'])}, p99 {format_seconds(result['p99'])}, "
+                       f"mean of answered {format_seconds(result['mean']) if result['mean'] is not None else '-'}")
+            print(f"{students:4d} students {label}: {latency}; "
+                  f"throttled calls {result['throttled']}; outcomes {result['outcomes']}")
+
+if __name__ == "__main__":
+    main()
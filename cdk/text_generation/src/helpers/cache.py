@@ -0,0 +1,98 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+class LRUCache:
+    """
+    A small thread-safe LRU cache that lives for the lifetime of a warm container.
+
+    Entries are evicted when the cache grows past max_size, entries that have not
+    been used for idle_seconds are dropped on the next access, and entries older than
+    ttl_seconds are treated as missing. Hit and miss counters are kept so callers can
+    report how often a turn avoided rebuilding a resource.
+    """
+
+    def __init__(self, max_size: int, idle_seconds: Optional[float] = None, ttl_seconds: Optional[float] = None):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Return the cached value for key, or None if it is missing, idle or expired.
+        """
+        with self._lock:
+            self._evict_idle()
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_seconds is not None and time.monotonic() - entry[2] > self.ttl_seconds:
+                self._entries.pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._entries[key] = (entry[0], time.monotonic(), entry[2])
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Store value under key, evicting the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._entries[key] = (value, now, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """
+        Remove key from the cache and return its value, if present.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry else None
+
+    def pop_matching(self, predicate) -> int:
+        """
+        Remove every entry whose key satisfies predicate and return how many were removed.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._entries.pop(key)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Return the current size and hit/miss counters.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def _evict_idle(self) -> None:
+        if self.idle_seconds is None:
+            return
+        cutoff = time.monotonic() - self.idle_seconds
+        # Entries are ordered by last use, so stop at the first one that is still fresh
+        while self._entries:
+            key, (_, last_used, _) = next(iter(self._entries.items()))
+            if last_used >= cutoff:
+                break
+            self._entries.pop(key)
@@ -1,22 +1,64 @@
-import boto3, re, json, logging
+import os, re, json, time, hashlib, logging, itertools
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 from langchain_aws import ChatBedrock
-from langchain_aws import BedrockLLM
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import DynamoDBChatMessageHistory
-from langchain_core.pydantic_v1 import BaseModel, Field
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import HumanMessage, AIMessage
 
-class LLM_evaluation(BaseModel):
-    response: str = Field(description="Assessment of the student's answer with a follow-up question.")
-    verdict: str = Field(description="'True' if the student has properly diagnosed the patient, 'False' otherwise.")
+from helpers.cache import LRUCache
+from helpers.timing import span, run_in_context
+from helpers.usage import record_model_call
+from helpers.policy import call_with_policy, ModelCallError, CircuitOpenError, DeadlineExceeded
+from helpers.evaluation import COMBINED_OUTPUT_INSTRUCTIONS, parse_patient_turn, get_empathy_evaluation
+from helpers.clients import get_client, get_chat_model, get_completion_model
+from helpers.history import HISTORY_BACKEND, get_chat_history, get_raw_history, get_meta_key, get_message_table_name
 
+# Concurrency settings for running the empathy evaluation alongside the RAG chain
+CONCURRENT_EMPATHY = os.environ.get("CONCURRENT_EMPATHY", "true").lower() == "true"
+EMPATHY_TIMEOUT_SECONDS = float(os.environ.get("EMPATHY_TIMEOUT_SECONDS", "20"))
+RESPONSE_TIMEOUT_SECONDS = float(os.environ.get("RESPONSE_TIMEOUT_SECONDS", "240"))
+
+# How the patient reply and the empathy evaluation of a student turn are produced:
+#   separate - the RAG chain and a Nova Pro evaluation call (the original behaviour)
+#   combined - one call to the patient model returning both as JSON (see helpers/evaluation.py),
+#              falling back to separate calls when the output does not validate
+STRUCTURED_OUTPUT_MODE = os.environ.get("STRUCTURED_OUTPUT_MODE", "separate").lower()
+
+# Shared across warm invocations so threads are not recreated on every turn
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("TEXT_GEN_WORKERS", "4")), thread_name_prefix="text-gen"
+)
+
+# Compiled chains reused across warm invocations
+chain_cache = LRUCache(
+    max_size=int(os.environ.get("CHAIN_CACHE_SIZE", "64")),
+    idle_seconds=float(os.environ.get("CHAIN_CACHE_IDLE_SECONDS", "3600")),
+)
+
+# Greetings for the fixed opening turn, cached per patient fingerprint. The
+# "<table>-OpeningTurns" DynamoDB table holds the shared copy so every container can serve
+# it; this cache avoids even that read.
+OPENING_TURN_CACHE = os.environ.get("OPENING_TURN_CACHE", "true").lower() == "true"
+opening_turn_cache = LRUCache(max_size=int(os.environ.get("OPENING_TURN_CACHE_SIZE", "256")))
+dynamodb_client = get_client("dynamodb")
+
+# History tables already known to exist in this container
+verified_tables = set()
+
+# The patient announces a correct diagnosis with this marker, which is never shown to the student
+DIAGNOSIS_MARKER = "PROPER DIAGNOSIS ACHIEVED"
+COMPLETION_SENTENCE = " Congratulations! You have provided the proper diagnosis for me, the patient I am pretending to be! Please try other mock patients to continue your diagnosis skills! :)"
+# Sentence boundaries: whitespace after ., ? or !, except after abbreviations such as "Dr." or "U.S."
+SENTENCE_ENDINGS = r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s'
 
 def create_dynamodb_history_table(table_name: str) -> bool:
     """
@@ -29,40 +71,65 @@ def create_dynamodb_history_table(table_name: str) -> bool:
     None
     
     If the table already exists, this function does nothing. Otherwise, it creates a 
-    new table with a key schema based on 'SessionId'.
+    new table with a key schema based on 'SessionId'. Each table is only checked once
+    per container, so warm invocations make no DynamoDB calls here.
     """
-    # Get the service resource and client.
-    dynamodb_resource = boto3.resource("dynamodb")
-    dynamodb_client = boto3.client("dynamodb")
-    
-    # Retrieve the list of tables that currently exist.
-    existing_tables = []
-    exclusive_start_table_name = None
-    
-    while True:
-        if exclusive_start_table_name:
-            response = dynamodb_client.list_tables(ExclusiveStartTableName=exclusive_start_table_name)
-        else:
-            response = dynamodb_client.list_tables()
-        
-        existing_tables.extend(response.get('TableNames', []))
-        
-        if 'LastEvaluatedTableName' in response:
-            exclusive_start_table_name = response['LastEvaluatedTableName']
-        else:
-            break
-    
-    if table_name not in existing_tables:  # Create a new table if it doesn't exist.
-        # Create the DynamoDB table.
-        table = dynamodb_resource.create_table(
-            TableName=table_name,
-            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
-            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
-            BillingMode="PAY_PER_REQUEST",
+    ensure_table(
+        table_name,
+        key_schema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+        attribute_definitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+    )
+
+    # The per-message layout keeps messages in a companion table keyed by (SessionId, Seq).
+    if HISTORY_BACKEND == "message":
+        ensure_table(
+            get_message_table_name(table_name),
+            key_schema=[
+                {"AttributeName": "SessionId", "KeyType": "HASH"},
+                {"AttributeName": "Seq", "KeyType": "RANGE"},
+            ],
+            attribute_definitions=[
+                {"AttributeName": "SessionId", "AttributeType": "S"},
+                {"AttributeName": "Seq", "AttributeType": "N"},
+            ],
         )
-        
+
+def ensure_table(table_name: str, key_schema: list, attribute_definitions: list) -> None:
+    """
+    Make sure a DynamoDB table exists, creating it on first use.
+
+    A single describe_table call answers whether the table exists; the result is
+    remembered in verified_tables for the lifetime of the container.
+
+    Args:
+    table_name (str): The name of the table.
+    key_schema (list): The KeySchema to create the table with.
+    attribute_definitions (list): The AttributeDefinitions for the key attributes.
+    """
+    if table_name in verified_tables:
+        return
+
+    try:
+        status = dynamodb_client.describe_table(TableName=table_name)["Table"]["TableStatus"]
+    except dynamodb_client.exceptions.ResourceNotFoundException:
+        try:
+            dynamodb_client.create_table(
+                TableName=table_name,
+                KeySchema=key_schema,
+                AttributeDefinitions=attribute_definitions,
+                BillingMode="PAY_PER_REQUEST",
+            )
+            logger.info(f"Created DynamoDB table {table_name}")
+        except dynamodb_client.exceptions.ResourceInUseException:
+            # Another container created it first
+            pass
+        status = "CREATING"
+
+    if status == "CREATING":
         # Wait until the table exists.
-        table.meta.client.get_waiter("table_exists").wait(TableName=table_name)
+        dynamodb_client.get_waiter("table_exists").wait(TableName=table_name)
+
+    verified_tables.add(table_name)
 
 def get_bedrock_llm(
     bedrock_llm_id: str,
@@ -79,10 +146,7 @@ def get_bedrock_llm(
     Returns:
     ChatBedrock: An instance of the Bedrock LLM corresponding to the provided model ID.
     """
-    return ChatBedrock(
-        model_id=bedrock_llm_id,
-        model_kwargs=dict(temperature=temperature),
-    )
+    return get_chat_model(bedrock_llm_id, temperature)
 
 def get_student_query(raw_query: str) -> str:
     """
@@ -118,114 +182,107 @@ def get_initial_student_query(patient_name: str) -> str:
     """
     return student_query
 
-def get_response(
-    query: str,
+def get_chain_fingerprint(
+    llm: ChatBedrock,
+    table_name: str,
+    system_prompt: str,
     patient_name: str,
+    patient_age: str,
+    patient_prompt: str,
+    llm_completion: bool
+) -> str:
+    """
+    Compute a fingerprint of everything that shapes the compiled RAG chain.
+
+    The fingerprint only changes when an instructor edits the patient or simulation
+    group, or when the model changes.
+
+    Returns:
+    str: A SHA-256 hex digest of the chain inputs.
+    """
+    inputs = [
+        getattr(llm, "model_id", None), table_name, system_prompt,
+        patient_name, str(patient_age), patient_prompt, bool(llm_completion)
+    ]
+    return hashlib.sha256(json.dumps(inputs).encode("utf-8")).hexdigest()
+
+def build_conversational_rag_chain(
     llm: ChatBedrock,
     history_aware_retriever,
     table_name: str,
-    session_id: str,
     system_prompt: str,
+    patient_name: str,
     patient_age: str,
     patient_prompt: str,
-    llm_completion: bool
-) -> dict:
+    llm_completion: bool,
+    structured_output: bool = False
+) -> RunnableWithMessageHistory:
     """
-    Generates a response to a query using the LLM and a history-aware retriever for context.
+    Return the conversational RAG chain for a patient, compiling it only when its inputs change.
+
+    Compiled chains are cached across warm invocations under the fingerprint of their
+    inputs and the retriever they were built with. Editing the patient changes the
+    fingerprint, so the next turn compiles a fresh chain and the stale one ages out.
+
+    Returns:
+    RunnableWithMessageHistory: The RAG chain wrapped with DynamoDB-backed chat history.
+    """
+    fingerprint = get_chain_fingerprint(
+        llm, table_name, system_prompt, patient_name, patient_age, patient_prompt, llm_completion
+    )
+    key = (fingerprint, id(history_aware_retriever), structured_output)
+    cached = chain_cache.get(key)
+    if cached is not None and cached[0] is history_aware_retriever:
+        logger.info(f"Reusing compiled RAG chain {fingerprint[:12]}; cache stats: {chain_cache.stats()}")
+        return cached[1]
+
+    start = time.perf_counter()
+    conversational_rag_chain = compile_conversational_rag_chain(
+        llm=llm,
+        history_aware_retriever=history_aware_retriever,
+        table_name=table_name,
+        system_prompt=system_prompt,
+        patient_name=patient_name,
+        patient_age=patient_age,
+        patient_prompt=patient_prompt,
+        llm_completion=llm_completion,
+        structured_output=structured_output
+    )
+    chain_cache.put(key, (history_aware_retriever, conversational_rag_chain))
+    logger.info(f"Compiled RAG chain {fingerprint[:12]} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return conversational_rag_chain
+
+def compile_conversational_rag_chain(
+    llm: ChatBedrock,
+    history_aware_retriever,
+    table_name: str,
+    system_prompt: str,
+    patient_name: str,
+    patient_age: str,
+    patient_prompt: str,
+    llm_completion: bool,
+    structured_output: bool = False
+) -> RunnableWithMessageHistory:
+    """
+    Build the conversational RAG chain that plays the patient.
 
     Args:
-    query (str): The student's query string for which a response is needed.
-    patient_name (str): The specific patient that the student needs to diagnose.
     llm (ChatBedrock): The language model instance used to generate the response.
     history_aware_retriever: The history-aware retriever instance that provides relevant context documents for the query.
     table_name (str): The DynamoDB table name used to store and retrieve the chat history.
-    session_id (str): The unique identifier for the chat session to manage history.
+    system_prompt (str): The simulation group's system prompt.
+    patient_name (str): The specific patient that the student needs to diagnose.
+    patient_age (str): The patient's age.
+    patient_prompt (str): Additional details about the patient's personality, symptoms, or condition.
+    llm_completion (bool): Whether the patient should announce PROPER DIAGNOSIS ACHIEVED.
+    structured_output (bool, optional): Whether the patient also evaluates the student's message
+    and answers with a PatientTurn. The chain then returns the reply as "answer" and the
+    evaluation as "empathy_evaluation", and fails without writing history if the output
+    does not validate.
 
     Returns:
-    dict: A dictionary containing the generated response and the source documents used in the retrieval.
+    RunnableWithMessageHistory: The RAG chain wrapped with DynamoDB-backed chat history.
     """
-    
-    # Evaluate empathy if this is a student response (not initial greeting)
-    empathy_evaluation = None
-    empathy_feedback = ""
-    if query.strip() and "Greet me" not in query:
-        patient_context = f"Patient: {patient_name}, Age: {patient_age}, Condition: {patient_prompt}"
-        nova_client = {
-            "client": boto3.client("bedrock-runtime", region_name="us-east-1"),
-            "model_id": "amazon.nova-pro-v1:0"
-        }
-        empathy_evaluation = evaluate_empathy(query, patient_context, nova_client)
-        
-        if empathy_evaluation:
-            empathy_score = empathy_evaluation.get('empathy_score', 'unknown')
-            realism_flag = empathy_evaluation.get('realism_flag', 'unknown')
-            feedback = empathy_evaluation.get('feedback', '')
-            
-            # Use markdown formatting with star ratings and icons
-            empathy_feedback = f"**Empathy Coach:**\n\n"
-            
-            # Add star rating based on empathy score
-            if empathy_score == "bad":
-                stars = ""
-            elif empathy_score == "ok":
-                stars = "⭐"
-            elif empathy_score == "good":
-                stars = "⭐⭐"
-            else:
-                stars = "⭐⭐⭐"
-                
-            # Add icon for realism
-            if realism_flag == "unrealistic":
-                realism_icon = ""
-            else:
-                realism_icon = "✅"
-                
-            empathy_feedback += f"Your empathy score is {empathy_score} {stars}\n"
-            empathy_feedback += f"Your response is {realism_flag} {realism_icon}\n"
-            
-            # Add detailed feedback with reasoning
-            if feedback:
-                if isinstance(feedback, dict):  # Structured feedback from Nova Pro
-                    # Add strengths
-                    if 'strengths' in feedback and feedback['strengths']:
-                        empathy_feedback += f"**Strengths:**\n"
-                        for strength in feedback['strengths']:
-                            empathy_feedback += f"• {strength}\n"
-                        empathy_feedback += "\n"
-                    
-                    # Add areas for improvement
-                    if 'areas_for_improvement' in feedback and feedback['areas_for_improvement']:
-                        empathy_feedback += f"**Areas for improvement:**\n"
-                        for area in feedback['areas_for_improvement']:
-                            empathy_feedback += f"• {area}\n"
-                        empathy_feedback += "\n"
-                    
-                    # Add why realistic/unrealistic
-                    if 'why_realistic' in feedback and feedback['why_realistic']:
-                        empathy_feedback += f"**Your response is {realism_flag} because:** {feedback['why_realistic']}\n\n"
-                    elif 'why_unrealistic' in feedback and feedback['why_unrealistic']:
-                        empathy_feedback += f"**Your response is {realism_flag} because:** {feedback['why_unrealistic']}\n\n"
-                    
-                    # Add improvement suggestions
-                    if 'improvement_suggestions' in feedback and feedback['improvement_suggestions']:
-                        empathy_feedback += f"**Improvement suggestions:**\n"
-                        for suggestion in feedback['improvement_suggestions']:
-                            empathy_feedback += f"• {suggestion}\n"
-                        empathy_feedback += "\n"
-                    
-                    # Add alternative phrasing
-                    if 'alternative_phrasing' in feedback and feedback['alternative_phrasing']:
-                        empathy_feedback += f"**Try this approach:** *{feedback['alternative_phrasing']}*\n\n"
-                        
-                elif isinstance(feedback, str) and len(feedback) > 10:  # Simple string feedback
-                    empathy_feedback += f"**Feedback:** {feedback}\n"
-                else:
-                    empathy_feedback += f"**Feedback:** Unable to provide detailed feedback at this time.\n"
-            else:
-                empathy_feedback += "**Feedback:** System temporarily unavailable.\n"
-                
-            empathy_feedback += "---\n\n**Patient Response:**\n"
-    
     completion_string = """
                 Once I, the pharmacy student, have give you a diagnosis, politely leave the conversation and wish me goodbye.
                 Regardless if I have given you the proper diagnosis or not for the patient you are pretending to be, stop talking to me.
@@ -257,7 +314,9 @@ def get_response(
         <|eot_id|>
         """
     )
-    
+    if structured_output:
+        system_prompt += COMBINED_OUTPUT_INSTRUCTIONS
+
     qa_prompt = ChatPromptTemplate.from_messages(
         [
             ("system", system_prompt),
@@ -267,33 +326,308 @@ def get_response(
     )
     question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
     rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    if structured_output:
+        rag_chain = rag_chain | RunnableLambda(split_patient_turn)
 
     conversational_rag_chain = RunnableWithMessageHistory(
         rag_chain,
-        lambda session_id: DynamoDBChatMessageHistory(
-            table_name=table_name, 
-            session_id=session_id
+        lambda session_id: get_chat_history(
+            table_name=table_name,
+            session_id=session_id,
+            llm=llm
         ),
         input_messages_key="input",
         history_messages_key="chat_history",
         output_messages_key="answer",
     )
-    
-    # Generate the response until it's not empty
-    response = ""
-    while not response:
-        response = generate_response(
-            conversational_rag_chain,
-            query,
-            session_id
-        )
-    
+
+    return conversational_rag_chain
+
+def split_patient_turn(output: dict) -> dict:
+    """
+    Replace the combined answer of a structured RAG chain with the patient reply, and
+    return the empathy evaluation alongside it.
+
+    Raises:
+    OutputParserException: If the answer is not a valid PatientTurn.
+    """
+    turn = parse_patient_turn(output["answer"])
+    return {**output, "answer": turn.response, "empathy_evaluation": get_empathy_evaluation(turn)}
+
+def get_response(
+    query: str,
+    patient_name: str,
+    llm: ChatBedrock,
+    history_aware_retriever,
+    table_name: str,
+    session_id: str,
+    system_prompt: str,
+    patient_age: str,
+    patient_prompt: str,
+    llm_completion: bool,
+    opening_key: str = None
+) -> dict:
+    """
+    Generates a response to a query using the LLM and a history-aware retriever for context.
+
+    With STRUCTURED_OUTPUT_MODE=combined, a student turn is answered and evaluated in a
+    single structured call, falling back to separate calls if its output does not validate.
+
+    Args:
+    query (str): The student's query string for which a response is needed.
+    patient_name (str): The specific patient that the student needs to diagnose.
+    llm (ChatBedrock): The language model instance used to generate the response.
+    history_aware_retriever: The history-aware retriever instance that provides relevant context documents for the query.
+    table_name (str): The DynamoDB table name used to store and retrieve the chat history.
+    session_id (str): The unique identifier for the chat session to manage history.
+    opening_key (str, optional): Set on the opening turn to serve and store the greeting from the opening-turn cache.
+
+    Returns:
+    dict: A dictionary containing the generated response and the source documents used in the retrieval.
+    """
+    if opening_key:
+        greeting = get_cached_opening_turn(table_name, opening_key)
+        if greeting:
+            record_opening_turn(table_name, session_id, query, greeting)
+            return get_llm_output(greeting, llm_completion)
+
+    chain_inputs = dict(
+        llm=llm,
+        history_aware_retriever=history_aware_retriever,
+        table_name=table_name,
+        system_prompt=system_prompt,
+        patient_name=patient_name,
+        patient_age=patient_age,
+        patient_prompt=patient_prompt,
+        llm_completion=llm_completion
+    )
+
+    # Evaluate empathy if this is a student response (not initial greeting)
+    evaluate = query.strip() and "Greet me" not in query
+    patient_context = f"Patient: {patient_name}, Age: {patient_age}, Condition: {patient_prompt}"
+
+    combined = None
+    if evaluate and STRUCTURED_OUTPUT_MODE == "combined":
+        structured_chain = build_conversational_rag_chain(**chain_inputs, structured_output=True)
+        combined = generate_combined_response(structured_chain, query, session_id, getattr(llm, "model_id", None))
+
+    if combined:
+        response, empathy_evaluation = combined
+    else:
+        # The separate chain is only needed when the combined call was not made or fell back
+        conversational_rag_chain = build_conversational_rag_chain(**chain_inputs)
+        if evaluate and CONCURRENT_EMPATHY:
+            response, empathy_evaluation = run_concurrently(
+                conversational_rag_chain, query, session_id, patient_context, getattr(llm, "model_id", None)
+            )
+        else:
+            empathy_evaluation = None
+            if evaluate:
+                empathy_evaluation = evaluate_empathy(query, patient_context, get_nova_client())
+            response = generate_non_empty_response(conversational_rag_chain, query, session_id, getattr(llm, "model_id", None))
+
+    if opening_key:
+        save_opening_turn(table_name, opening_key, response)
+
+    empathy_feedback = format_empathy_feedback(empathy_evaluation) if empathy_evaluation else ""
     result = get_llm_output(response, llm_completion, empathy_feedback)
     if empathy_evaluation:
         result["empathy_evaluation"] = empathy_evaluation
     
     return result
 
+def get_opening_turn_key(patient_id: str, fingerprint: str) -> str:
+    """
+    Build the storage key of a patient's cached opening turn.
+
+    Args:
+    patient_id (str): The patient (vector store collection) the greeting is based on.
+    fingerprint (str): The chain fingerprint from get_chain_fingerprint.
+
+    Returns:
+    str: The key used in the opening turn table and the in-process cache.
+    """
+    return f"{patient_id}#{fingerprint}"
+
+def get_opening_turn_table(table_name: str) -> str:
+    """
+    Return the name of the opening turn table that accompanies table_name, creating it on first use.
+    """
+    opening_table_name = f"{table_name}-OpeningTurns"
+    ensure_table(
+        opening_table_name,
+        key_schema=[{"AttributeName": "OpeningKey", "KeyType": "HASH"}],
+        attribute_definitions=[{"AttributeName": "OpeningKey", "AttributeType": "S"}],
+    )
+    return opening_table_name
+
+def get_cached_opening_turn(table_name: str, opening_key: str) -> str:
+    """
+    Look up a cached opening greeting, first in-process and then in DynamoDB.
+
+    Returns:
+    str: The greeting, or None if it has not been generated yet.
+    """
+    greeting = opening_turn_cache.get(opening_key)
+    if greeting:
+        return greeting
+    try:
+        response = dynamodb_client.get_item(
+            TableName=get_opening_turn_table(table_name),
+            Key={"OpeningKey": {"S": opening_key}}
+        )
+    except Exception as e:
+        logger.error(f"Error reading cached opening turn: {e}")
+        return None
+    greeting = response.get("Item", {}).get("Greeting", {}).get("S")
+    if greeting:
+        opening_turn_cache.put(opening_key, greeting)
+    return greeting
+
+def save_opening_turn(table_name: str, opening_key: str, greeting: str) -> None:
+    """
+    Store a freshly generated opening greeting so later sessions can reuse it.
+    """
+    opening_turn_cache.put(opening_key, greeting)
+    try:
+        dynamodb_client.put_item(
+            TableName=get_opening_turn_table(table_name),
+            Item={"OpeningKey": {"S": opening_key}, "Greeting": {"S": greeting}}
+        )
+    except Exception as e:
+        logger.error(f"Error storing cached opening turn: {e}")
+
+def record_opening_turn(table_name: str, session_id: str, query: str, greeting: str) -> None:
+    """
+    Write a cached opening exchange into the session history, exactly as the RAG chain would have.
+    """
+    logger.info(f"Serving cached opening turn for session {session_id}")
+    with span("history"):
+        get_raw_history(table_name, session_id).add_messages(
+            [HumanMessage(content=query), AIMessage(content=greeting)]
+        )
+
+def get_nova_client() -> dict:
+    """
+    Build the Bedrock client description used by evaluate_empathy.
+
+    Returns:
+    dict: The bedrock-runtime client and the Nova Pro model ID.
+    """
+    return {
+        "client": get_client("bedrock-runtime", "us-east-1"),
+        "model_id": "amazon.nova-pro-v1:0"
+    }
+
+def timed_call(func, *args) -> tuple:
+    """
+    Call a function and measure how long it took.
+
+    Returns:
+    tuple: The function's return value and the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    value = func(*args)
+    return value, time.perf_counter() - start
+
+def generate_non_empty_response(conversational_rag_chain: object, query: str, session_id: str, model_id: str = None) -> str:
+    """
+    Invoke the RAG chain until it produces a non-empty answer, within the call policy's
+    attempt limit and the request deadline (see helpers/policy.py).
+
+    Raises:
+    ModelCallError: If no non-empty answer was produced in time.
+    """
+    return call_with_policy(
+        "generation",
+        generate_response,
+        args=(conversational_rag_chain, query, session_id),
+        accept=bool,
+        model_id=model_id,
+    )
+
+def generate_combined_response(structured_chain: object, query: str, session_id: str, model_id: str = None) -> tuple:
+    """
+    Produce the patient reply and the empathy evaluation with one call to the patient model.
+
+    The call has its own circuit breaker, so after repeated invalid outputs turns go
+    straight to the separate calls until the cooldown has passed.
+
+    Args:
+    structured_chain: A RAG chain built with structured_output=True.
+    query (str): The student's query.
+    session_id (str): The unique identifier for the current conversation session.
+    model_id (str, optional): The model that plays the patient, for rate limiting.
+
+    Returns:
+    tuple: The patient reply and the empathy evaluation, or None if the output did not
+    validate and the caller should fall back to separate calls.
+    """
+    def invoke() -> dict:
+        with span("generation"):
+            return structured_chain.invoke(
+                {"input": query},
+                config={"configurable": {"session_id": session_id}},
+            )
+
+    try:
+        output = call_with_policy("combined", invoke, model_id=model_id)
+    except (OutputParserException, CircuitOpenError) as e:
+        logger.warning(f"Falling back to separate reply and empathy calls: {e}")
+        return None
+    return output["answer"], output["empathy_evaluation"]
+
+def run_concurrently(
+    conversational_rag_chain: object,
+    query: str,
+    session_id: str,
+    patient_context: str,
+    model_id: str = None
+) -> tuple:
+    """
+    Run the empathy evaluation and the RAG chain at the same time and join the results.
+
+    Each branch has its own timeout. If the empathy evaluation is too slow the patient
+    reply is returned without the empathy coach block instead of waiting for it.
+
+    Args:
+    conversational_rag_chain: The Conversational RAG chain used to generate the patient reply.
+    query (str): The student's query.
+    session_id (str): The unique identifier for the current conversation session.
+    patient_context (str): Patient summary passed to the empathy evaluator.
+    model_id (str, optional): The model that plays the patient, for rate limiting.
+
+    Returns:
+    tuple: The patient reply and the empathy evaluation (None if it timed out).
+
+    Raises:
+    DeadlineExceeded: If the patient reply took longer than RESPONSE_TIMEOUT_SECONDS.
+    """
+    start = time.perf_counter()
+    empathy_future = executor.submit(run_in_context(timed_call), evaluate_empathy, query, patient_context, get_nova_client())
+    response_future = executor.submit(
+        run_in_context(timed_call), generate_non_empty_response, conversational_rag_chain, query, session_id, model_id
+    )
+
+    try:
+        response, response_time = response_future.result(timeout=RESPONSE_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        raise DeadlineExceeded(f"Patient reply exceeded {RESPONSE_TIMEOUT_SECONDS}s")
+
+    # The empathy branch gets whatever is left of its own budget after the reply is ready
+    remaining = max(0.0, EMPATHY_TIMEOUT_SECONDS - (time.perf_counter() - start))
+    try:
+        empathy_evaluation, empathy_time = empathy_future.result(timeout=remaining)
+    except FutureTimeoutError:
+        logger.warning(f"Empathy evaluation exceeded {EMPATHY_TIMEOUT_SECONDS}s; returning the patient reply without it.")
+        return response, None
+
+    wall_time = time.perf_counter() - start
+    saved = response_time + empathy_time - wall_time
+    logger.info(f"Concurrent turn: response {response_time:.3f}s, empathy {empathy_time:.3f}s, "
+                f"wall {wall_time:.3f}s, overlap saved {saved:.3f}s")
+    return response, empathy_evaluation
+
 def generate_response(conversational_rag_chain: object, query: str, session_id: str) -> str:
     """
     Invokes the RAG chain to generate a response to a given query.
@@ -306,14 +640,220 @@ def generate_response(conversational_rag_chain: object, query: str, session_id:
     Returns:
     str: The answer generated by the Conversational RAG chain, based on the input query and session context.
     """
-    return conversational_rag_chain.invoke(
-        {
-            "input": query
-        },
-        config={
-            "configurable": {"session_id": session_id}
-        },  # constructs a key "session_id" in `store`.
-    )["answer"]
+    with span("generation"):
+        return conversational_rag_chain.invoke(
+            {
+                "input": query
+            },
+            config={
+                "configurable": {"session_id": session_id}
+            },  # constructs a key "session_id" in `store`.
+        )["answer"]
+
+class DiagnosisMarkerFilter:
+    """
+    Incrementally release the streamed patient text that get_llm_output will keep.
+
+    get_llm_output drops the sentence holding the PROPER DIAGNOSIS ACHIEVED marker and
+    the sentence before it (see truncate_at_diagnosis). While the reply is streaming it is
+    not yet known whether the marker follows, so the last complete sentence and the one
+    in progress are held back; the text before them is the same in the final reply
+    either way. finish() returns the rest of the final reply, so the streamed tokens add
+    up to exactly the text the non-streamed path returns.
+    """
+
+    def __init__(self, llm_completion: bool):
+        self.llm_completion = llm_completion
+        self.achieved = False
+        self.text = ""
+        self.sent = 0
+
+    def feed(self, text: str) -> str:
+        """
+        Add a streamed chunk and return the part of the reply that is safe to send to the client.
+        """
+        if not self.llm_completion:
+            return text
+        searched = max(0, len(self.text) - len(DIAGNOSIS_MARKER) + 1)
+        self.text += text
+        if self.achieved or DIAGNOSIS_MARKER in self.text[searched:]:
+            self.achieved = True
+            return ""
+
+        starts = get_sentence_starts(self.text)
+        if len(starts) < 3:
+            return ""
+        # Everything before the boundary that precedes the last complete sentence
+        limit = starts[-2] - 1
+        safe, self.sent = self.text[self.sent:limit], max(self.sent, limit)
+        return safe
+
+    def finish(self, reply: str) -> str:
+        """
+        Return the part of the final reply (get_llm_output's text) not yet sent.
+        """
+        if not self.llm_completion:
+            return ""
+        return reply[self.sent:]
+
+def open_answer_stream(conversational_rag_chain: object, query: str, session_id: str) -> tuple:
+    """
+    Start streaming the RAG chain and wait for the first non-empty answer token.
+
+    Returns:
+    tuple: The first token ("" if the stream ended without one) and an iterator over
+    the remaining answer tokens.
+    """
+    chunks = conversational_rag_chain.stream(
+        {"input": query},
+        config={"configurable": {"session_id": session_id}},
+    )
+    tokens = (chunk.get("answer") for chunk in chunks)
+    tokens = (token for token in tokens if token)
+    return next(tokens, ""), tokens
+
+def stream_response(
+    query: str,
+    patient_name: str,
+    llm: ChatBedrock,
+    history_aware_retriever,
+    table_name: str,
+    session_id: str,
+    system_prompt: str,
+    patient_age: str,
+    patient_prompt: str,
+    llm_completion: bool,
+    opening_key: str = None
+):
+    """
+    Streaming counterpart of get_response.
+
+    Tokens from the RAG chain are yielded as they arrive. The empathy evaluation runs
+    concurrently and is yielded as its own event as soon as it is ready. The combined
+    structured mode is not used here, since a JSON answer cannot be shown while it streams.
+
+    Opening the stream goes through the call policy like any other generation: until
+    the first token arrives, throttling is retried and a stream that ends empty is
+    reopened. Once tokens have been sent the stream cannot be retried.
+
+    Yields:
+    dict: Events of type "token" (content), "empathy" (empathy_evaluation, empathy_feedback)
+    and finally "result" (the same fields as get_response plus ttft_ms and total_ms).
+    """
+    start = time.perf_counter()
+    if opening_key:
+        greeting = get_cached_opening_turn(table_name, opening_key)
+        if greeting:
+            record_opening_turn(table_name, session_id, query, greeting)
+            result = get_llm_output(greeting, llm_completion)
+            yield {"type": "token", "content": result["llm_output"]}
+            result["type"] = "result"
+            result["ttft_ms"] = result["total_ms"] = round((time.perf_counter() - start) * 1000)
+            yield result
+            return
+
+    conversational_rag_chain = build_conversational_rag_chain(
+        llm=llm,
+        history_aware_retriever=history_aware_retriever,
+        table_name=table_name,
+        system_prompt=system_prompt,
+        patient_name=patient_name,
+        patient_age=patient_age,
+        patient_prompt=patient_prompt,
+        llm_completion=llm_completion
+    )
+
+    empathy_future = None
+    if query.strip() and "Greet me" not in query:
+        patient_context = f"Patient: {patient_name}, Age: {patient_age}, Condition: {patient_prompt}"
+        empathy_future = executor.submit(run_in_context(evaluate_empathy), query, patient_context, get_nova_client())
+
+    empathy_evaluation = None
+    empathy_sent = False
+    marker_filter = DiagnosisMarkerFilter(llm_completion)
+    answer = ""
+
+    with span("generation"):
+        first_token, tokens = call_with_policy(
+            "generation",
+            open_answer_stream,
+            args=(conversational_rag_chain, query, session_id),
+            accept=lambda opened: bool(opened[0]),
+            model_id=getattr(llm, "model_id", None),
+        )
+        ttft = time.perf_counter() - start
+        logger.info(f"Time to first token: {ttft * 1000:.0f} ms")
+
+        for token in itertools.chain([first_token], tokens):
+            answer += token
+
+            if empathy_future and not empathy_sent and empathy_future.done():
+                empathy_evaluation = empathy_future.result()
+                empathy_sent = True
+                yield empathy_event(empathy_evaluation)
+
+            safe = marker_filter.feed(token)
+            if safe:
+                yield {"type": "token", "content": safe}
+
+    tail = marker_filter.finish(get_llm_output(answer, llm_completion)["llm_output"])
+    if tail:
+        yield {"type": "token", "content": tail}
+
+    if empathy_future and not empathy_sent:
+        remaining = max(0.0, EMPATHY_TIMEOUT_SECONDS - (time.perf_counter() - start))
+        try:
+            empathy_evaluation = empathy_future.result(timeout=remaining)
+            yield empathy_event(empathy_evaluation)
+        except FutureTimeoutError:
+            logger.warning(f"Empathy evaluation exceeded {EMPATHY_TIMEOUT_SECONDS}s; streaming the patient reply without it.")
+
+    if opening_key:
+        save_opening_turn(table_name, opening_key, answer)
+
+    empathy_feedback = format_empathy_feedback(empathy_evaluation) if empathy_evaluation else ""
+    result = get_llm_output(answer, llm_completion, empathy_feedback)
+    if empathy_evaluation:
+        result["empathy_evaluation"] = empathy_evaluation
+    result["type"] = "result"
+    result["ttft_ms"] = round(ttft * 1000)
+    result["total_ms"] = round((time.perf_counter() - start) * 1000)
+    yield result
+
+def empathy_event(empathy_evaluation: dict) -> dict:
+    """
+    Wrap an empathy evaluation as a stream event.
+    """
+    return {
+        "type": "empathy",
+        "empathy_evaluation": empathy_evaluation,
+        "empathy_feedback": format_empathy_feedback(empathy_evaluation) if empathy_evaluation else ""
+    }
+
+def truncate_at_diagnosis(response: str) -> tuple:
+    """
+    Cut a patient reply at the PROPER DIAGNOSIS ACHIEVED marker.
+
+    The sentence holding the marker and the sentence before it are dropped. The diagnosis
+    counts as achieved unless that previous sentence is a question. Used by get_llm_output
+    and, while streaming, by DiagnosisMarkerFilter, so both paths show the same text.
+
+    Args:
+    response (str): The response generated by the LLM.
+
+    Returns:
+    tuple: The reply to show and whether the proper diagnosis was achieved.
+    """
+    index = response.find(DIAGNOSIS_MARKER)
+    if index == -1:
+        return response, False
+
+    starts = get_sentence_starts(response)
+    sentence = sum(1 for start in starts if start <= index) - 1
+    if sentence == 0:
+        return "", True
+    previous = response[starts[sentence - 1]:starts[sentence]].rstrip()
+    return response[:max(starts[sentence - 1] - 1, 0)], not previous.endswith("?")
 
 def get_llm_output(response: str, llm_completion: bool, empathy_feedback: str = "") -> dict:
     """
@@ -328,39 +868,97 @@ def get_llm_output(response: str, llm_completion: bool, empathy_feedback: str =
     dict: A dictionary containing the processed output from the LLM and a boolean 
     flag indicating whether proper diagnosis has been achieved.
     """
-
-    completion_sentence = " Congratulations! You have provided the proper diagnosis for me, the patient I am pretending to be! Please try other mock patients to continue your diagnosis skills! :)"
-
     if not llm_completion:
         return dict(
             llm_output=empathy_feedback + response,
             llm_verdict=False
         )
-    
-    elif "PROPER DIAGNOSIS ACHIEVED" not in response:
-        return dict(
-            llm_output=empathy_feedback + response,
-            llm_verdict=False
-        )
-    
-    elif "PROPER DIAGNOSIS ACHIEVED" in response:
-        sentences = split_into_sentences(response)
-        
-        for i in range(len(sentences)):
-            
-            if "PROPER DIAGNOSIS ACHIEVED" in sentences[i]:
-                llm_response=' '.join(sentences[0:i-1])
-                
-                if sentences[i-1][-1] == '?':
-                    return dict(
-                        llm_output=empathy_feedback + llm_response,
-                        llm_verdict=False
-                    )
-                else:
-                    return dict(
-                        llm_output=empathy_feedback + llm_response + completion_sentence,
-                        llm_verdict=True
-                    )
+
+    llm_response, achieved = truncate_at_diagnosis(response)
+    return dict(
+        llm_output=empathy_feedback + llm_response + (COMPLETION_SENTENCE if achieved else ""),
+        llm_verdict=achieved
+    )
+
+def format_empathy_feedback(empathy_evaluation: dict) -> str:
+    """
+    Render an empathy evaluation as the markdown "Empathy Coach" block shown above the patient reply.
+
+    Args:
+    empathy_evaluation (dict): The evaluation returned by evaluate_empathy.
+
+    Returns:
+    str: The formatted empathy feedback.
+    """
+    empathy_score = empathy_evaluation.get('empathy_score', 'unknown')
+    realism_flag = empathy_evaluation.get('realism_flag', 'unknown')
+    feedback = empathy_evaluation.get('feedback', '')
+
+    # Use markdown formatting with star ratings and icons
+    empathy_feedback = f"**Empathy Coach:**\n\n"
+
+    # Add star rating based on empathy score
+    if empathy_score == "bad":
+        stars = ""
+    elif empathy_score == "ok":
+        stars = "⭐"
+    elif empathy_score == "good":
+        stars = "⭐⭐"
+    else:
+        stars = "⭐⭐⭐"
+
+    # Add icon for realism
+    if realism_flag == "unrealistic":
+        realism_icon = ""
+    else:
+        realism_icon = "✅"
+
+    empathy_feedback += f"Your empathy score is {empathy_score} {stars}\n"
+    empathy_feedback += f"Your response is {realism_flag} {realism_icon}\n"
+
+    # Add detailed feedback with reasoning
+    if feedback:
+        if isinstance(feedback, dict):  # Structured feedback from Nova Pro
+            # Add strengths
+            if 'strengths' in feedback and feedback['strengths']:
+                empathy_feedback += f"**Strengths:**\n"
+                for strength in feedback['strengths']:
+                    empathy_feedback += f"• {strength}\n"
+                empathy_feedback += "\n"
+
+            # Add areas for improvement
+            if 'areas_for_improvement' in feedback and feedback['areas_for_improvement']:
+                empathy_feedback += f"**Areas for improvement:**\n"
+                for area in feedback['areas_for_improvement']:
+                    empathy_feedback += f"• {area}\n"
+                empathy_feedback += "\n"
+
+            # Add why realistic/unrealistic
+            if 'why_realistic' in feedback and feedback['why_realistic']:
+                empathy_feedback += f"**Your response is {realism_flag} because:** {feedback['why_realistic']}\n\n"
+            elif 'why_unrealistic' in feedback and feedback['why_unrealistic']:
+                empathy_feedback += f"**Your response is {realism_flag} because:** {feedback['why_unrealistic']}\n\n"
+
+            # Add improvement suggestions
+            if 'improvement_suggestions' in feedback and feedback['improvement_suggestions']:
+                empathy_feedback += f"**Improvement suggestions:**\n"
+                for suggestion in feedback['improvement_suggestions']:
+                    empathy_feedback += f"• {suggestion}\n"
+                empathy_feedback += "\n"
+
+            # Add alternative phrasing
+            if 'alternative_phrasing' in feedback and feedback['alternative_phrasing']:
+                empathy_feedback += f"**Try this approach:** *{feedback['alternative_phrasing']}*\n\n"
+
+        elif isinstance(feedback, str) and len(feedback) > 10:  # Simple string feedback
+            empathy_feedback += f"**Feedback:** {feedback}\n"
+        else:
+            empathy_feedback += f"**Feedback:** Unable to provide detailed feedback at this time.\n"
+    else:
+        empathy_feedback += "**Feedback:** System temporarily unavailable.\n"
+
+    empathy_feedback += "---\n\n**Patient Response:**\n"
+    return empathy_feedback
 
 def split_into_sentences(paragraph: str) -> list[str]:
     """
@@ -376,10 +974,13 @@ def split_into_sentences(paragraph: str) -> list[str]:
     or exclamation marks, and avoids splitting on abbreviations (e.g., "Dr." or "U.S.") by handling edge cases. The 
     resulting list contains sentences extracted from the input paragraph.
     """
-    # Regular expression pattern
-    sentence_endings = r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s'
-    sentences = re.split(sentence_endings, paragraph)
-    return sentences
+    return re.split(SENTENCE_ENDINGS, paragraph)
+
+def get_sentence_starts(paragraph: str) -> list[int]:
+    """
+    Return the offset of every sentence of paragraph, using the boundaries of split_into_sentences.
+    """
+    return [0] + [match.end() for match in re.finditer(SENTENCE_ENDINGS, paragraph)]
 
 def evaluate_empathy(student_response: str, patient_context: str, bedrock_client) -> dict:
     """
@@ -391,7 +992,8 @@ def evaluate_empathy(student_response: str, patient_context: str, bedrock_client
     bedrock_client: Bedrock client for Nova Pro
     
     Returns:
-    dict: Contains empathy_score, realism_flag, and feedback
+    dict: Contains empathy_score, realism_flag, and feedback, or None if the evaluation
+    was skipped because its deadline passed or its circuit breaker is open.
     """
 
     evaluation_prompt = f"""
@@ -444,15 +1046,27 @@ def evaluate_empathy(student_response: str, patient_context: str, bedrock_client
         }
     }
     
-    try:
+    def invoke() -> dict:
+        start = time.perf_counter()
         response = bedrock_client["client"].invoke_model(
             modelId=bedrock_client["model_id"],
             contentType="application/json",
             accept="application/json",
             body=json.dumps(body)
         )
-        
         result = json.loads(response["body"].read())
+        usage = result.get("usage", {})
+        record_model_call(
+            bedrock_client["model_id"], usage.get("inputTokens", 0), usage.get("outputTokens", 0),
+            time.perf_counter() - start
+        )
+        return result
+
+    try:
+        with span("empathy"):
+            result = call_with_policy(
+                "empathy", invoke, timeout=EMPATHY_TIMEOUT_SECONDS, hedge=True, model_id=bedrock_client["model_id"]
+            )
         logger.info(f"LLM RESPONSE: {result}")
         response_text = result["output"]["message"]["content"][0]["text"]
         
@@ -468,7 +1082,11 @@ def evaluate_empathy(student_response: str, patient_context: str, bedrock_client
                 "realism_flag": "realistic",
                 "feedback": "System error - unable to parse evaluation. Please try again."
             }
-        
+
+    except ModelCallError as e:
+        # The reply is still useful on its own, so the empathy coach is skipped
+        logger.warning(f"Skipping empathy evaluation: {e}")
+        return None
     except Exception as e:
         logger.error(f"Error evaluating empathy: {e}")
         return {
@@ -477,71 +1095,159 @@ def evaluate_empathy(student_response: str, patient_context: str, bedrock_client
             "feedback": "System error - unable to evaluate. Please try again."
         }
 
-def update_session_name(table_name: str, session_id: str, bedrock_llm_id: str) -> str:
+# Words that never make a useful session title
+TITLE_STOPWORDS = set("""
+a about above after again all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself
+him himself his how i if in into is it its itself just let me more most my myself no nor not now of off on once
+only or other our ours ourselves out over own please same she should so some such than that the their theirs
+them themselves then there these they this those through to too under until up user very was we were what when
+where which while who whom why will with would you your yours yourself yourselves hello hi hey thanks thank okay
+ok tell feel feeling today currently also any anything know think like get got much many really well going long
+sorry i'm i've i'd you're you've it's that's there's don't can't
+""".split())
+
+# Openers that say nothing about the conversation
+TITLE_GREETING = re.compile(
+    r"^\W*(?:(?:(?:hi|hello|hey)(?: there)?|good (?:morning|afternoon|evening)|thanks|thank you|okay|ok)\b[\s,.!]*)+(?-i:[A-Z][a-z]+\b[\s,.!]*)?",
+    re.IGNORECASE
+)
+
+def generate_local_session_name(student_message: str, max_length: int = 30) -> str:
     """
-    Check if both the LLM and the student have exchanged exactly one message each.
-    If so, generate and return a session name using the content of the student's first message
-    and the LLM's first response. Otherwise, return None.
+    Build a short session title from the student's first message without calling a model.
+
+    A leading greeting is dropped. If at least two informative words are left, the
+    longest ones (non-stopwords, in their original order) are kept until the title would
+    exceed max_length characters. Otherwise the message itself is used, cut at a word
+    boundary, so a short question such as "What brings you in?" keeps its meaning.
 
     Args:
-    session_id (str): The unique ID for the session.
-    table_name (str): The DynamoDB table name where the conversation history is stored.
+    student_message (str): The student's first message.
+    max_length (int, optional): The maximum title length. Defaults to 30.
 
     Returns:
-    str: The updated session name if conditions are met, otherwise None.
+    str: The title, or None if the message is only a greeting.
+    """
+    message = TITLE_GREETING.sub("", student_message.strip()).strip()
+    words = [w for w in re.findall(r"[A-Za-z][A-Za-z'-]*", message) if w.lower() not in TITLE_STOPWORDS and len(w) > 2]
+    if len(dict.fromkeys(w.lower() for w in words)) < 2:
+        return truncate_title(message, max_length)
+
+    # Keep the longest distinct words but present them in the order they were written
+    ranked = sorted(dict.fromkeys(w.lower() for w in words), key=len, reverse=True)
+    chosen = []
+    for word in ranked:
+        if len(" ".join(chosen + [word])) > max_length:
+            continue
+        chosen.append(word)
+        if len(chosen) == 4:
+            break
+    ordered = [w for w in dict.fromkeys(x.lower() for x in words) if w in chosen]
+    return " ".join(w.capitalize() for w in ordered)
+
+def truncate_title(message: str, max_length: int) -> str:
+    """
+    Cut a message to at most max_length characters at a word boundary, without trailing punctuation.
+    """
+    words = re.findall(r"[A-Za-z0-9][A-Za-z0-9'-]*", message.split("?")[0].split(".")[0])
+    title = ""
+    for word in words:
+        if len(f"{title} {word}".strip()) > max_length:
+            break
+        title = f"{title} {word}".strip()
+    return title[:1].upper() + title[1:] if title else None
+
+def count_student_turns(table_name: str, session_id: str) -> int:
+    """
+    Count the student turns already stored in a session's history, leaving out the opening greeting.
+    """
+    messages = get_raw_history(table_name, session_id).messages
+    return sum(1 for m in messages if isinstance(m, HumanMessage) and "Greet me" not in m.content)
+
+def increment_student_turns(table_name: str, session_id: str) -> int:
+    """
+    Atomically count a student turn on the session's metadata item.
+
+    Sessions created before the counter existed have no StudentTurns attribute. Their
+    counter is seeded once from the history (which already holds this turn), so an
+    ongoing conversation is not mistaken for a first exchange and renamed.
+
+    Returns:
+    int: The number of student turns in the session, including this one.
     """
-    
-    dynamodb_client = boto3.client("dynamodb")
-    
-    # Retrieve the conversation history from the DynamoDB table
     try:
-        response = dynamodb_client.get_item(
+        response = dynamodb_client.update_item(
             TableName=table_name,
-            Key={
-                'SessionId': {
-                    'S': session_id
-                }
-            }
+            Key=get_meta_key(session_id),
+            UpdateExpression="ADD StudentTurns :one",
+            ConditionExpression="attribute_exists(StudentTurns)",
+            ExpressionAttributeValues={":one": {"N": "1"}},
+            ReturnValues="UPDATED_NEW"
         )
-    except Exception as e:
-        print(f"Error fetching conversation history from DynamoDB: {e}")
-        return None
+        return int(response["Attributes"]["StudentTurns"]["N"])
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        pass
+
+    turns = max(count_student_turns(table_name, session_id), 1)
+    try:
+        dynamodb_client.update_item(
+            TableName=table_name,
+            Key=get_meta_key(session_id),
+            UpdateExpression="SET StudentTurns = :turns",
+            ConditionExpression="attribute_not_exists(StudentTurns)",
+            ExpressionAttributeValues={":turns": {"N": str(turns)}}
+        )
+        if turns > 1:
+            logger.info(f"Seeded StudentTurns for session {session_id} from {turns} stored turns")
+        return turns
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        # A concurrent turn seeded the counter first; count this turn on top of it
+        response = dynamodb_client.update_item(
+            TableName=table_name,
+            Key=get_meta_key(session_id),
+            UpdateExpression="ADD StudentTurns :one",
+            ExpressionAttributeValues={":one": {"N": "1"}},
+            ReturnValues="UPDATED_NEW"
+        )
+        return int(response["Attributes"]["StudentTurns"]["N"])
 
-    history = response.get('Item', {}).get('History', {}).get('L', [])
+def update_session_name(table_name: str, session_id: str, student_message: str) -> str:
+    """
+    Name the session after the first exchange between the student and the patient.
 
+    A cheap atomic turn counter replaces reading the whole history, and only the turn
+    that moves the counter to 1 names the session, so naming happens at most once.
+    The title is generated locally; SESSION_NAMING_MODE=llm additionally refines it in
+    the background (see generate_llm_session_name). A greeting-only first message has
+    no local title, so the session keeps "New Chat" unless the LLM names it.
 
+    Args:
+    table_name (str): The DynamoDB table name where the conversation history is stored.
+    session_id (str): The unique ID for the session.
+    student_message (str): The student's message for this turn.
 
-    human_messages = []
-    ai_messages = []
-    
-    # Find the first human and ai messages in the history
-    # Check if length of human messages is 2 since the prompt counts as 1
-    # Check if length of AI messages is 2 since after first response by student, another response is generated
-    for item in history:
-        message_type = item.get('M', {}).get('data', {}).get('M', {}).get('type', {}).get('S')
-        
-        if message_type == 'human':
-            human_messages.append(item)
-            if len(human_messages) > 2:
-                print("More than one student message found; not the first exchange.")
-                return None
-        
-        elif message_type == 'ai':
-            ai_messages.append(item)
-            if len(ai_messages) > 2:
-                print("More than one AI message found; not the first exchange.")
-                return None
-
-    if len(human_messages) != 2 or len(ai_messages) != 2:
-        print("Not a complete first exchange between the LLM and student.")
-        return None
-    
-    student_message = human_messages[0].get('M', {}).get('data', {}).get('M', {}).get('content', {}).get('S', "")
-    llm_message = ai_messages[0].get('M', {}).get('data', {}).get('M', {}).get('content', {}).get('S', "")
-    
-    llm = BedrockLLM(
-                        model_id = bedrock_llm_id
-                    )
+    Returns:
+    str: The new session name on the first exchange, otherwise None.
+    """
+    with span("naming"):
+        if increment_student_turns(table_name, session_id) != 1:
+            return None
+        return generate_local_session_name(student_message) or "New Chat"
+
+def generate_llm_session_name(bedrock_llm_id: str, student_message: str, llm_message: str) -> str:
+    """
+    Ask the LLM for a session name describing the first exchange.
+
+    Args:
+    bedrock_llm_id (str): The Bedrock model ID.
+    student_message (str): The student's first message.
+    llm_message (str): The patient's first reply.
+
+    Returns:
+    str: The generated session name.
+    """
+    llm = get_completion_model(bedrock_llm_id)
     
     system_prompt = """
         You are given the first message from an AI and the first message from a student in a conversation. 
@@ -563,5 +1269,6 @@ def update_session_name(table_name: str, session_id: str, bedrock_llm_id: str) -
         <|start_header_id|>assistant<|end_header_id|>
     """
     
-    session_name = llm.invoke(prompt)
-    return session_name
\ No newline at end of file
+    with span("naming"):
+        session_name = call_with_policy("naming", llm.invoke, args=(prompt,), hedge=True, model_id=bedrock_llm_id)
+    return session_name.strip()
@@ -0,0 +1,132 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Hashable, Optional
+
+import boto3
+from botocore.config import Config
+from langchain_aws import ChatBedrock, BedrockEmbeddings
+
+from helpers.usage import UsageCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+# Connection settings shared by every AWS client in the container. Clients are
+# thread-safe, so one client per (service, region) serves all worker threads.
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "20"))
+AWS_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("AWS_CONNECT_TIMEOUT_SECONDS", "5"))
+AWS_READ_TIMEOUT_SECONDS = float(os.environ.get("AWS_READ_TIMEOUT_SECONDS", "300"))
+
+client_config = Config(
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    connect_timeout=AWS_CONNECT_TIMEOUT_SECONDS,
+    read_timeout=AWS_READ_TIMEOUT_SECONDS,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+
+# Replace every Bedrock model and the bedrock-runtime client with local stubs (see helpers/stub_clients.py)
+BEDROCK_STUB = os.environ.get("BEDROCK_STUB", "false").lower() == "true"
+
+# (service, region, model_id) -> client or model instance, created on first use
+registry = {}
+registry_lock = threading.RLock()
+
+def get_or_create(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """
+    Return the registry entry for key, building it with factory the first time.
+    """
+    instance = registry.get(key)
+    if instance is not None:
+        return instance
+    with registry_lock:
+        instance = registry.get(key)
+        if instance is None:
+            start = time.perf_counter()
+            instance = factory()
+            registry[key] = instance
+            logger.info(f"Created {key} in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return instance
+
+# Bedrock calls are retried by helpers/policy.py within the request deadline, so botocore
+# does not retry them on its own as well
+bedrock_client_config = client_config.merge(Config(retries={"max_attempts": 1, "mode": "standard"}))
+
+def get_client(service: str, region: Optional[str] = None):
+    """
+    Return the shared boto3 client for a service and region.
+
+    Args:
+    service (str): The AWS service name, e.g. "bedrock-runtime".
+    region (str, optional): The region. Defaults to the Lambda's own region.
+
+    Returns:
+    The boto3 client, with pooled keep-alive connections.
+    """
+    if BEDROCK_STUB and service == "bedrock-runtime":
+        from helpers.stub_clients import StubBedrockRuntime
+        return get_or_create((service, region, "stub"), StubBedrockRuntime)
+    return get_or_create(
+        (service, region, None),
+        lambda: boto3.client(
+            service,
+            region_name=region,
+            config=bedrock_client_config if service == "bedrock-runtime" else client_config,
+        ),
+    )
+
+def get_chat_model(model_id: str, temperature: float = 0, region: Optional[str] = None):
+    """
+    Return the shared ChatBedrock instance for a model and temperature.
+    """
+    if BEDROCK_STUB:
+        from helpers.stub_clients import StubChatModel
+        return get_or_create(
+            ("chat", region, model_id, temperature),
+            lambda: StubChatModel(model_id=model_id, callbacks=[UsageCallbackHandler(model_id)]),
+        )
+    return get_or_create(
+        ("chat", region, model_id, temperature),
+        lambda: ChatBedrock(
+            model_id=model_id,
+            model_kwargs=dict(temperature=temperature),
+            client=get_client("bedrock-runtime", region),
+            callbacks=[UsageCallbackHandler(model_id)],
+        ),
+    )
+
+def get_completion_model(model_id: str, region: Optional[str] = None):
+    """
+    Return the shared BedrockLLM (text completion) instance for a model.
+    """
+    if BEDROCK_STUB:
+        from helpers.stub_clients import StubCompletionModel
+        return get_or_create(("completion", region, model_id), StubCompletionModel)
+    # Only the LLM session naming path needs a completion model
+    from langchain_aws import BedrockLLM
+
+    return get_or_create(
+        ("completion", region, model_id),
+        lambda: BedrockLLM(
+            model_id=model_id,
+            client=get_client("bedrock-runtime", region),
+            callbacks=[UsageCallbackHandler(model_id)],
+        ),
+    )
+
+def get_embeddings_model(model_id: str, region: Optional[str] = None):
+    """
+    Return the shared BedrockEmbeddings instance for a model.
+    """
+    if BEDROCK_STUB:
+        from helpers.stub_clients import get_stub_embeddings
+        return get_or_create(("embeddings", region, model_id), get_stub_embeddings)
+    return get_or_create(
+        ("embeddings", region, model_id),
+        lambda: BedrockEmbeddings(
+            model_id=model_id,
+            client=get_client("bedrock-runtime", region),
+            region_name=region,
+        ),
+    )
@@ -0,0 +1,80 @@
+"""
+Schemas for the empathy evaluation and the combined patient turn.
+
+evaluate_empathy asks Nova Pro for JSON in the EmpathyEvaluation shape. When
+STRUCTURED_OUTPUT_MODE=combined, the patient model answers with a PatientTurn instead:
+the patient reply and the evaluation of the student's message in a single call.
+"""
+import json
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+from langchain_core.exceptions import OutputParserException
+
+class EmpathyFeedback(BaseModel):
+    strengths: List[str] = Field(default_factory=list)
+    areas_for_improvement: List[str] = Field(default_factory=list)
+    why_realistic: Optional[str] = None
+    why_unrealistic: Optional[str] = None
+    improvement_suggestions: List[str] = Field(default_factory=list)
+    alternative_phrasing: Optional[str] = None
+
+class EmpathyEvaluation(BaseModel):
+    empathy_score: Literal["bad", "ok", "good", "great"]
+    realism_flag: Literal["realistic", "unrealistic"]
+    feedback: EmpathyFeedback
+
+class PatientTurn(EmpathyEvaluation):
+    response: str = Field(min_length=1)
+
+# Appended to the patient's system prompt in the combined mode. Braces are doubled
+# because the text is part of a ChatPromptTemplate.
+COMBINED_OUTPUT_INSTRUCTIONS = """
+        <|start_header_id|>coach<|end_header_id|>
+        Before you answer, also act as an expert healthcare communication coach and evaluate my latest message.
+        Empathy score: bad (dismissive, insensitive), ok (basic acknowledgment, little emotional connection),
+        good (acknowledges concerns, shows care) or great (validates emotions, highly supportive).
+        Realism: unrealistic (false reassurances, impossible promises, dismissing serious symptoms, medical inaccuracies)
+        or realistic (medically appropriate, honest, evidence-based).
+        Make the feedback specific to your condition and concerns as the patient.
+
+        Respond with only this JSON object and no other text:
+        {{
+            "response": "Your reply as the patient, following every instruction above",
+            "empathy_score": "bad|ok|good|great",
+            "realism_flag": "realistic|unrealistic",
+            "feedback": {{
+                "strengths": ["What I did well"],
+                "areas_for_improvement": ["Specific areas to improve"],
+                "why_realistic": "Why my message is realistic (if realistic)",
+                "why_unrealistic": "Why my message is unrealistic and its consequences for you (if unrealistic)",
+                "improvement_suggestions": ["Specific suggestions"],
+                "alternative_phrasing": "A better way to phrase my message to you"
+            }}
+        }}
+        <|eot_id|>
+        """
+
+def parse_patient_turn(text: str) -> PatientTurn:
+    """
+    Parse and validate the combined output of the patient model.
+
+    Text around the outermost JSON object (e.g. a code fence or a sentence of preamble)
+    is ignored.
+
+    Raises:
+    OutputParserException: If the output is not a valid PatientTurn.
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        raise OutputParserException(f"No JSON object in combined output: {text[:200]}")
+    try:
+        return PatientTurn.model_validate(json.loads(text[start:end + 1]))
+    except (json.JSONDecodeError, ValidationError) as e:
+        raise OutputParserException(f"Invalid combined output: {e}")
+
+def get_empathy_evaluation(turn: PatientTurn) -> dict:
+    """
+    Return the evaluation part of a PatientTurn in the dict shape evaluate_empathy returns.
+    """
+    return turn.model_dump(exclude={"response"}, exclude_none=True)
@@ -1,14 +1,40 @@
+import os
 import logging
-from typing import Optional
+from typing import List, Tuple
 
-import psycopg2
+from sqlalchemy import text
 from langchain_aws import BedrockEmbeddings
 from langchain_postgres import PGVector
+from langchain_core.documents import Document
+
+from db_pool import build_connection_string, get_engine
+from helpers.cache import LRUCache
+from helpers.timing import span
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Warm-container caches shared across invocations
+vectorstore_cache = LRUCache(
+    max_size=int(os.environ.get("VECTORSTORE_CACHE_SIZE", "32")),
+    idle_seconds=float(os.environ.get("VECTORSTORE_CACHE_IDLE_SECONDS", "900")),
+)
+
+# Per-collection chunk/token totals and version stamps recorded by data ingestion
+collection_stats_cache = LRUCache(
+    max_size=int(os.environ.get("VECTORSTORE_CACHE_SIZE", "32")),
+    ttl_seconds=float(os.environ.get("COLLECTION_STATS_TTL_SECONDS", "300")),
+)
+# All chunks of small collections, keyed by (collection_name, version)
+collection_documents_cache = LRUCache(max_size=int(os.environ.get("VECTORSTORE_CACHE_SIZE", "32")))
+
+def get_vectorstore_cache_stats() -> dict:
+    """
+    Return the hit/miss counters of the vector store cache.
+    """
+    return vectorstore_cache.stats()
+
 def get_vectorstore(
     collection_name: str, 
     embeddings: BedrockEmbeddings, 
@@ -17,9 +43,9 @@ def get_vectorstore(
     password: str, 
     host: str, 
     port: int
-) -> Optional[PGVector]:
+) -> Tuple[PGVector, str]:
     """
-    Initialize and return a PGVector instance.
+    Initialize and return a PGVector instance, reusing a cached one when possible.
     
     Args:
     collection_name (str): The name of the collection.
@@ -31,24 +57,96 @@ def get_vectorstore(
     port (int): The database port.
     
     Returns:
-    Optional[PGVector]: The initialized PGVector instance, or None if an error occurred.
+    Tuple[PGVector, str]: The initialized PGVector instance and the connection string it uses.
+
+    Raises:
+    Exception: Any error from building the connection or the vector store, after logging it.
     """
     try:
-        connection_string = (
-            f"postgresql+psycopg://{user}:{password}@{host}:{port}/{dbname}"
+        # The same URL as the metadata queries, so both share one connection pool
+        connection_string = build_connection_string(
+            {"username": user, "password": password, "port": port, "dbname": dbname}, host
         )
 
+        cache_key = (collection_name, connection_string)
+        vectorstore = vectorstore_cache.get(cache_key)
+        if vectorstore is not None:
+            logger.info(f"Reusing cached VectorStore for collection {collection_name}")
+            return vectorstore, connection_string
+
         logger.info("Initializing the VectorStore")
         vectorstore = PGVector(
             embeddings=embeddings,
             collection_name=collection_name,
-            connection=connection_string,
+            connection=get_engine(connection_string),
             use_jsonb=True
         )
+        vectorstore_cache.put(cache_key, vectorstore)
 
-        logger.info("VectorStore initialized")
+        logger.info(f"VectorStore initialized; cache stats: {vectorstore_cache.stats()}")
         return vectorstore, connection_string
 
     except Exception as e:
         logger.error(f"Error initializing vector store: {e}")
-        return None
\ No newline at end of file
+        raise
+
+def get_collection_stats(collection_name: str, connection_string: str) -> dict:
+    """
+    Return the chunk_count, token_count and version that data ingestion recorded for a collection.
+
+    The result is cached for COLLECTION_STATS_TTL_SECONDS, so most turns make no query.
+
+    Args:
+    collection_name (str): The name of the collection.
+    connection_string (str): The SQLAlchemy connection URL.
+
+    Returns:
+    dict: The collection metadata, or an empty dict if the collection has no recorded stats.
+    """
+    stats = collection_stats_cache.get(collection_name)
+    if stats is not None:
+        return stats
+
+    with span("db"), get_engine(connection_string).connect() as conn:
+        row = conn.execute(
+            text("SELECT cmetadata FROM langchain_pg_collection WHERE name = :name"),
+            {"name": collection_name}
+        ).fetchone()
+
+    stats = dict(row[0] or {}) if row else {}
+    collection_stats_cache.put(collection_name, stats)
+    return stats
+
+def get_collection_documents(collection_name: str, connection_string: str, version: str) -> List[Document]:
+    """
+    Load every chunk of a collection, cached per collection version.
+
+    Args:
+    collection_name (str): The name of the collection.
+    connection_string (str): The SQLAlchemy connection URL.
+    version (str): The collection's version stamp; a new version reloads the chunks.
+
+    Returns:
+    List[Document]: All documents stored in the collection.
+    """
+    cache_key = (collection_name, version)
+    documents = collection_documents_cache.get(cache_key)
+    if documents is not None:
+        return documents
+
+    with span("db"), get_engine(connection_string).connect() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT e.document, e.cmetadata
+                FROM langchain_pg_embedding e
+                JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+                WHERE c.name = :name
+                ORDER BY e.id
+            """),
+            {"name": collection_name}
+        ).fetchall()
+
+    documents = [Document(page_content=row[0], metadata=row[1] or {}) for row in rows]
+    collection_documents_cache.put(cache_key, documents)
+    logger.info(f"Loaded {len(documents)} chunks for collection {collection_name}")
+    return documents
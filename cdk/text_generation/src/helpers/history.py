@@ -0,0 +1,478 @@
+import os
+import json
+import logging
+import threading
+from typing import List, Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import (
+    BaseMessage, HumanMessage, AIMessage, get_buffer_string, message_to_dict, messages_from_dict
+)
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+from helpers.clients import get_client
+from helpers.timing import span, run_in_context
+from helpers.policy import call_with_policy
+
+logger = logging.getLogger(__name__)
+
+# How much of the session history is injected into the prompts:
+#   full         - every message (the original behaviour)
+#   last_n       - the last CHAT_HISTORY_LAST_N_TURNS student/patient exchanges
+#   token_budget - as many recent messages as fit in CHAT_HISTORY_TOKEN_BUDGET
+#   summary      - a rolling summary of older turns plus the last N exchanges
+CHAT_HISTORY_STRATEGY = os.environ.get("CHAT_HISTORY_STRATEGY", "full").lower()
+CHAT_HISTORY_LAST_N_TURNS = int(os.environ.get("CHAT_HISTORY_LAST_N_TURNS", "6"))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", "2000"))
+# The summary is only refreshed once this many messages have fallen out of the window
+CHAT_HISTORY_SUMMARY_BATCH = int(os.environ.get("CHAT_HISTORY_SUMMARY_BATCH", "6"))
+# Threads that refresh summaries after the turn's messages are stored
+CHAT_HISTORY_SUMMARY_WORKERS = int(os.environ.get("CHAT_HISTORY_SUMMARY_WORKERS", "2"))
+
+# Where raw messages are stored:
+#   item    - one item per session with an ever-growing History list (the original layout)
+#   message - one item per message in the "<table>-Messages" table, keyed by (SessionId, Seq)
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "item").lower()
+
+dynamodb_client = get_client("dynamodb")
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+summary_executor = ThreadPoolExecutor(max_workers=CHAT_HISTORY_SUMMARY_WORKERS, thread_name_prefix="history-summary")
+# Sessions whose summary is being refreshed, so a session never has two refreshes at once
+summarizing_sessions = set()
+summarizing_lock = threading.Lock()
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimate the number of tokens in text (about four characters per token).
+    """
+    return len(text) // 4 + 1
+
+def get_meta_key(session_id: str) -> dict:
+    """
+    Return the key of the per-session metadata item stored next to the history item.
+    """
+    return {"SessionId": {"S": f"{session_id}#meta"}}
+
+def last_turns(messages: Sequence[BaseMessage], turns: int) -> List[BaseMessage]:
+    """
+    Return the messages of the last `turns` student/patient exchanges.
+    """
+    if turns <= 0:
+        return []
+    window = list(messages[-2 * turns:])
+    # Always start the window on a student message
+    while window and not isinstance(window[0], HumanMessage):
+        window.pop(0)
+    return window
+
+def within_token_budget(messages: Sequence[BaseMessage], budget: int) -> List[BaseMessage]:
+    """
+    Return the most recent messages whose combined size fits in budget tokens.
+    """
+    window = []
+    used = 0
+    for message in reversed(messages):
+        used += estimate_tokens(str(message.content))
+        if used > budget:
+            break
+        window.insert(0, message)
+    while window and not isinstance(window[0], HumanMessage):
+        window.pop(0)
+    return window
+
+def without_empty_reply(messages: Sequence[BaseMessage]) -> List[BaseMessage]:
+    """
+    Drop an exchange whose AI reply is empty.
+
+    RunnableWithMessageHistory stores the student message and the reply after every
+    chain run, including runs the call policy rejects as empty and retries (or a stream
+    that ended without tokens). Only the exchange that produced an answer is kept, so the
+    student message is stored once.
+    """
+    messages = list(messages)
+    if messages and isinstance(messages[-1], AIMessage) and not str(messages[-1].content).strip():
+        logger.info("Not storing an exchange with an empty reply")
+        while messages and not isinstance(messages[-1], HumanMessage):
+            messages.pop()
+        if messages:
+            messages.pop()
+    return messages
+
+def get_message_table_name(table_name: str) -> str:
+    """
+    Return the name of the per-message history table that accompanies table_name.
+    """
+    return f"{table_name}-Messages"
+
+class MessageTableChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history stored as one DynamoDB item per message.
+
+    Items are keyed by SessionId (hash) and Seq (range). Seq 0 is a header item holding
+    the last allocated sequence number, so appends never read or rewrite earlier
+    messages, the last N messages are a single range query, and deleting the last
+    exchange touches only two items. Each item also stays far below the 400 KB item
+    limit that caps the single-list layout.
+    """
+
+    def __init__(self, table_name: str, session_id: str):
+        self.table_name = get_message_table_name(table_name)
+        self.session_id = session_id
+
+    def query(self, limit: int = None, newest_first: bool = False) -> List[dict]:
+        """
+        Return message items for the session in sequence order (or newest first).
+        """
+        kwargs = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "SessionId = :session AND Seq > :header",
+            "ExpressionAttributeValues": {":session": {"S": self.session_id}, ":header": {"N": "0"}},
+            "ScanIndexForward": not newest_first,
+        }
+        if limit:
+            kwargs["Limit"] = limit
+
+        items = []
+        while True:
+            response = dynamodb_client.query(**kwargs)
+            items.extend(response.get("Items", []))
+            if (limit and len(items) >= limit) or "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        return items[:limit] if limit else items
+
+    @staticmethod
+    def to_messages(items: List[dict]) -> List[BaseMessage]:
+        return messages_from_dict([json.loads(item["Message"]["S"]) for item in items])
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.to_messages(self.query())
+
+    def last_messages(self, count: int) -> List[BaseMessage]:
+        """
+        Return the last count messages with one range query.
+        """
+        if count <= 0:
+            return []
+        return self.to_messages(list(reversed(self.query(limit=count, newest_first=True))))
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        messages = without_empty_reply(messages)
+        if not messages:
+            return
+        # Reserve a block of sequence numbers atomically, then write only the new messages
+        response = dynamodb_client.update_item(
+            TableName=self.table_name,
+            Key={"SessionId": {"S": self.session_id}, "Seq": {"N": "0"}},
+            UpdateExpression="ADD LastSeq :count",
+            ExpressionAttributeValues={":count": {"N": str(len(messages))}},
+            ReturnValues="UPDATED_NEW"
+        )
+        last_seq = int(response["Attributes"]["LastSeq"]["N"])
+        first_seq = last_seq - len(messages) + 1
+
+        requests = [
+            {"PutRequest": {"Item": {
+                "SessionId": {"S": self.session_id},
+                "Seq": {"N": str(first_seq + offset)},
+                "Message": {"S": json.dumps(message_to_dict(message))},
+            }}}
+            for offset, message in enumerate(messages)
+        ]
+        self.batch_write(requests)
+
+    def delete_last_exchange(self) -> bool:
+        """
+        Delete the last student and AI messages in one transaction.
+
+        Both deletes require their item to still exist, so a concurrent delete makes the
+        transaction fail instead of removing one message and an older one.
+
+        Returns:
+        bool: False if the session has fewer than two messages or changed concurrently.
+        """
+        items = self.query(limit=2, newest_first=True)
+        if len(items) < 2:
+            return False
+        try:
+            dynamodb_client.transact_write_items(TransactItems=[
+                {"Delete": {
+                    "TableName": self.table_name,
+                    "Key": {"SessionId": item["SessionId"], "Seq": item["Seq"]},
+                    "ConditionExpression": "attribute_exists(Seq)",
+                }}
+                for item in items
+            ])
+        except dynamodb_client.exceptions.TransactionCanceledException:
+            logger.info(f"History for session {self.session_id} changed while deleting the last exchange")
+            return False
+        return True
+
+    def clear(self) -> None:
+        keys = [{"SessionId": item["SessionId"], "Seq": item["Seq"]} for item in self.query()]
+        keys.append({"SessionId": {"S": self.session_id}, "Seq": {"N": "0"}})
+        self.batch_write([{"DeleteRequest": {"Key": key}} for key in keys])
+
+    def batch_write(self, requests: List[dict]) -> None:
+        for start in range(0, len(requests), 25):
+            pending = {self.table_name: requests[start:start + 25]}
+            while pending:
+                response = dynamodb_client.batch_write_item(RequestItems=pending)
+                pending = response.get("UnprocessedItems") or None
+
+class ListItemChatMessageHistory(BaseChatMessageHistory):
+    """
+    The single-item history layout: one item per session holding a History list.
+
+    This reads and writes the same items as langchain_community's
+    DynamoDBChatMessageHistory, without importing langchain_community at cold start.
+    Unlike that class, which reads the whole list and puts the whole item back for every
+    message, new messages are appended with list_append in one UpdateItem, and a
+    MessageCount attribute is kept alongside the list so the last exchange can be
+    removed by index without reading the list (see deleteLastMessage).
+
+    Items written before MessageCount existed are seeded from the length of their list
+    on the first append, so the count always matches the list.
+    """
+
+    def __init__(self, table_name: str, session_id: str):
+        self.table_name = table_name
+        self.session_id = session_id
+        self.key = {"SessionId": {"S": session_id}}
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        try:
+            response = dynamodb_client.get_item(
+                TableName=self.table_name, Key=self.key, ProjectionExpression="History"
+            )
+        except Exception as e:
+            logger.error(f"Error loading chat history for {self.session_id}: {e}")
+            return []
+        history = response.get("Item", {}).get("History")
+        if not history:
+            return []
+        return messages_from_dict(deserializer.deserialize(history))
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        messages = without_empty_reply(messages)
+        if not messages:
+            return
+        new = serializer.serialize([message_to_dict(message) for message in messages])
+        for _ in range(3):
+            try:
+                # New sessions and counted items: append and count in one update
+                dynamodb_client.update_item(
+                    TableName=self.table_name,
+                    Key=self.key,
+                    UpdateExpression=(
+                        "SET History = list_append(if_not_exists(History, :empty), :new), "
+                        "MessageCount = if_not_exists(MessageCount, :zero) + :count"
+                    ),
+                    ConditionExpression="attribute_exists(MessageCount) OR attribute_not_exists(History)",
+                    ExpressionAttributeValues={
+                        ":empty": {"L": []},
+                        ":new": new,
+                        ":zero": {"N": "0"},
+                        ":count": {"N": str(len(messages))},
+                    },
+                    ReturnValuesOnConditionCheckFailure="ALL_OLD",
+                )
+                return
+            except dynamodb_client.exceptions.ConditionalCheckFailedException as e:
+                # A History list without MessageCount: seed the count from the list it was returned with
+                length = len(e.response.get("Item", {}).get("History", {}).get("L", []))
+            try:
+                dynamodb_client.update_item(
+                    TableName=self.table_name,
+                    Key=self.key,
+                    UpdateExpression="SET History = list_append(History, :new), MessageCount = :total",
+                    ConditionExpression="attribute_not_exists(MessageCount) AND size(History) = :length",
+                    ExpressionAttributeValues={
+                        ":new": new,
+                        ":length": {"N": str(length)},
+                        ":total": {"N": str(length + len(messages))},
+                    },
+                )
+                logger.info(f"Seeded MessageCount for session {self.session_id} from {length} stored messages")
+                return
+            except dynamodb_client.exceptions.ConditionalCheckFailedException:
+                # Another writer appended or seeded first; start over
+                continue
+        raise RuntimeError(f"Chat history for session {self.session_id} kept changing while appending")
+
+    def clear(self) -> None:
+        dynamodb_client.delete_item(TableName=self.table_name, Key=self.key)
+
+def get_raw_history(table_name: str, session_id: str) -> BaseChatMessageHistory:
+    """
+    Return the full (unwindowed) chat history for a session in the configured HISTORY_BACKEND.
+    """
+    if HISTORY_BACKEND == "message":
+        return MessageTableChatMessageHistory(table_name, session_id)
+    return ListItemChatMessageHistory(table_name=table_name, session_id=session_id)
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history that stores every message in DynamoDB but only exposes a window of it
+    to the prompts, according to CHAT_HISTORY_STRATEGY.
+
+    The full history is still written to the session's History item, so instructors
+    see the whole conversation. With the summary strategy the rolling summary and the
+    number of messages it covers live in a sibling "<session_id>#meta" item.
+
+    The summary is refreshed in the background after the turn's messages are stored,
+    from the messages this object already loaded for the prompt. A refresh that fails,
+    or is cut short because the container was frozen, is simply retried on a later turn.
+    """
+
+    def __init__(self, table_name: str, session_id: str, llm=None, strategy: str = CHAT_HISTORY_STRATEGY):
+        self.table_name = table_name
+        self.session_id = session_id
+        self.llm = llm
+        self.strategy = strategy
+        self.raw_history = get_raw_history(table_name, session_id)
+        # The messages and summary read by load_window, reused to refresh the summary
+        self.loaded_messages = None
+        self.loaded_summary = None
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        with span("history"):
+            return self.load_window()
+
+    def load_window(self) -> List[BaseMessage]:
+        if self.strategy == "last_n" and isinstance(self.raw_history, MessageTableChatMessageHistory):
+            # The per-message layout can fetch just the window instead of the whole session
+            messages = self.raw_history.last_messages(2 * CHAT_HISTORY_LAST_N_TURNS)
+        else:
+            messages = self.raw_history.messages
+
+        if self.strategy == "last_n":
+            window = last_turns(messages, CHAT_HISTORY_LAST_N_TURNS)
+        elif self.strategy == "token_budget":
+            window = within_token_budget(messages, CHAT_HISTORY_TOKEN_BUDGET)
+        elif self.strategy == "summary":
+            summary, summarized_count = self.get_summary()
+            self.loaded_messages, self.loaded_summary = list(messages), (summary, summarized_count)
+            window = list(messages[summarized_count:])
+            if summary:
+                window = [
+                    HumanMessage(content=f"Summary of our conversation so far: {summary}"),
+                    AIMessage(content="Okay."),
+                ] + window
+        else:
+            window = list(messages)
+
+        logger.info(f"Chat history window ({self.strategy}): {len(window)} of {len(messages)} messages, "
+                    f"~{sum(estimate_tokens(str(m.content)) for m in window)} tokens")
+        return window
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        with span("history"):
+            self.raw_history.add_messages(messages)
+        if self.strategy == "summary" and self.llm is not None:
+            self.schedule_summary(without_empty_reply(messages))
+
+    def schedule_summary(self, new_messages: List[BaseMessage]) -> None:
+        """
+        Refresh the rolling summary in a background thread, unless one is already running for the session.
+        """
+        with summarizing_lock:
+            if self.session_id in summarizing_sessions:
+                return
+            summarizing_sessions.add(self.session_id)
+        messages = None if self.loaded_messages is None else self.loaded_messages + new_messages
+        try:
+            summary_executor.submit(run_in_context(self.update_summary), messages, self.loaded_summary)
+        except Exception as e:
+            logger.error(f"Error scheduling history summary for session {self.session_id}: {e}")
+            with summarizing_lock:
+                summarizing_sessions.discard(self.session_id)
+
+    def clear(self) -> None:
+        self.raw_history.clear()
+        dynamodb_client.delete_item(TableName=self.table_name, Key=get_meta_key(self.session_id))
+
+    def get_summary(self) -> tuple:
+        """
+        Return the stored rolling summary and the number of messages it covers.
+        """
+        try:
+            response = dynamodb_client.get_item(
+                TableName=self.table_name,
+                Key=get_meta_key(self.session_id),
+                ProjectionExpression="Summary, SummarizedCount"
+            )
+        except Exception as e:
+            logger.error(f"Error fetching history summary for session {self.session_id}: {e}")
+            return "", 0
+        item = response.get("Item", {})
+        return item.get("Summary", {}).get("S", ""), int(item.get("SummarizedCount", {}).get("N", "0"))
+
+    def update_summary(self, messages: List[BaseMessage] = None, stored_summary: tuple = None) -> None:
+        """
+        Fold messages that have left the last-N window into the rolling summary.
+
+        Only runs once at least CHAT_HISTORY_SUMMARY_BATCH messages are waiting, so most
+        turns pay nothing for it. Only those messages are sent to the model, together
+        with the current summary.
+
+        Args:
+        messages (List[BaseMessage], optional): Every message of the session. Read from the table if not given.
+        stored_summary (tuple, optional): The stored (summary, summarized_count). Read from the meta item if not given.
+        """
+        try:
+            if messages is None:
+                messages = self.raw_history.messages
+            summary, summarized_count = stored_summary or self.get_summary()
+            keep = len(last_turns(messages, CHAT_HISTORY_LAST_N_TURNS))
+            cutoff = len(messages) - keep
+            if cutoff - summarized_count < CHAT_HISTORY_SUMMARY_BATCH:
+                return
+
+            new_lines = get_buffer_string(messages[summarized_count:cutoff], human_prefix="Student", ai_prefix="Patient")
+            prompt = (
+                "Progressively summarize this conversation between a pharmacy student and a mock patient, "
+                "adding the new lines to the current summary. Keep every symptom, medication, diagnosis and "
+                "question that has come up. Return only the new summary.\n\n"
+                f"Current summary:\n{summary or 'None'}\n\nNew lines:\n{new_lines}\n\nNew summary:"
+            )
+            new_summary = call_with_policy(
+                "summary", self.llm.invoke, args=(prompt,), hedge=True, model_id=getattr(self.llm, "model_id", None)
+            ).content
+            dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key=get_meta_key(self.session_id),
+                UpdateExpression="SET Summary = :summary, SummarizedCount = :count",
+                ExpressionAttributeValues={
+                    ":summary": {"S": new_summary},
+                    ":count": {"N": str(cutoff)},
+                }
+            )
+            logger.info(f"Updated history summary for session {self.session_id}: {cutoff} messages summarized")
+        except Exception as e:
+            logger.error(f"Error updating history summary for session {self.session_id}: {e}")
+        finally:
+            with summarizing_lock:
+                summarizing_sessions.discard(self.session_id)
+
+def get_chat_history(table_name: str, session_id: str, llm=None) -> BaseChatMessageHistory:
+    """
+    Return the chat history object used by RunnableWithMessageHistory.
+
+    Args:
+    table_name (str): The DynamoDB table name used to store the chat history.
+    session_id (str): The unique identifier for the chat session.
+    llm: The language model used to update the rolling summary.
+
+    Returns:
+    BaseChatMessageHistory: The raw history for the "full" strategy, otherwise a windowed view of it.
+    """
+    if CHAT_HISTORY_STRATEGY == "full":
+        return get_raw_history(table_name, session_id)
+    return WindowedChatMessageHistory(table_name, session_id, llm=llm, strategy=CHAT_HISTORY_STRATEGY)
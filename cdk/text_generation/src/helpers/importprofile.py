@@ -0,0 +1,71 @@
+import sys
+import json
+import time
+import logging
+import builtins
+
+logger = logging.getLogger(__name__)
+
+class ImportProfiler:
+    """
+    Measure how long each module takes to import while the profiler is running.
+
+    Every import that actually loads a module (i.e. is not already in sys.modules) is
+    timed. Nested imports are tracked on a stack, so each module reports both its
+    cumulative time and its self time with its dependencies' imports subtracted.
+    Relative imports are not timed separately and count towards the importing module.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.stack = []
+        self.original_import = None
+        self.started = None
+        self.elapsed = None
+
+    def start(self) -> "ImportProfiler":
+        self.original_import = builtins.__import__
+        self.started = time.perf_counter()
+        builtins.__import__ = self.timed_import
+        return self
+
+    def stop(self) -> None:
+        builtins.__import__ = self.original_import
+        self.elapsed = time.perf_counter() - self.started
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += cumulative
+            if name not in self.timings:
+                self.timings[name] = {"cumulative_ms": cumulative * 1000, "self_ms": (cumulative - children) * 1000}
+
+    def report(self, top: int = 25) -> dict:
+        """
+        Log the slowest imports as one JSON line and return the breakdown.
+
+        Args:
+        top (int): How many modules to include, ordered by self time.
+
+        Returns:
+        dict: Total import time and the per-module breakdown.
+        """
+        modules = sorted(self.timings.items(), key=lambda item: item[1]["self_ms"], reverse=True)[:top]
+        breakdown = {
+            "import_total_ms": round(self.elapsed * 1000, 1),
+            "modules": [
+                {"module": name, "self_ms": round(t["self_ms"], 1), "cumulative_ms": round(t["cumulative_ms"], 1)}
+                for name, t in modules
+            ],
+        }
+        logger.info(f"Import profile: {json.dumps(breakdown)}")
+        return breakdown
@@ -0,0 +1,100 @@
+"""
+CloudWatch Embedded Metric Format (EMF) records for chat turns.
+
+One JSON line is written to stdout per invocation. In Lambda, CloudWatch Logs turns the
+line into metrics without any PutMetricData calls; anywhere else (tests, the local
+server) it is just a line of output that can be parsed and checked.
+"""
+import os
+import sys
+import json
+import time
+import logging
+
+from helpers.usage import get_turn_usage
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "EmpatheticCommunication/TextGeneration")
+
+# Spans reported for every turn, even when they took no time, so dashboards line up
+TURN_STAGES = ("config", "db", "history", "rewrite", "retrieval", "generation", "empathy", "naming")
+
+USAGE_UNITS = {"input_tokens": "Count", "output_tokens": "Count", "model_calls": "Count", "cost_usd": "None"}
+
+def build_emf_record(metrics: dict, dimensions: dict, units: dict = None, properties: dict = None) -> dict:
+    """
+    Build an EMF record.
+
+    Args:
+    metrics (dict): Metric name to value.
+    dimensions (dict): Dimension name to value; all of them form a single dimension set.
+    units (dict, optional): Metric name to CloudWatch unit. Defaults to Milliseconds.
+    properties (dict, optional): Extra fields to log alongside the metrics (not metrics themselves).
+
+    Returns:
+    dict: The record, ready to be serialized as one JSON line.
+    """
+    units = units or {}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": units.get(name, "Milliseconds")} for name in metrics],
+            }],
+        },
+    }
+    record.update(properties or {})
+    record.update({name: str(value) for name, value in dimensions.items()})
+    record.update(metrics)
+    return record
+
+def emit_metrics(metrics: dict, dimensions: dict, units: dict = None, properties: dict = None, stream=None) -> dict:
+    """
+    Write an EMF record as one line to stdout (or stream).
+
+    print is used rather than the logger: the Lambda log formatter prefixes every line,
+    and CloudWatch only extracts metrics from lines that are pure JSON.
+
+    Returns:
+    dict: The record that was written, or None if metrics are disabled.
+    """
+    if not METRICS_ENABLED:
+        return None
+    record = build_emf_record(metrics, dimensions, units, properties)
+    try:
+        print(json.dumps(record), file=stream or sys.stdout, flush=True)
+    except Exception as e:
+        logger.error(f"Error writing metrics: {e}")
+    return record
+
+def emit_turn_metrics(timer, simulation_group_id: str, model_id: str, stream=None) -> dict:
+    """
+    Emit the per-stage latency breakdown of a turn from its StageTimer spans, together
+    with the tokens and cost of the model calls it made.
+
+    Args:
+    timer (StageTimer): The turn's timer.
+    simulation_group_id (str): The simulation group the turn belongs to.
+    model_id (str): The Bedrock model that played the patient.
+    stream (optional): Where to write the record. Defaults to stdout.
+
+    Returns:
+    dict: The record that was written.
+    """
+    spans = timer.span_totals()
+    metrics = {f"{stage}_ms": spans.get(stage, 0.0) for stage in TURN_STAGES}
+    metrics.update({f"{name}_ms": ms for name, ms in spans.items() if name not in TURN_STAGES})
+    metrics["turn_ms"] = timer.summary()["wall_ms"]
+    metrics.update(get_turn_usage(timer))
+    return emit_metrics(
+        metrics,
+        {"SimulationGroupId": simulation_group_id or "unknown", "ModelId": model_id or "unknown"},
+        units=USAGE_UNITS,
+        # The individual calls are logged for Logs Insights queries, not published as metrics
+        properties={"calls": timer.model_calls_snapshot()},
+        stream=stream,
+    )
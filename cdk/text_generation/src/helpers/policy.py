@@ -0,0 +1,330 @@
+"""
+Deadline-aware call policy for Bedrock invocations.
+
+Every model call made through call_with_policy:
+
+- stops retrying once the request's deadline has passed. The Lambda handler sets the
+  deadline from context.get_remaining_time_in_millis(); the server uses a fixed budget.
+- retries throttling and transient service errors with capped exponential backoff and
+  full jitter, never sleeping past the deadline.
+- optionally sends a hedged second request when the first one is slower than the
+  BEDROCK_HEDGE_PERCENTILE latency seen recently for that call. Only idempotent calls
+  (the empathy evaluation, question rewrite and session naming) are hedged; the patient
+  reply writes chat history and is never sent twice.
+- takes a token from the simulation group's rate limit bucket for the model before every
+  attempt (see helpers/ratelimit.py), and fails with RateLimitExceeded if none is
+  available before the deadline.
+- goes through a per-call circuit breaker. After BEDROCK_BREAKER_THRESHOLD consecutive
+  failures the call fails fast with CircuitOpenError for BEDROCK_BREAKER_COOLDOWN_SECONDS,
+  so callers can degrade (e.g. skip the empathy coach) instead of waiting on a struggling model.
+
+Worker threads cannot be interrupted, so a call abandoned at its deadline finishes in the
+background and its result is discarded.
+
+A call made from inside another policed call (e.g. the question rewrite, which runs in the
+retriever while the patient reply is generated on a policy worker) keeps its retries,
+breaker and rate limit but runs its attempts inline on that worker. Submitting it to the
+same bounded executor could otherwise deadlock once every worker waits on a nested call.
+"""
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from contextvars import ContextVar
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from helpers.timing import run_in_context
+from helpers import ratelimit
+
+logger = logging.getLogger(__name__)
+
+BEDROCK_MAX_ATTEMPTS = int(os.environ.get("BEDROCK_MAX_ATTEMPTS", "4"))
+BEDROCK_BACKOFF_BASE_SECONDS = float(os.environ.get("BEDROCK_BACKOFF_BASE_SECONDS", "0.5"))
+BEDROCK_BACKOFF_CAP_SECONDS = float(os.environ.get("BEDROCK_BACKOFF_CAP_SECONDS", "8"))
+
+# Hedging is off unless enabled; the delay is learned from the latencies of recent calls
+BEDROCK_HEDGE = os.environ.get("BEDROCK_HEDGE", "false").lower() == "true"
+BEDROCK_HEDGE_PERCENTILE = float(os.environ.get("BEDROCK_HEDGE_PERCENTILE", "0.95"))
+BEDROCK_HEDGE_MIN_SAMPLES = int(os.environ.get("BEDROCK_HEDGE_MIN_SAMPLES", "20"))
+
+BEDROCK_BREAKER_THRESHOLD = int(os.environ.get("BEDROCK_BREAKER_THRESHOLD", "5"))
+BEDROCK_BREAKER_COOLDOWN_SECONDS = float(os.environ.get("BEDROCK_BREAKER_COOLDOWN_SECONDS", "30"))
+
+# Time kept back from the Lambda timeout to return an error response and flush metrics
+DEADLINE_MARGIN_SECONDS = float(os.environ.get("DEADLINE_MARGIN_SECONDS", "5"))
+# Budget for requests without a Lambda context, e.g. in the long-running server
+DEFAULT_DEADLINE_SECONDS = float(os.environ.get("DEFAULT_DEADLINE_SECONDS", "120"))
+
+# Error codes worth retrying; LangChain re-raises ClientErrors as ValueErrors, so the
+# codes are also looked for in the error message
+RETRYABLE_ERROR_CODES = (
+    "ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+    "ModelNotReadyException", "InternalServerException", "ModelTimeoutException",
+)
+
+# monotonic time by which the current request must be answered
+current_deadline = ContextVar("current_deadline", default=None)
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BEDROCK_POLICY_WORKERS", "16")), thread_name_prefix="bedrock-call"
+)
+# Marks the executor's threads while they run an attempt
+worker_state = threading.local()
+
+class ModelCallError(Exception):
+    """
+    A model call did not produce an acceptable result within its policy.
+    """
+
+class DeadlineExceeded(ModelCallError):
+    pass
+
+class CircuitOpenError(ModelCallError):
+    pass
+
+class RateLimitExceeded(ModelCallError):
+    pass
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker with a single trial call after the cooldown.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < BEDROCK_BREAKER_COOLDOWN_SECONDS or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit for {self.name} closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= BEDROCK_BREAKER_THRESHOLD:
+                if self.opened_at is None:
+                    logger.warning(f"Circuit for {self.name} opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+    def release_trial(self) -> None:
+        """
+        Give up a trial call that was never made, so another caller may try.
+        """
+        with self.lock:
+            self.trial_in_flight = False
+
+    def state(self) -> str:
+        with self.lock:
+            return "closed" if self.opened_at is None else "open"
+
+breakers = {}
+# Recent successful latencies per call name, for the hedging delay
+latencies = {}
+registry_lock = threading.Lock()
+
+def get_breaker(name: str) -> CircuitBreaker:
+    with registry_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name)
+        return breakers[name]
+
+def get_breaker_states() -> dict:
+    """
+    Return the state of every circuit breaker, for logging.
+    """
+    with registry_lock:
+        return {name: breaker.state() for name, breaker in breakers.items()}
+
+def record_latency(name: str, seconds: float) -> None:
+    with registry_lock:
+        latencies.setdefault(name, deque(maxlen=200)).append(seconds)
+
+def get_hedge_delay(name: str):
+    """
+    Return how long to wait before hedging a call, or None without enough samples.
+    """
+    with registry_lock:
+        samples = sorted(latencies.get(name, ()))
+    if len(samples) < BEDROCK_HEDGE_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(BEDROCK_HEDGE_PERCENTILE * len(samples)))]
+
+@contextmanager
+def request_deadline(context=None):
+    """
+    Set the deadline for every call_with_policy made in the body of a with block.
+
+    Args:
+    context: The Lambda context. Without one, DEFAULT_DEADLINE_SECONDS is used.
+    """
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        budget = context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
+    else:
+        budget = DEFAULT_DEADLINE_SECONDS
+    token = current_deadline.set(time.monotonic() + max(0.0, budget))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+def time_left(timeout: float = None) -> float:
+    """
+    Return the seconds left before the request deadline (or timeout, if sooner).
+    """
+    deadline = current_deadline.get()
+    left = deadline - time.monotonic() if deadline is not None else DEFAULT_DEADLINE_SECONDS
+    return left if timeout is None else min(left, timeout)
+
+def is_retryable(error: Exception) -> bool:
+    response = getattr(error, "response", None)
+    code = response.get("Error", {}).get("Code") if isinstance(response, dict) else None
+    if code:
+        return code in RETRYABLE_ERROR_CODES
+    message = str(error)
+    return any(code in message for code in RETRYABLE_ERROR_CODES)
+
+def on_policy_worker() -> bool:
+    """
+    Return whether the current thread is running an attempt for call_with_policy.
+    """
+    return getattr(worker_state, "active", False)
+
+def as_worker(func):
+    """
+    Wrap func so the policy worker running it is marked for nested calls.
+    """
+    def run(*args, **kwargs):
+        worker_state.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            worker_state.active = False
+    return run
+
+def run_attempt(name: str, func, args: tuple, kwargs: dict, budget: float, hedge: bool, model_id: str = None):
+    """
+    Run one attempt in worker threads, hedging it if allowed, and return the first result.
+
+    On a policy worker the attempt runs inline, unhedged, and the budget is only checked
+    once it returns.
+
+    Raises:
+    DeadlineExceeded: If no attempt finished within budget seconds.
+    Exception: The error of the last attempt to fail, if every attempt failed.
+    """
+    start = time.monotonic()
+    if on_policy_worker():
+        result = func(*args, **kwargs)
+        elapsed = time.monotonic() - start
+        if elapsed > budget:
+            raise DeadlineExceeded(f"{name} call did not finish within {budget:.1f}s")
+        record_latency(name, elapsed)
+        return result
+
+    pending = {executor.submit(as_worker(run_in_context(func)), *args, **kwargs)}
+    hedge_delay = get_hedge_delay(name) if hedge and BEDROCK_HEDGE else None
+    if hedge_delay is not None and hedge_delay < budget:
+        done, _ = wait(pending, timeout=hedge_delay)
+        # A hedge is only sent if the rate limiter has a token to spare right now
+        if not done and ratelimit.acquire(model_id, 0):
+            logger.info(f"Hedging {name} call after {hedge_delay:.2f}s")
+            pending.add(executor.submit(as_worker(run_in_context(func)), *args, **kwargs))
+
+    error = None
+    while pending:
+        remaining = budget - (time.monotonic() - start)
+        done, pending = wait(pending, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                record_latency(name, time.monotonic() - start)
+                return future.result()
+            error = future.exception()
+    if error is not None and not pending:
+        raise error
+    raise DeadlineExceeded(f"{name} call did not finish within {budget:.1f}s")
+
+def call_with_policy(name: str, func, args: tuple = (), kwargs: dict = None, timeout: float = None,
+                     hedge: bool = False, accept=None, model_id: str = None):
+    """
+    Call a model under the deadline, retry, hedging and circuit breaker policy.
+
+    Args:
+    name (str): The kind of call, e.g. "generation" or "empathy". Breakers and latency
+    statistics are kept per name.
+    func (callable): The blocking call.
+    args (tuple, optional): Positional arguments for func.
+    kwargs (dict, optional): Keyword arguments for func.
+    timeout (float, optional): A per-call budget, applied on top of the request deadline.
+    hedge (bool, optional): Whether func is idempotent and may be sent twice.
+    accept (callable, optional): Returns False for results that should be retried (e.g. empty answers).
+    model_id (str, optional): The model func calls, for rate limiting. Calls without one are not limited.
+
+    Returns:
+    The result of func.
+
+    Raises:
+    CircuitOpenError: If the breaker for name is open.
+    RateLimitExceeded: If the rate limiter had no token for the model before the deadline.
+    DeadlineExceeded: If the deadline (or timeout) passed first.
+    ModelCallError: If every attempt returned an unacceptable result.
+    Exception: The last error, if it was not retryable or attempts ran out.
+    """
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit for {name} is open")
+
+    started = time.monotonic()
+    budget = lambda: time_left(None if timeout is None else timeout - (time.monotonic() - started))
+    for attempt in range(BEDROCK_MAX_ATTEMPTS):
+        if budget() <= 0:
+            breaker.record_failure()
+            raise DeadlineExceeded(f"No time left for {name} call")
+        if not ratelimit.acquire(model_id, budget()):
+            breaker.release_trial()
+            raise RateLimitExceeded(f"No capacity for {name} call to {model_id} before the deadline")
+        if budget() <= 0:
+            breaker.release_trial()
+            raise DeadlineExceeded(f"No time left for {name} call after waiting for capacity")
+        try:
+            result = run_attempt(name, func, args, kwargs or {}, budget(), hedge, model_id)
+        except DeadlineExceeded:
+            breaker.record_failure()
+            raise
+        except Exception as e:
+            if not is_retryable(e) or attempt == BEDROCK_MAX_ATTEMPTS - 1:
+                breaker.record_failure()
+                raise
+            delay = min(random.uniform(0, min(BEDROCK_BACKOFF_CAP_SECONDS, BEDROCK_BACKOFF_BASE_SECONDS * 2 ** attempt)), budget())
+            logger.warning(f"{name} call throttled or unavailable ({e}); retrying in {delay:.2f}s")
+            time.sleep(max(0.0, delay))
+            continue
+
+        if accept is None or accept(result):
+            breaker.record_success()
+            return result
+        logger.warning(f"{name} call returned an unusable result on attempt {attempt + 1}; retrying")
+
+    breaker.record_failure()
+    raise ModelCallError(f"{name} call returned no usable result in {BEDROCK_MAX_ATTEMPTS} attempts")
@@ -0,0 +1,237 @@
+"""
+Shared rate limiting of Bedrock calls per simulation group and model.
+
+When a whole class starts the same simulation at once, every container calls Bedrock at
+the same moment and the resulting throttling slows everyone down. Instead, each call
+first reserves capacity in a token bucket keyed by (simulation group, model) that is
+refilled every RATE_LIMIT_WINDOW_SECONDS with RATE_LIMIT_PER_SECOND * window tokens.
+
+Each bucket is a ticket counter. Ticket n belongs to window n // capacity (windows are
+numbered from the epoch), so taking a ticket also says which window the caller was given
+and, if that window is in the future, how long to sleep until it starts. Earlier callers
+therefore get earlier windows (fair, first-come first-served queuing), and a caller gives
+up without calling Bedrock when the first free window starts after its request deadline.
+A counter that has fallen behind the current window is moved up to it, since capacity
+left unused in past windows cannot be spent any more.
+
+Backends (RATE_LIMIT_BACKEND):
+    off      - no limiting (the default)
+    local    - in-process buckets, for the long-running server, tests and simulations
+    dynamodb - one atomic counter item per bucket in the "<table>-RateLimits" table,
+               shared by every container
+"""
+import os
+import time
+import logging
+import threading
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "off").lower()
+# Bedrock calls per second allowed for each (simulation group, model)
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", "5"))
+RATE_LIMIT_WINDOW_SECONDS = float(os.environ.get("RATE_LIMIT_WINDOW_SECONDS", "1"))
+# Conditional writes a DynamoDB reservation may make while other containers race it
+RATE_LIMIT_MAX_ATTEMPTS = int(os.environ.get("RATE_LIMIT_MAX_ATTEMPTS", "3"))
+
+# The simulation group of the request being served, set with rate_limit_scope
+current_group = ContextVar("rate_limit_group", default=None)
+
+# The configured limiter, or None when limiting is off
+limiter = None
+
+def get_rate_limit_table_name(table_name: str) -> str:
+    """
+    Return the name of the rate limit table that accompanies table_name.
+    """
+    return f"{table_name}-RateLimits"
+
+def get_ticket_range(now: float, max_wait: float, window: float, capacity: int) -> Tuple[int, int]:
+    """
+    Return the tickets a caller at time now may take: from the first ticket of the current
+    window up to, but excluding, the first ticket of the first window starting after max_wait.
+    """
+    floor = int(now // window) * capacity
+    limit = (int((now + max_wait) // window) + 1) * capacity
+    return floor, limit
+
+def get_ticket_delay(ticket: int, now: float, window: float, capacity: int) -> float:
+    """
+    Return the seconds to wait before the window that ticket belongs to starts.
+    """
+    return max(0.0, (ticket // capacity) * window - now)
+
+class LocalRateLimiter:
+    """
+    In-process token buckets with the same ticket scheme as DynamoDBRateLimiter.
+    """
+
+    def __init__(self, rate: float = RATE_LIMIT_PER_SECOND, window: float = RATE_LIMIT_WINDOW_SECONDS):
+        self.window = window
+        self.capacity = max(1, int(rate * window))
+        self.tickets = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, key: tuple, max_wait: float) -> Optional[float]:
+        """
+        Take a token from the earliest window that has one.
+
+        Returns:
+        float: Seconds to wait before the reserved window starts, or None if no window
+        starting within max_wait has a token left.
+        """
+        now = time.time()
+        floor, limit = get_ticket_range(now, max_wait, self.window, self.capacity)
+        with self.lock:
+            ticket = max(self.tickets.get(key, 0), floor)
+            if ticket >= limit:
+                return None
+            self.tickets[key] = ticket + 1
+        return get_ticket_delay(ticket, now, self.window, self.capacity)
+
+class DynamoDBRateLimiter:
+    """
+    Token buckets shared by every container, one DynamoDB counter item per bucket.
+
+    A token is normally taken with a single conditional ADD on the bucket's counter, so
+    there is no read-modify-write race between containers and no per-window probing. Only
+    a counter that has fallen behind the current window needs a second write, to move it
+    up; that write is conditional too, and a caller retries at most
+    RATE_LIMIT_MAX_ATTEMPTS times when other containers move the counter first.
+    """
+
+    def __init__(self, table_name: str, rate: float = RATE_LIMIT_PER_SECOND, window: float = RATE_LIMIT_WINDOW_SECONDS):
+        from helpers.clients import get_client
+
+        self.table_name = table_name
+        self.window = window
+        self.capacity = max(1, int(rate * window))
+        self.client = get_client("dynamodb")
+
+    def update(self, key: tuple, update_expression: str, condition: str, values: dict) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Apply a conditional update to a bucket's counter, also setting its ExpiresAt (:expires).
+
+        Returns:
+        tuple: The counter after the update and None, or None and the counter that failed
+        the condition (None if the bucket has no counter yet).
+        """
+        try:
+            response = self.client.update_item(
+                TableName=self.table_name,
+                Key={"BucketId": {"S": f"{key[0]}#{key[1]}"}},
+                UpdateExpression=update_expression,
+                ConditionExpression=condition,
+                ExpressionAttributeValues={
+                    **values,
+                    # Idle buckets are only worth keeping for a while; TTL removes them
+                    ":expires": {"N": str(int(time.time()) + 3600)},
+                },
+                ReturnValues="UPDATED_NEW",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+            return int(response["Attributes"]["Tickets"]["N"]), None
+        except self.client.exceptions.ConditionalCheckFailedException as e:
+            tickets = e.response.get("Item", {}).get("Tickets")
+            return None, int(tickets["N"]) if tickets else None
+
+    def reserve(self, key: tuple, max_wait: float) -> Optional[float]:
+        """
+        Take a token from the earliest window that has one (see LocalRateLimiter.reserve).
+        """
+        now = time.time()
+        floor, limit = get_ticket_range(now, max_wait, self.window, self.capacity)
+        for _ in range(RATE_LIMIT_MAX_ATTEMPTS):
+            tickets, current = self.update(
+                key, "ADD Tickets :one SET ExpiresAt = :expires", "Tickets >= :floor AND Tickets < :limit",
+                {":one": {"N": "1"}, ":floor": {"N": str(floor)}, ":limit": {"N": str(limit)}},
+            )
+            if tickets is None and current is not None and current >= limit:
+                return None
+            if tickets is None:
+                # No counter yet, or one left behind in a past window: move it to this window
+                tickets, current = self.update(
+                    key, "SET Tickets = :next, ExpiresAt = :expires", "attribute_not_exists(Tickets) OR Tickets < :floor",
+                    {":next": {"N": str(floor + 1)}, ":floor": {"N": str(floor)}},
+                )
+            if tickets is not None:
+                return get_ticket_delay(tickets - 1, now, self.window, self.capacity)
+        logger.warning(f"Gave up reserving a rate limit token for {key} after {RATE_LIMIT_MAX_ATTEMPTS} attempts")
+        return None
+
+def configure_rate_limiter(table_name: str = None, ensure_table=None) -> None:
+    """
+    Build the limiter selected by RATE_LIMIT_BACKEND, once per container.
+
+    Args:
+    table_name (str, optional): The chat history table; the dynamodb backend uses a companion table.
+    ensure_table (callable, optional): chat.ensure_table, used to create the companion table.
+    """
+    global limiter
+    if limiter is not None or RATE_LIMIT_BACKEND == "off":
+        return
+    if RATE_LIMIT_BACKEND == "local":
+        limiter = LocalRateLimiter()
+    elif RATE_LIMIT_BACKEND == "dynamodb":
+        rate_table = get_rate_limit_table_name(table_name)
+        ensure_table(
+            rate_table,
+            key_schema=[{"AttributeName": "BucketId", "KeyType": "HASH"}],
+            attribute_definitions=[{"AttributeName": "BucketId", "AttributeType": "S"}],
+        )
+        rate_limiter = DynamoDBRateLimiter(rate_table)
+        try:
+            rate_limiter.client.update_time_to_live(
+                TableName=rate_table,
+                TimeToLiveSpecification={"Enabled": True, "AttributeName": "ExpiresAt"},
+            )
+        except Exception as e:
+            # Already enabled, or enabled by another container
+            logger.debug(f"Not updating TTL of {rate_table}: {e}")
+        limiter = rate_limiter
+    else:
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {RATE_LIMIT_BACKEND}")
+    logger.info(f"Rate limiting Bedrock calls ({RATE_LIMIT_BACKEND}): {RATE_LIMIT_PER_SECOND}/s per simulation group and model")
+
+@contextmanager
+def rate_limit_scope(simulation_group_id: str):
+    """
+    Charge Bedrock calls made in the body of a with block to a simulation group.
+    """
+    token = current_group.set(simulation_group_id or None)
+    try:
+        yield
+    finally:
+        current_group.reset(token)
+
+def acquire(model_id: str, max_wait: float) -> bool:
+    """
+    Wait for a token for model_id in the current simulation group's bucket.
+
+    Args:
+    model_id (str): The Bedrock model about to be called.
+    max_wait (float): The longest the caller can wait, e.g. the time left before its deadline.
+
+    Returns:
+    bool: True once the call may proceed, False if no token is available within max_wait.
+    Always True when limiting is off or no simulation group is in scope.
+    """
+    group = current_group.get()
+    if limiter is None or group is None or not model_id:
+        return True
+    try:
+        delay = limiter.reserve((group, model_id), max_wait)
+    except Exception as e:
+        # The limiter protects Bedrock; being unable to reach it should not fail the turn
+        logger.error(f"Error reserving rate limit token: {e}")
+        return True
+    if delay is None:
+        logger.warning(f"No Bedrock capacity for {model_id} in simulation group {group} within {max_wait:.1f}s")
+        return False
+    if delay > 0:
+        logger.info(f"Rate limited: waiting {delay:.2f}s for {model_id} in simulation group {group}")
+        time.sleep(delay)
+    return True
@@ -0,0 +1,136 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from array import array
+from contextvars import ContextVar
+from typing import Any, List
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+
+from helpers.cache import LRUCache
+from helpers.helper import get_collection_stats
+from helpers.history import estimate_tokens
+from helpers.usage import record_model_call
+
+logger = logging.getLogger(__name__)
+
+# Level 1: normalized query text -> embedding
+embedding_cache = LRUCache(max_size=int(os.environ.get("EMBEDDING_CACHE_SIZE", "2048")))
+# Level 2: (collection, version, embedding hash, k) -> retrieved documents
+retrieval_cache = LRUCache(max_size=int(os.environ.get("RETRIEVAL_CACHE_SIZE", "1024")))
+
+# Per-turn counters, reset by the Lambda handler and the server at the start of each turn.
+# Context-local, so concurrent turns in the server each count their own lookups.
+invocation_stats = ContextVar("invocation_stats", default=None)
+invocation_stats_lock = threading.Lock()
+
+def reset_invocation_stats() -> None:
+    """
+    Start a fresh set of cache counters for the turn running in this context.
+    """
+    invocation_stats.set({
+        "embedding_hits": 0, "embedding_misses": 0, "embedding_seconds": 0.0,
+        "retrieval_hits": 0, "retrieval_misses": 0, "retrieval_seconds": 0.0,
+    })
+
+def get_invocation_stats() -> dict:
+    """
+    Return this turn's embedding and retrieval cache counters and latencies.
+    """
+    stats = invocation_stats.get()
+    with invocation_stats_lock:
+        return dict(stats or {})
+
+def record(level: str, hit: bool, elapsed: float) -> None:
+    stats = invocation_stats.get()
+    if stats is None:
+        return
+    with invocation_stats_lock:
+        stats[f"{level}_{'hits' if hit else 'misses'}"] += 1
+        stats[f"{level}_seconds"] += elapsed
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a query so trivially different phrasings share a cache entry.
+    """
+    text = query.strip().lower()
+    if text.startswith("user"):
+        text = text[len("user"):]
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.strip(" ?!.")
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model and caches query embeddings by normalized query text.
+
+    Document embeddings are passed straight through; only embed_query is cached.
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        start = time.perf_counter()
+        key = normalize_query(text)
+        embedding = embedding_cache.get(key)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(text)
+            embedding_cache.put(key, embedding)
+            elapsed = time.perf_counter() - start
+            record("embedding", False, elapsed)
+            # BedrockEmbeddings does not return the token count, so it is estimated
+            record_model_call(
+                getattr(self.embeddings, "model_id", "unknown"), estimate_tokens(text), 0, elapsed, call="embedding"
+            )
+        else:
+            record("embedding", True, time.perf_counter() - start)
+        return embedding
+
+class CachingRetriever(BaseRetriever):
+    """
+    Vector store retriever that caches search results per collection version.
+
+    Results are keyed by (collection, version, query embedding hash, k). The version
+    stamp is written by data ingestion whenever a collection changes, so stale results
+    are never served once the collection stats cache has refreshed (at most
+    COLLECTION_STATS_TTL_SECONDS after the change). Entries of old versions are no
+    longer hit and age out of the LRU.
+    """
+    vectorstore: Any
+    collection_name: str
+    connection_string: str
+    k: int = 4
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        embedding = self.vectorstore.embeddings.embed_query(query)
+
+        start = time.perf_counter()
+        try:
+            version = get_collection_stats(self.collection_name, self.connection_string).get("version")
+        except Exception as e:
+            logger.error(f"Error fetching collection version for {self.collection_name}: {e}")
+            version = None
+        embedding_hash = hashlib.sha1(array("d", embedding).tobytes()).hexdigest()
+        key = (self.collection_name, version, embedding_hash, self.k)
+
+        documents = retrieval_cache.get(key) if version is not None else None
+        if documents is not None:
+            record("retrieval", True, time.perf_counter() - start)
+            return documents
+
+        documents = self.vectorstore.similarity_search_by_vector(embedding, k=self.k)
+        if version is not None:
+            retrieval_cache.put(key, documents)
+        record("retrieval", False, time.perf_counter() - start)
+        return documents
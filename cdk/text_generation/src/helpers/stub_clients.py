@@ -0,0 +1,82 @@
+"""
+Stand-ins for Bedrock used when BEDROCK_STUB=true, so the engine can be load tested
+locally without calling (or paying for) real models. Each call sleeps for
+BEDROCK_STUB_LATENCY_SECONDS to approximate model latency.
+"""
+import io
+import os
+import json
+import time
+from typing import Any, List, Optional
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+BEDROCK_STUB_LATENCY_SECONDS = float(os.environ.get("BEDROCK_STUB_LATENCY_SECONDS", "0.5"))
+BEDROCK_STUB_EMBEDDING_SIZE = int(os.environ.get("BEDROCK_STUB_EMBEDDING_SIZE", "1024"))
+
+STUB_REPLY = "I've been getting these headaches most afternoons, and they're starting to worry me."
+STUB_EVALUATION = {
+    "empathy_score": "good",
+    "realism_flag": "realistic",
+    "feedback": {
+        "strengths": ["Acknowledged the patient's worry."],
+        "areas_for_improvement": ["Ask how the headaches affect daily life."],
+        "why_realistic": "Stubbed evaluation.",
+        "improvement_suggestions": ["Invite the patient to describe a typical episode."],
+        "alternative_phrasing": "That sounds worrying. Can you tell me what a typical afternoon is like?",
+    },
+}
+
+class StubChatModel(BaseChatModel):
+    """
+    A chat model that always answers with the same patient line, wrapped in a combined
+    patient turn when the prompt asks for one (STRUCTURED_OUTPUT_MODE=combined).
+    """
+    model_id: str = "stub"
+
+    @property
+    def _llm_type(self) -> str:
+        return "bedrock-stub"
+
+    def _generate(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any
+    ) -> ChatResult:
+        time.sleep(BEDROCK_STUB_LATENCY_SECONDS)
+        prompt = "".join(str(message.content) for message in messages)
+        reply = STUB_REPLY
+        if '"empathy_score"' in prompt:
+            reply = json.dumps({"response": STUB_REPLY, **STUB_EVALUATION})
+        input_tokens = len(prompt) // 4 + 1
+        output_tokens = len(reply) // 4 + 1
+        message = AIMessage(content=reply, usage_metadata={
+            "input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+class StubCompletionModel:
+    """
+    A text completion model with the invoke() interface used for session naming.
+    """
+
+    def invoke(self, prompt: str) -> str:
+        time.sleep(BEDROCK_STUB_LATENCY_SECONDS)
+        return "Stub Session"
+
+class StubBedrockRuntime:
+    """
+    A bedrock-runtime client whose invoke_model returns a Nova-style empathy evaluation.
+    """
+
+    def invoke_model(self, modelId: str, body: str, **kwargs) -> dict:
+        time.sleep(BEDROCK_STUB_LATENCY_SECONDS)
+        payload = {
+            "output": {"message": {"content": [{"text": json.dumps(STUB_EVALUATION)}]}},
+            "usage": {"inputTokens": len(body) // 4 + 1, "outputTokens": len(json.dumps(STUB_EVALUATION)) // 4 + 1},
+        }
+        return {"body": io.BytesIO(json.dumps(payload).encode())}
+
+def get_stub_embeddings() -> DeterministicFakeEmbedding:
+    return DeterministicFakeEmbedding(size=BEDROCK_STUB_EMBEDDING_SIZE)
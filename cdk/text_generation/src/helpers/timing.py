@@ -0,0 +1,122 @@
+import time
+import asyncio
+import threading
+from contextvars import ContextVar, copy_context
+from contextlib import contextmanager
+
+# The timer of the turn being served, set with StageTimer.active(). Worker threads started
+# with asyncio.to_thread, or with run_in_context below, see the same timer.
+current_timer = ContextVar("current_timer", default=None)
+# The innermost open span, so a span can subtract its children from its own time
+current_span = ContextVar("current_span", default=None)
+
+class StageTimer:
+    """
+    Record when each stage of a request started and how long it took.
+
+    Stages may overlap. The summary reports both the wall-clock time and the sum of
+    the stage durations, so the time saved by running stages concurrently is visible.
+    The timer also collects the named spans and model calls made while it is active.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.spans = {}
+        self.model_calls = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def active(self):
+        """
+        Make this the timer that span() records into for the body of a with block.
+        """
+        token = current_timer.set(self)
+        try:
+            yield self
+        finally:
+            current_timer.reset(token)
+
+    def add_span(self, name: str, elapsed: float, child_seconds: float, parent) -> None:
+        """
+        Add the exclusive time of a finished span (its time minus that of nested spans).
+        """
+        with self.lock:
+            totals = self.spans.setdefault(name, {"ms": 0.0, "count": 0})
+            totals["ms"] += max(0.0, elapsed - child_seconds) * 1000
+            totals["count"] += 1
+            if parent is not None:
+                parent["child_seconds"] += elapsed
+
+    def record(self, name: str, start: float, end: float) -> None:
+        with self.lock:
+            self.stages[name] = {
+                "start_ms": round((start - self.started) * 1000, 1),
+                "duration_ms": round((end - start) * 1000, 1),
+            }
+
+    async def run(self, name: str, func, *args, **kwargs):
+        """
+        Run a blocking function in a worker thread as a timed stage.
+        """
+        start = time.perf_counter()
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def add_model_call(self, call: dict) -> None:
+        with self.lock:
+            self.model_calls.append(call)
+
+    def model_calls_snapshot(self) -> list:
+        with self.lock:
+            return list(self.model_calls)
+
+    def span_totals(self) -> dict:
+        """
+        Return the exclusive milliseconds spent in each named span.
+        """
+        with self.lock:
+            return {name: round(totals["ms"], 1) for name, totals in self.spans.items()}
+
+    def summary(self) -> dict:
+        with self.lock:
+            stages = dict(self.stages)
+        return {
+            "wall_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stage_sum_ms": round(sum(stage["duration_ms"] for stage in stages.values()), 1),
+            "stages": stages,
+            "spans": self.span_totals(),
+        }
+
+@contextmanager
+def span(name: str):
+    """
+    Time the body of a with block as a named span of the current turn.
+
+    Spans with the same name are summed, and time spent in nested spans is only counted
+    once, in the innermost span, so the span totals add up to where the time went. Outside
+    an active timer (e.g. during module init) this does nothing.
+    """
+    timer = current_timer.get()
+    if timer is None:
+        yield
+        return
+    parent = current_span.get()
+    own = {"name": name, "child_seconds": 0.0}
+    token = current_span.set(own)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current_span.reset(token)
+        timer.add_span(name, time.perf_counter() - start, own["child_seconds"], parent)
+
+def run_in_context(func):
+    """
+    Wrap a function so it runs with the caller's context (and so its timer) when
+    submitted to a plain ThreadPoolExecutor.
+    """
+    context = copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
@@ -0,0 +1,228 @@
+"""
+Token and cost accounting for every model call made while serving a turn.
+
+LangChain models report their usage through UsageCallbackHandler, which is attached to
+every model built in helpers/clients.py; the Nova empathy call and embedding cache misses
+call record_model_call directly. Calls are recorded on the turn's StageTimer, labelled
+with the span they ran in (generation, rewrite, history, naming, ...), and at the end of
+the turn they are:
+
+- summed into the turn's EMF record (see helpers/metrics.py), and
+- buffered as rows of the "model_usage" table, which are written to Postgres at the end of
+  each Lambda invocation, or in batches by the long-running server. The session_model_usage, patient_model_usage and simulation_group_model_usage views
+  aggregate them.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from helpers.timing import current_timer, current_span
+
+logger = logging.getLogger(__name__)
+
+# On-demand USD prices per 1,000 input and output tokens. MODEL_PRICES_JSON (same shape)
+# adds or overrides entries, e.g. for another region or a newly enabled model.
+MODEL_PRICES = {
+    "meta.llama3-70b-instruct-v1:0": (0.00265, 0.0035),
+    "meta.llama3-8b-instruct-v1:0": (0.0003, 0.0006),
+    "amazon.nova-pro-v1:0": (0.0008, 0.0032),
+    "amazon.nova-lite-v1:0": (0.00006, 0.00024),
+    "amazon.nova-micro-v1:0": (0.000035, 0.00014),
+    "anthropic.claude-3-haiku-20240307-v1:0": (0.00025, 0.00125),
+    "amazon.titan-embed-text-v2:0": (0.00002, 0.0),
+}
+MODEL_PRICES.update({
+    model_id: tuple(prices) for model_id, prices in json.loads(os.environ.get("MODEL_PRICES_JSON", "{}")).items()
+})
+
+# Batching for the long-running server (src/server.py): buffered rows are written once this
+# many have accumulated or the oldest is this old, checked at the end of each turn, and the
+# rest at shutdown. The Lambda handler forces a flush at the end of every invocation instead,
+# since a frozen container may never run another turn.
+USAGE_FLUSH_ROWS = int(os.environ.get("USAGE_FLUSH_ROWS", "50"))
+USAGE_FLUSH_SECONDS = float(os.environ.get("USAGE_FLUSH_SECONDS", "30"))
+USAGE_PERSIST = os.environ.get("USAGE_PERSIST", "true").lower() == "true"
+# Rows kept while the database is unreachable; the oldest are dropped beyond this
+USAGE_MAX_PENDING_ROWS = int(os.environ.get("USAGE_MAX_PENDING_ROWS", "1000"))
+
+pending_rows = []
+pending_since = None
+pending_lock = threading.Lock()
+
+def get_cost(model_id: str, input_tokens: int, output_tokens: int) -> Optional[float]:
+    """
+    Return the USD cost of a model call, or None if the model has no known price.
+    """
+    prices = MODEL_PRICES.get(model_id)
+    if prices is None:
+        return None
+    return (input_tokens * prices[0] + output_tokens * prices[1]) / 1000
+
+def record_model_call(model_id: str, input_tokens: int, output_tokens: int, latency_seconds: float, call: str = None) -> None:
+    """
+    Record a model call on the turn being served. Does nothing outside an active turn.
+
+    Args:
+    model_id (str): The Bedrock model ID.
+    input_tokens (int): Prompt tokens.
+    output_tokens (int): Completion tokens.
+    latency_seconds (float): How long the call took.
+    call (str, optional): What the call was for. Defaults to the name of the enclosing span.
+    """
+    timer = current_timer.get()
+    if timer is None:
+        return
+    if call is None:
+        span = current_span.get()
+        call = span["name"] if span else "other"
+    timer.add_model_call({
+        "call": call,
+        "model_id": model_id,
+        "input_tokens": int(input_tokens or 0),
+        "output_tokens": int(output_tokens or 0),
+        "latency_ms": round(latency_seconds * 1000, 1),
+        "cost_usd": get_cost(model_id, int(input_tokens or 0), int(output_tokens or 0)),
+        "recorded_at": time.time(),
+    })
+
+def get_token_usage(response: LLMResult) -> tuple:
+    """
+    Extract (input_tokens, output_tokens) from a LangChain model result.
+
+    Chat models attach usage_metadata to the generated message; completion models report
+    it in llm_output["usage"].
+    """
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = (response.llm_output or {}).get("usage") or {}
+    return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """
+    Records the tokens and latency of every call made through a LangChain model.
+
+    One handler is attached to each shared model instance, so it knows the model ID.
+    Callbacks run in the thread that made the call, so the turn's timer and the
+    enclosing span are visible to record_model_call.
+    """
+
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+        self.started = {}
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self.started[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self.started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        start = self.started.pop(run_id, None)
+        input_tokens, output_tokens = get_token_usage(response)
+        record_model_call(
+            self.model_id, input_tokens, output_tokens, time.perf_counter() - start if start else 0.0
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self.started.pop(run_id, None)
+
+def get_turn_usage(timer) -> dict:
+    """
+    Sum the tokens and cost of the model calls recorded on a turn's timer.
+
+    Returns:
+    dict: input_tokens, output_tokens, cost_usd (of the calls with a known price) and model_calls.
+    """
+    calls = timer.model_calls_snapshot()
+    return {
+        "input_tokens": sum(call["input_tokens"] for call in calls),
+        "output_tokens": sum(call["output_tokens"] for call in calls),
+        "cost_usd": round(sum(call["cost_usd"] or 0.0 for call in calls), 6),
+        "model_calls": len(calls),
+    }
+
+def as_uuid(value) -> Optional[str]:
+    """
+    Return value if it is a UUID, else None (e.g. the synthetic ids of prewarm sessions).
+    """
+    try:
+        return str(uuid.UUID(str(value)))
+    except (TypeError, ValueError):
+        return None
+
+def record_turn_usage(timer, simulation_group_id: str, patient_id: str, session_id: str) -> None:
+    """
+    Buffer a turn's model calls as model_usage rows for the next flush_usage.
+    """
+    global pending_since
+    calls = timer.model_calls_snapshot()
+    if not USAGE_PERSIST or not calls:
+        return
+    rows = [(
+        as_uuid(session_id), as_uuid(simulation_group_id), as_uuid(patient_id),
+        call["model_id"], call["call"], call["input_tokens"], call["output_tokens"],
+        int(call["latency_ms"]), call["cost_usd"], datetime.fromtimestamp(call["recorded_at"], timezone.utc),
+    ) for call in calls]
+    with pending_lock:
+        if not pending_rows:
+            pending_since = time.monotonic()
+        pending_rows.extend(rows)
+
+def flush_usage(force: bool = False) -> int:
+    """
+    Write buffered model_usage rows to Postgres in one batch.
+
+    Args:
+    force (bool): Write whatever is buffered, even below USAGE_FLUSH_ROWS / USAGE_FLUSH_SECONDS.
+
+    Returns:
+    int: The number of rows written. Rows are put back in the buffer if the write fails.
+    """
+    global pending_since
+    with pending_lock:
+        due = len(pending_rows) >= USAGE_FLUSH_ROWS or (
+            pending_since is not None and time.monotonic() - pending_since >= USAGE_FLUSH_SECONDS
+        )
+        if not pending_rows or not (force or due):
+            return 0
+        rows = list(pending_rows)
+        pending_rows.clear()
+        pending_since = None
+
+    # Imported here so the accounting helpers above work without a database driver
+    from db_pool import db_connection
+
+    try:
+        with db_connection(os.environ["SM_DB_CREDENTIALS"], os.environ["RDS_PROXY_ENDPOINT"]) as connection:
+            cur = connection.cursor()
+            cur.executemany("""
+                INSERT INTO "model_usage" (session_id, simulation_group_id, patient_id, model_id, call_type,
+                                           input_tokens, output_tokens, latency_ms, cost_usd, time_recorded)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+            """, rows)
+            connection.commit()
+            cur.close()
+        logger.info(f"Wrote {len(rows)} model usage rows")
+        return len(rows)
+    except Exception as e:
+        logger.error(f"Error writing model usage rows: {e}")
+        with pending_lock:
+            pending_rows[:0] = rows
+            dropped = len(pending_rows) - USAGE_MAX_PENDING_ROWS
+            if dropped > 0:
+                del pending_rows[:dropped]
+                logger.warning(f"Dropped {dropped} unwritten model usage rows")
+            if pending_since is None:
+                pending_since = time.monotonic()
+        return 0
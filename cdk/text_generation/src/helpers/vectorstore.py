@@ -1,10 +1,107 @@
+import os
+import re
+import time
+import logging
+import threading
 from typing import Dict
 
 from langchain_core.vectorstores import VectorStoreRetriever
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_history_aware_retriever
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
 
-from helpers.helper import get_vectorstore
+from helpers.cache import LRUCache
+from helpers.helper import get_vectorstore, get_collection_stats, get_collection_documents
+from helpers.retrieval import CachingRetriever
+from helpers.timing import span
+from helpers.policy import call_with_policy
+
+logger = logging.getLogger(__name__)
+
+# How the latest question is reformulated against the chat history before retrieval:
+#   always    - rewrite on every turn that has history (the original behaviour)
+#   never     - retrieve with the raw question
+#   heuristic - rewrite only when the question refers back to the conversation
+#   model     - like always, but with the cheaper QUESTION_REWRITE_MODEL_ID
+QUESTION_REWRITE_POLICY = os.environ.get("QUESTION_REWRITE_POLICY", "heuristic").lower()
+QUESTION_REWRITE_MODEL_ID = os.environ.get("QUESTION_REWRITE_MODEL_ID", "")
+
+# Patients whose whole corpus fits in this many tokens skip embedding and vector search
+# and have every chunk stuffed into the prompt. 0 disables the bypass.
+SMALL_CORPUS_TOKEN_BUDGET = int(os.environ.get("SMALL_CORPUS_TOKEN_BUDGET", "3000"))
+
+# Pronouns and phrases that usually point back to an earlier turn
+ANAPHORA_PATTERN = re.compile(
+    r"\b(it|its|it's|they|them|their|theirs|he|him|his|she|her|hers|this|that|these|those|"
+    r"there|then|same|such|one|ones|former|latter|above|also|else|again|more|another|other)\b",
+    re.IGNORECASE,
+)
+
+# History-aware retrievers reused across warm invocations, keyed by collection and LLM
+retriever_cache = LRUCache(
+    max_size=int(os.environ.get("VECTORSTORE_CACHE_SIZE", "32")),
+    idle_seconds=float(os.environ.get("VECTORSTORE_CACHE_IDLE_SECONDS", "900")),
+)
+
+# Counters for question rewrites performed and avoided in this container
+rewrite_stats = {"rewrites": 0, "skipped": 0, "rewrite_seconds": 0.0, "saved_seconds": 0.0}
+rewrite_stats_lock = threading.Lock()
+
+def needs_rewrite(question: str) -> bool:
+    """
+    Decide whether a question depends on the chat history to be understood.
+
+    Very short questions ("Why?", "How long?") and questions containing pronouns or
+    other references back to the conversation are rewritten; self-contained questions
+    such as "What medications are you currently taking?" are not.
+
+    Args:
+    question (str): The student's latest question.
+
+    Returns:
+    bool: True if the question should be reformulated before retrieval.
+    """
+    text = question.strip()
+    if text.lower().startswith("user"):
+        text = text[len("user"):].strip()
+    if len(text.split()) < 3:
+        return True
+    return bool(ANAPHORA_PATTERN.search(text))
+
+def should_rewrite(inputs: dict) -> bool:
+    """
+    Apply QUESTION_REWRITE_POLICY to a retriever input.
+    """
+    if not inputs.get("chat_history") or QUESTION_REWRITE_POLICY == "never":
+        return False
+    if QUESTION_REWRITE_POLICY == "heuristic":
+        return needs_rewrite(inputs["input"])
+    return True
+
+def record_rewrite(elapsed: float = None) -> None:
+    """
+    Update the rewrite counters. Pass elapsed for a rewrite that ran, None for one that was skipped.
+
+    The latency saved by a skipped rewrite is estimated from the average rewrite seen so far.
+    """
+    with rewrite_stats_lock:
+        if elapsed is not None:
+            rewrite_stats["rewrites"] += 1
+            rewrite_stats["rewrite_seconds"] += elapsed
+            logger.info(f"Question rewrite took {elapsed:.3f}s")
+            return
+        rewrite_stats["skipped"] += 1
+        if rewrite_stats["rewrites"]:
+            saved = rewrite_stats["rewrite_seconds"] / rewrite_stats["rewrites"]
+            rewrite_stats["saved_seconds"] += saved
+            logger.info(f"Question rewrite skipped; estimated {saved:.3f}s saved")
+
+def get_rewrite_stats() -> dict:
+    """
+    Return how many question rewrites were performed and avoided, and the estimated time saved.
+    """
+    with rewrite_stats_lock:
+        return dict(rewrite_stats)
 
 def get_vectorstore_retriever(
     llm,
@@ -22,7 +119,7 @@ def get_vectorstore_retriever(
     Returns:
     VectorStoreRetriever: A history-aware retriever instance.
     """
-    vectorstore, _ = get_vectorstore(
+    vectorstore, connection_string = get_vectorstore(
         collection_name=vectorstore_config_dict['collection_name'],
         embeddings=embeddings,
         dbname=vectorstore_config_dict['dbname'],
@@ -32,7 +129,21 @@ def get_vectorstore_retriever(
         port=int(vectorstore_config_dict['port'])
     )
 
-    retriever = vectorstore.as_retriever()
+    stuffed_retriever = get_small_corpus_retriever(vectorstore_config_dict['collection_name'], connection_string)
+    if stuffed_retriever is not None:
+        return stuffed_retriever
+
+    # Reuse the retriever as long as it was built from the same vector store and LLM
+    cache_key = (vectorstore_config_dict['collection_name'], id(vectorstore), id(llm))
+    cached = retriever_cache.get(cache_key)
+    if cached is not None and cached[0] is vectorstore and cached[1] is llm:
+        return cached[2]
+
+    retriever = CachingRetriever(
+        vectorstore=vectorstore,
+        collection_name=vectorstore_config_dict['collection_name'],
+        connection_string=connection_string
+    )
 
     # Contextualize question and create history-aware retriever
     contextualize_q_system_prompt = (
@@ -49,8 +160,94 @@ def get_vectorstore_retriever(
             ("human", "{input}"),
         ]
     )
-    history_aware_retriever = create_history_aware_retriever(
+    history_aware_retriever = create_policy_aware_retriever(
         llm, retriever, contextualize_q_prompt
     )
+    retriever_cache.put(cache_key, (vectorstore, llm, history_aware_retriever))
+
+    return history_aware_retriever
+
+def get_small_corpus_retriever(collection_name: str, connection_string: str):
+    """
+    Return a retriever that hands back every chunk of a small collection, or None if the
+    collection is too large (or has no recorded stats) and needs normal retrieval.
+
+    The decision uses the chunk and token totals recorded at ingestion time, and the
+    chunks are loaded once per collection version.
+
+    Args:
+    collection_name (str): The name of the collection.
+    connection_string (str): The SQLAlchemy connection URL.
+
+    Returns:
+    Runnable: A retriever with the history-aware retriever's interface, or None.
+    """
+    if SMALL_CORPUS_TOKEN_BUDGET <= 0:
+        return None
+    try:
+        stats = get_collection_stats(collection_name, connection_string)
+    except Exception as e:
+        logger.error(f"Error fetching collection stats for {collection_name}: {e}")
+        return None
+    if "token_count" not in stats or int(stats["token_count"]) > SMALL_CORPUS_TOKEN_BUDGET:
+        return None
+
+    version = stats.get("version")
+    cache_key = ("stuffed", collection_name, version)
+    cached = retriever_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    documents = get_collection_documents(collection_name, connection_string, version)
+    logger.info(f"Collection {collection_name} fits in {SMALL_CORPUS_TOKEN_BUDGET} tokens "
+                f"(~{stats['token_count']}); stuffing all {len(documents)} chunks")
+    # No question rewrite is needed either, since the retrieved set does not depend on the question
+    retriever = RunnableLambda(lambda inputs: documents).with_config(run_name="chat_retriever_chain")
+    retriever_cache.put(cache_key, retriever)
+    return retriever
+
+def create_policy_aware_retriever(llm, retriever, contextualize_q_prompt):
+    """
+    Build a history-aware retriever that only pays for a question rewrite when
+    QUESTION_REWRITE_POLICY calls for one.
+
+    This behaves like langchain's create_history_aware_retriever: it takes a dict with
+    "input" and "chat_history" and returns the retrieved documents.
+
+    Args:
+    llm: The language model used for the rewrite (unless the "model" policy selects another one).
+    retriever: The vector store retriever.
+    contextualize_q_prompt (ChatPromptTemplate): The prompt that reformulates the question.
+
+    Returns:
+    Runnable: The history-aware retriever.
+    """
+    rewrite_llm = llm
+    if QUESTION_REWRITE_POLICY == "model" and QUESTION_REWRITE_MODEL_ID:
+        from helpers.chat import get_bedrock_llm
+        rewrite_llm = get_bedrock_llm(QUESTION_REWRITE_MODEL_ID)
+    rewrite_chain = contextualize_q_prompt | rewrite_llm | StrOutputParser()
+
+    def retrieve(inputs: dict, config):
+        if not should_rewrite(inputs):
+            if inputs.get("chat_history"):
+                record_rewrite()
+            with span("retrieval"):
+                return retriever.invoke(inputs["input"], config)
+
+        start = time.perf_counter()
+        try:
+            with span("rewrite"):
+                question = call_with_policy(
+                    "rewrite", rewrite_chain.invoke, args=(inputs, config), hedge=True,
+                    model_id=getattr(rewrite_llm, "model_id", None)
+                )
+            record_rewrite(time.perf_counter() - start)
+        except Exception as e:
+            # Retrieval with the raw question is worse but still better than failing the turn
+            logger.warning(f"Question rewrite failed, retrieving with the original question: {e}")
+            question = inputs["input"]
+        with span("retrieval"):
+            return retriever.invoke(question, config)
 
-    return history_aware_retriever
\ No newline at end of file
+    return RunnableLambda(retrieve).with_config(run_name="chat_retriever_chain")
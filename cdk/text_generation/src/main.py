@@ -1,18 +1,44 @@
 import os
 import json
-import boto3
+import time
+import uuid
+import asyncio
 import logging
-import psycopg2
-from langchain_aws import BedrockEmbeddings
 
-from helpers.vectorstore import get_vectorstore_retriever
-from helpers.chat import get_bedrock_llm, get_initial_student_query, get_student_query, create_dynamodb_history_table, get_response, update_session_name
+# IMPORT_PROFILE=true logs a per-module import time breakdown during cold start
+IMPORT_PROFILE = os.environ.get("IMPORT_PROFILE", "false").lower() == "true"
+if IMPORT_PROFILE:
+    from helpers.importprofile import ImportProfiler
+    import_profiler = ImportProfiler().start()
+imports_started = time.perf_counter()
+
+from config_loader import get_secret, get_parameters
+from db_pool import db_connection, get_pool_status
+
+from helpers.vectorstore import get_vectorstore_retriever, get_rewrite_stats
+from helpers.helper import get_vectorstore_cache_stats
+from helpers.cache import LRUCache
+from helpers.timing import StageTimer, span
+from helpers.metrics import emit_turn_metrics
+from helpers.usage import record_turn_usage, flush_usage
+from helpers.policy import request_deadline, get_breaker_states, RateLimitExceeded
+from helpers.ratelimit import configure_rate_limiter, rate_limit_scope
+from helpers.clients import get_client, get_embeddings_model
+from helpers.retrieval import CachedEmbeddings, reset_invocation_stats, get_invocation_stats
+from helpers.chat import get_bedrock_llm, get_initial_student_query, get_student_query, create_dynamodb_history_table, get_response, stream_response, update_session_name, generate_llm_session_name
+from helpers.chat import OPENING_TURN_CACHE, get_chain_fingerprint, get_opening_turn_key, ensure_table
+from helpers.history import get_chat_history
 
 # Set up basic logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+if IMPORT_PROFILE:
+    import_profiler.stop()
+    import_profiler.report()
+logger.info(f"Module imports took {(time.perf_counter() - imports_started) * 1000:.1f}ms")
+
 # Environment variables
 DB_SECRET_NAME = os.environ["SM_DB_CREDENTIALS"]
 REGION = os.environ["REGION"]
@@ -22,13 +48,13 @@ EMBEDDING_MODEL_PARAM = os.environ["EMBEDDING_MODEL_PARAM"]
 TABLE_NAME_PARAM = os.environ["TABLE_NAME_PARAM"]
 
 # AWS Clients
-secrets_manager_client = boto3.client("secretsmanager")
-ssm_client = boto3.client("ssm", region_name=REGION)
-bedrock_runtime = boto3.client("bedrock-runtime", region_name=REGION)
+lambda_client = get_client("lambda", REGION)
+
+# "local" names sessions from the student's first message without a model call;
+# "llm" additionally asks the LLM for a better name in a background invocation
+SESSION_NAMING_MODE = os.environ.get("SESSION_NAMING_MODE", "local").lower()
 
 # Cached resources
-connection = None
-db_secret = None
 BEDROCK_LLM_ID = None
 EMBEDDING_MODEL_ID = None
 TABLE_NAME = None
@@ -36,276 +62,355 @@ TABLE_NAME = None
 # Cached embeddings instance
 embeddings = None
 
-def get_secret(secret_name, expect_json=True):
-    global db_secret
-    if db_secret is None:
-        try:
-            response = secrets_manager_client.get_secret_value(SecretId=secret_name)["SecretString"]
-            db_secret = json.loads(response) if expect_json else response
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode JSON for secret {secret_name}: {e}")
-            raise ValueError(f"Secret {secret_name} is not properly formatted as JSON.")
-        except Exception as e:
-            logger.error(f"Error fetching secret {secret_name}: {e}")
-            raise
-    return db_secret
-
+# Static patient configuration, cached per (simulation_group_id, patient_id) together with
+# the rows' config_version. Every edit bumps config_version (a trigger created by the
+# initializer), and each turn compares the versions before using its cached copy, so an
+# instructor's edit reaches every warm container on its next turn. The TTL only bounds
+# how long an unused entry is kept.
+patient_context_cache = LRUCache(
+    max_size=int(os.environ.get("PATIENT_CONTEXT_CACHE_SIZE", "256")),
+    ttl_seconds=float(os.environ.get("PATIENT_CONTEXT_TTL_SECONDS", "300")),
+)
 
-def get_parameter(param_name, cached_var):
-    """
-    Fetch a parameter value from Systems Manager Parameter Store.
+def initialize_constants():
     """
-    if cached_var is None:
-        try:
-            response = ssm_client.get_parameter(Name=param_name, WithDecryption=True)
-            cached_var = response["Parameter"]["Value"]
-        except Exception as e:
-            logger.error(f"Error fetching parameter {param_name}: {e}")
-            raise
-    return cached_var
+    Load the SSM parameters in one batch and build the resources that depend on them.
 
-def initialize_constants():
+    Parameters are cached by config_loader, so after the cold start this only reads memory.
+    """
     global BEDROCK_LLM_ID, EMBEDDING_MODEL_ID, TABLE_NAME, embeddings
-    BEDROCK_LLM_ID = get_parameter(BEDROCK_LLM_PARAM, BEDROCK_LLM_ID)
-    EMBEDDING_MODEL_ID = get_parameter(EMBEDDING_MODEL_PARAM, EMBEDDING_MODEL_ID)
-    TABLE_NAME = get_parameter(TABLE_NAME_PARAM, TABLE_NAME)
-
-    if embeddings is None:
-        embeddings = BedrockEmbeddings(
-            model_id=EMBEDDING_MODEL_ID,
-            client=bedrock_runtime,
-            region_name=REGION,
-        )
-    
-    create_dynamodb_history_table(TABLE_NAME)
+    with span("config"):
+        parameters = get_parameters([BEDROCK_LLM_PARAM, EMBEDDING_MODEL_PARAM, TABLE_NAME_PARAM])
+        BEDROCK_LLM_ID = parameters[BEDROCK_LLM_PARAM]
+        EMBEDDING_MODEL_ID = parameters[EMBEDDING_MODEL_PARAM]
+        TABLE_NAME = parameters[TABLE_NAME_PARAM]
 
-def connect_to_db():
-    global connection
-    if connection is None or connection.closed:
-        try:
-            secret = get_secret(DB_SECRET_NAME)
-            connection_params = {
-                'dbname': secret["dbname"],
-                'user': secret["username"],
-                'password': secret["password"],
-                'host': RDS_PROXY_ENDPOINT,
-                'port': secret["port"]
-            }
-            connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
-            connection = psycopg2.connect(connection_string)
-            logger.info("Connected to the database!")
-        except Exception as e:
-            logger.error(f"Failed to connect to database: {e}")
-            if connection:
-                connection.rollback()
-                connection.close()
-            raise
-    return connection
+        if embeddings is None:
+            embeddings = CachedEmbeddings(get_embeddings_model(EMBEDDING_MODEL_ID, REGION))
 
-def get_system_prompt(simulation_group_id):
-    connection = connect_to_db()
-    if connection is None:
-        logger.error("No database connection available.")
-        return {
-            "statusCode": 500,
-            "body": json.dumps("Database connection failed.")
-        }
-    
+        create_dynamodb_history_table(TABLE_NAME)
+        configure_rate_limiter(TABLE_NAME, ensure_table)
+
+def load_configuration():
+    """
+    Fetch parameters and the database secret during the Lambda init phase so the first
+    request does not wait on SSM and Secrets Manager. Failures are left to the request path.
+    """
+    start = time.perf_counter()
     try:
-        cur = connection.cursor()
-        
-        cur.execute("""
-            SELECT system_prompt
-            FROM "simulation_groups"
-            WHERE simulation_group_id = %s;
-        """, (simulation_group_id,))
+        initialize_constants()
+        get_secret(DB_SECRET_NAME)
+        logger.info(f"Loaded configuration during init in {(time.perf_counter() - start) * 1000:.1f}ms")
+    except Exception as e:
+        logger.error(f"Error loading configuration during init: {e}")
 
-        result = cur.fetchone()
-        logger.info(f"Query result: {result}")
-        system_prompt = result[0] if result else None
+load_configuration()
 
-        cur.close()
+def get_patient_context(simulation_group_id, patient_id):
+    """
+    Load the simulation group's system prompt and the patient's details in one query.
 
-        if system_prompt:
-            logger.info(f"System prompt for simulation_group_id {simulation_group_id} found: {system_prompt}")
-        else:
-            logger.warning(f"No system prompt found for simulation_group_id {simulation_group_id}")
+    Results are kept in an in-process cache keyed by (simulation_group_id, patient_id). A
+    cached entry is only used while the config_version of both rows is unchanged, which
+    costs a primary-key lookup of two integers instead of reading the prompts again.
 
-        return system_prompt
+    Returns:
+    tuple: (system_prompt, patient_name, patient_age, patient_prompt, llm_completion).
+    Fields are None when the simulation group or patient could not be found.
+    """
+    cache_key = (simulation_group_id, patient_id)
+    cached = patient_context_cache.get(cache_key)
 
-    except Exception as e:
-        logger.error(f"Error fetching system prompt: {e}")
-        if cur:
+    cur = None
+    with span("db"), db_connection(DB_SECRET_NAME, RDS_PROXY_ENDPOINT) as connection:
+        try:
+            cur = connection.cursor()
+            if cached is not None:
+                cur.execute("""
+                    SELECT sg.config_version, p.config_version
+                    FROM "simulation_groups" sg
+                    LEFT JOIN "patients" p ON p.patient_id = %s
+                    WHERE sg.simulation_group_id = %s;
+                """, (patient_id, simulation_group_id))
+                versions = cur.fetchone()
+                context, cached_versions = cached
+                if versions is not None and tuple(versions) == cached_versions:
+                    cur.close()
+                    logger.info(f"Patient context cache hit for patient_id {patient_id}")
+                    return context
+                logger.info(f"Patient context for patient_id {patient_id} changed since it was cached")
+
+            cur.execute("""
+                SELECT sg.system_prompt, p.patient_name, p.patient_age, p.patient_prompt, p.llm_completion,
+                       sg.config_version, p.config_version
+                FROM "simulation_groups" sg
+                LEFT JOIN "patients" p ON p.patient_id = %s
+                WHERE sg.simulation_group_id = %s;
+            """, (patient_id, simulation_group_id))
+
+            result = cur.fetchone()
             cur.close()
-        connection.rollback()
-        return None
+        except Exception as e:
+            logger.error(f"Error fetching patient context: {e}")
+            if cur:
+                cur.close()
+            connection.rollback()
+            return None, None, None, None, None
+
+    if not result:
+        logger.warning(f"No simulation group found for simulation_group_id {simulation_group_id}")
+        return None, None, None, None, None
+
+    context, versions = tuple(result[:5]), tuple(result[5:])
+    logger.debug(f"Patient context for patient_id {patient_id}: {context}")
+    if context[1] is None:
+        logger.warning(f"No details found for patient_id {patient_id}")
+    elif all(value is not None for value in context):
+        patient_context_cache.put(cache_key, (context, versions))
+    return context
+
+def prewarm_opening_turn(event, context):
+    """
+    Generate and cache a patient's opening turn ahead of the first student session.
 
+    Intended to be invoked directly after a patient is created or edited. The greeting is
+    generated with get_response in a throwaway session, whose history is cleared through
+    the history backend afterwards.
+    """
+    simulation_group_id = event.get("simulation_group_id", "")
+    patient_id = event.get("patient_id", "")
+    if not OPENING_TURN_CACHE:
+        logger.info("OPENING_TURN_CACHE is off; nothing to prewarm")
+        return {"statusCode": 200, "body": json.dumps({"patient_id": patient_id})}
 
-def get_patient_details(patient_id):
-    connection = connect_to_db()
-    if connection is None:
-        logger.error("No database connection available.")
-        return {
-            "statusCode": 500,
-            "body": json.dumps("Database connection failed.")
-        }
-    
+    initialize_constants()
+    system_prompt, patient_name, patient_age, patient_prompt, llm_completion = get_patient_context(
+        simulation_group_id, patient_id
+    )
+    if None in (system_prompt, patient_name, patient_age, patient_prompt, llm_completion):
+        logger.error(f"Error fetching patient context to prewarm patient_id {patient_id}")
+        return error_response(400, 'Error fetching patient details')
+
+    session_id = f"prewarm-{uuid.uuid4()}"
+    status_code = 200
     try:
-        cur = connection.cursor()
-        logger.info("Connected to RDS instance!")
-        cur.execute("""
-            SELECT patient_name, patient_age, patient_prompt, llm_completion
-            FROM "patients"
-            WHERE patient_id = %s;
-        """, (patient_id,))
-
-        result = cur.fetchone()
-        logger.info(f"Query result: {result}")
-
-        cur.close()
-
-        if result:
-            patient_name, patient_age, patient_prompt, llm_completion = result
-            logger.info(f"Patient details found for patient_id {patient_id}: "
-                        f"Name: {patient_name}, Age: {patient_age}, Prompt: {patient_prompt}, LLM Completion: {llm_completion}")
-            return patient_name, patient_age, patient_prompt, llm_completion
-        else:
-            logger.warning(f"No details found for patient_id {patient_id}")
-            return None, None, None, None
+        llm = get_bedrock_llm(BEDROCK_LLM_ID)
+        history_aware_retriever = get_vectorstore_retriever(
+            llm=llm,
+            vectorstore_config_dict=get_vectorstore_config(patient_id),
+            embeddings=embeddings
+        )
+        opening_key = get_opening_turn_key(patient_id, get_chain_fingerprint(
+            llm, TABLE_NAME, system_prompt, patient_name, patient_age, patient_prompt, llm_completion
+        ))
+        with request_deadline(context), rate_limit_scope(simulation_group_id):
+            get_response(
+                query=get_initial_student_query(patient_name),
+                patient_name=patient_name,
+                llm=llm,
+                history_aware_retriever=history_aware_retriever,
+                table_name=TABLE_NAME,
+                session_id=session_id,
+                system_prompt=system_prompt,
+                patient_age=patient_age,
+                patient_prompt=patient_prompt,
+                llm_completion=llm_completion,
+                opening_key=opening_key
+            )
+    except Exception as e:
+        logger.error(f"Error prewarming opening turn for patient_id {patient_id}: {e}")
+        status_code = 500
+    finally:
+        try:
+            get_chat_history(TABLE_NAME, session_id).clear()
+        except Exception as e:
+            logger.error(f"Error deleting prewarm session {session_id}: {e}")
+
+    logger.info(f"Prewarmed opening turn for patient_id {patient_id}: status {status_code}")
+    return {"statusCode": status_code, "body": json.dumps({"patient_id": patient_id})}
+
+def request_llm_session_name(session_id, student_message, llm_message, fallback_name):
+    """
+    Invoke this function asynchronously to name the session with the LLM, off the critical path.
+    """
+    lambda_client.invoke(
+        FunctionName=os.environ["AWS_LAMBDA_FUNCTION_NAME"],
+        InvocationType="Event",
+        Payload=json.dumps({
+            "action": "name_session",
+            "session_id": session_id,
+            "student_message": student_message,
+            "llm_message": llm_message,
+            "fallback_name": fallback_name,
+        })
+    )
+
+def name_session(event):
+    """
+    Background task: generate an LLM session name and store it on the session in RDS.
 
+    The frontend does not store the placeholder name of a turn whose name is pending, so
+    if the LLM call fails the locally generated fallback_name is stored instead.
+    """
+    session_id = event.get("session_id", "")
+    try:
+        session_name = generate_llm_session_name(
+            BEDROCK_LLM_ID, event.get("student_message", ""), event.get("llm_message", "")
+        )[:30]
     except Exception as e:
-        logger.error(f"Error fetching patient details: {e}")
-        if cur:
+        logger.error(f"Error generating LLM session name for session {session_id}: {e}")
+        session_name = None
+    session_name = session_name or event.get("fallback_name")
+    if not session_name:
+        return {"statusCode": 500, "body": json.dumps("No session name generated")}
+
+    cur = None
+    with span("db"), db_connection(DB_SECRET_NAME, RDS_PROXY_ENDPOINT) as connection:
+        try:
+            cur = connection.cursor()
+            cur.execute("""
+                UPDATE "sessions"
+                SET session_name = %s
+                WHERE session_id = %s;
+            """, (session_name, session_id))
+            connection.commit()
             cur.close()
-        connection.rollback()
-        return None, None, None
+            logger.info(f"Session {session_id} named '{session_name}'")
+        except Exception as e:
+            logger.error(f"Error storing session name for session {session_id}: {e}")
+            if cur:
+                cur.close()
+            connection.rollback()
+            raise
 
+    return {"statusCode": 200, "body": json.dumps({"session_name": session_name})}
 
-def handler(event, context):
-    logger.info("Text Generation Lambda function is called!")
-    initialize_constants()
+def get_vectorstore_config(patient_id):
+    """
+    Build the vectorstore configuration for a patient's collection from the DB secret.
+    """
+    with span("config"):
+        db_secret = get_secret(DB_SECRET_NAME)
+    return {
+        'collection_name': patient_id,
+        'dbname': db_secret["dbname"],
+        'user': db_secret["username"],
+        'password': db_secret["password"],
+        'host': RDS_PROXY_ENDPOINT,
+        'port': db_secret["port"]
+    }
+
+def error_response(status_code, message):
+    return {
+        'statusCode': status_code,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Headers": "*",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "*",
+        },
+        'body': json.dumps(message)
+    }
 
-    query_params = event.get("queryStringParameters", {})
-    simulation_group_id = query_params.get("simulation_group_id", "")
-    session_id = query_params.get("session_id", "")
-    patient_id = query_params.get("patient_id", "")
-    session_name = query_params.get("session_name", "New Chat")
+def name_first_exchange(session_id, question, llm_output):
+    """
+    Name the session if this turn is the student's first successful exchange.
 
-    if not simulation_group_id or not session_id or not patient_id:
-        return {
-            'statusCode': 400,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "*",
-            },
-            'body': json.dumps("Missing required parameters: simulation_group_id, session_id, or patient_id")
-        }
+    Only called once the patient reply exists, so a turn that fails (or is rate limited)
+    does not use up the session's naming turn.
+
+    Returns:
+    tuple: (session_name, pending). session_name is None if the session was already
+    named. pending is True when SESSION_NAMING_MODE=llm will store a better name in the
+    background, in which case the client should not store session_name itself.
+    """
+    session_name = update_session_name(TABLE_NAME, session_id, question)
+    if not session_name:
+        logger.info("Not the first exchange between the LLM and student. Session name remains the same.")
+        return None, False
+
+    logger.info("This is the first exchange between the LLM and student. Updating session name.")
+    if SESSION_NAMING_MODE != "llm":
+        return session_name, False
+    try:
+        request_llm_session_name(session_id, question, llm_output, session_name)
+        return session_name, True
+    except Exception as e:
+        logger.error(f"Error requesting LLM session name: {e}")
+        return session_name, False
+
+async def handle_turn_async(event, query_params, simulation_group_id, session_id, patient_id, session_name,
+                            timer=None, on_event=None):
+    """
+    Serve a chat turn with independent stages running concurrently.
+
+    The patient context query and the retriever setup (secret, vector store, collection
+    stats) do not depend on each other and are awaited together. The session-naming
+    counter is only advanced once the reply has been generated. Blocking clients run in
+    worker threads, sharing the container's pools and caches. Per-stage start offsets
+    and durations are logged at the end of the turn. Pass the caller's active timer to
+    have the turn's spans recorded in it.
+
+    Only server.py streams: it passes on_event, which is called from the worker thread
+    with every token and empathy event as it is produced, and sends each one before the
+    turn ends. The returned response still holds every event. Lambda's Python runtime
+    cannot stream a response, so without on_event stream=true is ignored and the turn is
+    answered with the usual JSON body.
+    """
+    timer = timer or StageTimer()
+
+    body = {} if event.get("body") is None else json.loads(event.get("body"))
+    question = body.get("message_content", "")
+    stream = on_event is not None and query_params.get("stream", "false").lower() == "true"
 
-    system_prompt = get_system_prompt(simulation_group_id)
+    def load_retriever():
+        llm = get_bedrock_llm(BEDROCK_LLM_ID)
+        retriever = get_vectorstore_retriever(
+            llm=llm,
+            vectorstore_config_dict=get_vectorstore_config(patient_id),
+            embeddings=embeddings
+        )
+        return llm, retriever
+
+    patient_context, retriever_result = await asyncio.gather(
+        timer.run("patient_context", get_patient_context, simulation_group_id, patient_id),
+        timer.run("retriever", load_retriever),
+        return_exceptions=True
+    )
+
+    if isinstance(patient_context, Exception):
+        logger.error(f"Error fetching patient context: {patient_context}")
+        patient_context = (None, None, None, None, None)
+    system_prompt, patient_name, patient_age, patient_prompt, llm_completion = patient_context
     if system_prompt is None:
         logger.error(f"Error fetching system prompt for simulation_group_id: {simulation_group_id}")
-        return {
-            'statusCode': 400,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "*",
-            },
-            'body': json.dumps('Error fetching system prompt')
-        }
-
-    patient_name, patient_age, patient_prompt, llm_completion = get_patient_details(
-        patient_id)
+        return error_response(400, 'Error fetching system prompt')
     if patient_name is None or patient_age is None or patient_prompt is None or llm_completion is None:
         logger.error(f"Error fetching patient details for patient_id: {patient_id}")
-        return {
-            'statusCode': 400,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "*",
-            },
-            'body': json.dumps('Error fetching patient details')
-        }
+        return error_response(400, 'Error fetching patient details')
 
-    body = {} if event.get("body") is None else json.loads(event.get("body"))
-    question = body.get("message_content", "")
+    if isinstance(retriever_result, Exception):
+        logger.error(f"Error creating history-aware retriever: {retriever_result}")
+        return error_response(500, 'Error creating history-aware retriever')
+    llm, history_aware_retriever = retriever_result
+    logger.info(f"Vectorstore cache stats: {get_vectorstore_cache_stats()}")
+    logger.info(f"Database pool status: {get_pool_status()}")
 
     if not question:
-        logger.info(f"Start of conversation. Creating conversation history table in DynamoDB.")
         student_query = get_initial_student_query(patient_name)
     else:
         logger.info(f"Processing student question: {question}")
         student_query = get_student_query(question)
 
-    try:
-        logger.info("Creating Bedrock LLM instance.")
-        llm = get_bedrock_llm(BEDROCK_LLM_ID)
-    except Exception as e:
-        logger.error(f"Error getting LLM from Bedrock: {e}")
-        return {
-            'statusCode': 500,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "*",
-            },
-            'body': json.dumps('Error getting LLM from Bedrock')
-        }
-
-    try:
-        logger.info("Retrieving vectorstore config.")
-        db_secret = get_secret(DB_SECRET_NAME)
-        vectorstore_config_dict = {
-            'collection_name': patient_id,
-            'dbname': db_secret["dbname"],
-            'user': db_secret["username"],
-            'password': db_secret["password"],
-            'host': RDS_PROXY_ENDPOINT,
-            'port': db_secret["port"]
-        }
-    except Exception as e:
-        logger.error(f"Error retrieving vectorstore config: {e}")
-        return {
-            'statusCode': 500,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "*",
-            },
-            'body': json.dumps('Error retrieving vectorstore config')
-        }
-
-    try:
-        logger.info("Creating history-aware retriever.")
-
-        history_aware_retriever = get_vectorstore_retriever(
-            llm=llm,
-            vectorstore_config_dict=vectorstore_config_dict,
-            embeddings=embeddings
-        )
-    except Exception as e:
-        logger.error(f"Error creating history-aware retriever: {e}")
-        return {
-            'statusCode': 500,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "*",
-            },
-            'body': json.dumps('Error creating history-aware retriever')
-        }
+    opening_key = None
+    if not question and OPENING_TURN_CACHE:
+        opening_key = get_opening_turn_key(patient_id, get_chain_fingerprint(
+            llm, TABLE_NAME, system_prompt, patient_name, patient_age, patient_prompt, llm_completion
+        ))
 
-    try:
-        logger.info("Generating response from the LLM.")
-        response = get_response(
+    def generate():
+        generate_func = stream_response if stream else get_response
+        result = generate_func(
             query=student_query,
             patient_name=patient_name,
             llm=llm,
@@ -315,38 +420,128 @@ def handler(event, context):
             system_prompt=system_prompt,
             patient_age=patient_age,
             patient_prompt=patient_prompt,
-            llm_completion=llm_completion
+            llm_completion=llm_completion,
+            opening_key=opening_key
         )
+        if not stream:
+            return result
+        events = []
+        for stream_event in result:
+            events.append(stream_event)
+            if stream_event["type"] != "result":
+                on_event(stream_event)
+        return events
+
+    events = []
+    try:
+        response = await timer.run("response", generate)
+        if stream:
+            events = response
+            response = events.pop()
+            logger.info(f"Streamed response: time to first token {response['ttft_ms']} ms, total {response['total_ms']} ms")
     except Exception as e:
         logger.error(f"Error getting response: {e}")
+        if isinstance(e, RateLimitExceeded):
+            return error_response(429, 'Too many students are talking to this patient right now, please try again')
+        return error_response(500, 'Error getting response')
+
+    renamed, pending = False, False
+    if question:
+        try:
+            new_session_name, pending = await timer.run(
+                "session_naming", name_first_exchange, session_id, question, response.get("llm_output", "")
+            )
+            if new_session_name:
+                session_name, renamed = new_session_name, True
+        except Exception as e:
+            logger.error(f"Error updating session name: {e}")
+            session_name = "New Chat"
+
+    logger.info(f"Question rewrite stats: {get_rewrite_stats()}")
+    logger.info(f"Embedding and retrieval cache stats: {get_invocation_stats()}")
+    logger.info(f"Stage latencies: {json.dumps(timer.summary())}")
+    logger.info(f"Bedrock circuit breakers: {get_breaker_states()}")
+
+    return format_turn_response(response, events, stream, session_name, renamed, pending)
+
+def handler(event, context):
+    logger.info("Text Generation Lambda function is called!")
+
+    if event.get("action") == "prewarm_opening_turn":
+        return prewarm_opening_turn(event, context)
+
+    # Every span and model call recorded while serving the request ends up in one EMF record
+    timer = StageTimer()
+    query_params = event.get("queryStringParameters") or {}
+    with timer.active(), request_deadline(context), rate_limit_scope(query_params.get("simulation_group_id")):
+        try:
+            return handle_request(event, timer)
+        finally:
+            emit_turn_metrics(timer, query_params.get("simulation_group_id"), BEDROCK_LLM_ID)
+            record_turn_usage(
+                timer, query_params.get("simulation_group_id"), query_params.get("patient_id"),
+                query_params.get("session_id") or event.get("session_id")
+            )
+            # Written before the invocation returns: a frozen container may never run another
+            # turn, so rows buffered across invocations could be lost with it
+            flush_usage(force=True)
+
+def handle_request(event, timer):
+    """
+    Serve a chat turn (or a background naming request) with an active StageTimer.
+    """
+    initialize_constants()
+    reset_invocation_stats()
+
+    if event.get("action") == "name_session":
+        return name_session(event)
+
+    query_params = event.get("queryStringParameters", {})
+    simulation_group_id = query_params.get("simulation_group_id", "")
+    session_id = query_params.get("session_id", "")
+    patient_id = query_params.get("patient_id", "")
+    session_name = query_params.get("session_name", "New Chat")
+
+    if not simulation_group_id or not session_id or not patient_id:
+        return error_response(400, "Missing required parameters: simulation_group_id, session_id, or patient_id")
+
+    return asyncio.run(handle_turn_async(
+        event, query_params, simulation_group_id, session_id, patient_id, session_name, timer=timer
+    ))
+
+def format_turn_response(response, events, stream, session_name, renamed=False, pending=False):
+    """
+    Build the response for a completed chat turn: JSON, or NDJSON for a turn streamed by server.py.
+
+    session_renamed tells the client that this turn named the session, and
+    session_name_pending that the name will be replaced and stored in the background.
+    """
+    empathy_eval = response.get('empathy_evaluation', None)
+    logger.info(f"LLM RESPONSE: {empathy_eval}")
+
+    if stream:
+        events.append({
+            "type": "done",
+            "session_name": session_name,
+            "session_renamed": renamed,
+            "session_name_pending": pending,
+            "llm_output": response.get("llm_output", "LLM failed to create response"),
+            "llm_verdict": response.get("llm_verdict", "LLM failed to create verdict"),
+            "empathy_evaluation": response.get("empathy_evaluation", None),
+            "ttft_ms": response.get("ttft_ms"),
+            "total_ms": response.get("total_ms")
+        })
         return {
-            'statusCode': 500,
+            "statusCode": 200,
             "headers": {
-                "Content-Type": "application/json",
+                "Content-Type": "application/x-ndjson",
                 "Access-Control-Allow-Headers": "*",
                 "Access-Control-Allow-Origin": "*",
                 "Access-Control-Allow-Methods": "*",
             },
-            'body': json.dumps('Error getting response')
+            "body": "\n".join(json.dumps(event) for event in events) + "\n"
         }
 
-    try:
-        logger.info("Updating session name if this is the first exchange between the LLM and student")
-        potential_session_name = update_session_name(
-            TABLE_NAME, session_id, BEDROCK_LLM_ID)
-        if potential_session_name:
-            logger.info("This is the first exchange between the LLM and student. Updating session name.")
-            session_name = potential_session_name
-        else:
-            logger.info("Not the first exchange between the LLM and student. Session name remains the same.")
-    except Exception as e:
-        logger.error(f"Error updating session name: {e}")
-        session_name = "New Chat"
-
-    logger.info("Returning the generated response.")
-
-    empathy_eval = response.get('empathy_evaluation', None)
-    logger.info(f"LLM RESPONSE: {empathy_eval}")
     return {
         "statusCode": 200,
         "headers": {
@@ -357,6 +552,8 @@ def handler(event, context):
         },
         "body": json.dumps({
             "session_name": session_name,
+            "session_renamed": renamed,
+            "session_name_pending": pending,
             "llm_output": response.get("llm_output", "LLM failed to create response"),
             "llm_verdict": response.get("llm_verdict", "LLM failed to create verdict"),
             "empathy_evaluation": response.get("empathy_evaluation", None)
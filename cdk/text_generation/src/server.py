@@ -0,0 +1,273 @@
+"""
+Long-running ASGI entry point for the text generation engine.
+
+Serves the same chat turns as the Lambda handler in main.py, but from one process that
+handles many sessions at once, so the database pool, chain caches and client registry
+are shared by every concurrent turn instead of by one request at a time:
+
+    uvicorn server:app --host 0.0.0.0 --port 8080
+    python server.py
+
+Routes:
+    GET  /health    Liveness check, with the current number of running and queued turns.
+    POST /chat      A chat turn. Takes the same query parameters (simulation_group_id,
+                    session_id, patient_id, session_name, stream) and JSON body
+                    ({"message_content": ...}) as the API Gateway route. With
+                    stream=true the newline-delimited JSON events are sent as a chunked
+                    response while the patient reply is generated, ending with the
+                    "done" event (or an "error" event if the turn fails after the first
+                    token was sent).
+
+At most SERVER_MAX_CONCURRENT_TURNS turns run at once. Further requests wait for a slot
+for up to SERVER_QUEUE_TIMEOUT_SECONDS, and once SERVER_MAX_QUEUED_TURNS are already
+waiting new requests are rejected straight away. Both cases return 503 with a Retry-After
+header, so a load balancer can send the request elsewhere rather than let latency grow
+without bound. TEXT_GEN_WORKERS and BEDROCK_POLICY_WORKERS default to multiples of the
+limit and are checked against it on startup; size DB_POOL_SIZE for it as well.
+
+main.py reads the same environment variables as in Lambda (SM_DB_CREDENTIALS, REGION,
+RDS_PROXY_ENDPOINT and the *_PARAM names). See load_test.py for running against local
+Postgres and DynamoDB with stubbed Bedrock.
+"""
+import os
+import json
+import asyncio
+import logging
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+
+# Turns running at once; each holds a worker thread and up to one pooled DB connection.
+# Read before main is imported, since the pools below are created at import time
+SERVER_MAX_CONCURRENT_TURNS = int(os.environ.get("SERVER_MAX_CONCURRENT_TURNS", "16"))
+# Each running turn takes two text-gen workers (the patient reply and the empathy evaluation)
+# and two policy workers for their model calls, plus two more when those calls are hedged
+TEXT_GEN_WORKERS_PER_TURN = 2
+POLICY_WORKERS_PER_TURN = 4
+os.environ.setdefault("TEXT_GEN_WORKERS", str(SERVER_MAX_CONCURRENT_TURNS * TEXT_GEN_WORKERS_PER_TURN))
+os.environ.setdefault("BEDROCK_POLICY_WORKERS", str(SERVER_MAX_CONCURRENT_TURNS * POLICY_WORKERS_PER_TURN))
+
+import main
+from helpers import chat, policy
+from helpers.timing import StageTimer
+from helpers.metrics import emit_turn_metrics
+from helpers.usage import record_turn_usage, flush_usage
+from helpers.policy import request_deadline
+from helpers.ratelimit import rate_limit_scope
+from helpers.retrieval import reset_invocation_stats
+
+logger = logging.getLogger(__name__)
+
+# Requests allowed to wait for a slot before new ones are rejected
+SERVER_MAX_QUEUED_TURNS = int(os.environ.get("SERVER_MAX_QUEUED_TURNS", "64"))
+SERVER_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("SERVER_QUEUE_TIMEOUT_SECONDS", "10"))
+# Threads for the blocking stages of every running turn (asyncio.to_thread)
+SERVER_WORKER_THREADS = int(os.environ.get("SERVER_WORKER_THREADS", str(SERVER_MAX_CONCURRENT_TURNS * 4)))
+SERVER_RETRY_AFTER_SECONDS = os.environ.get("SERVER_RETRY_AFTER_SECONDS", "1")
+
+STREAM_HEADERS = [
+    (b"content-type", b"application/x-ndjson"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"*"),
+]
+
+# Created on startup, inside the server's event loop
+turn_slots = None
+queued_turns = 0
+running_turns = 0
+
+def check_worker_pools():
+    """
+    Check that the text-gen and policy executors can serve every concurrent turn at once.
+
+    TEXT_GEN_WORKERS and BEDROCK_POLICY_WORKERS default to multiples of
+    SERVER_MAX_CONCURRENT_TURNS, but either can be set explicitly. Smaller pools would queue
+    the evaluation of one turn behind the reply of another, with the wait counted against
+    each turn's deadline.
+
+    Raises:
+    ValueError: If either pool has fewer workers than the turn limit needs.
+    """
+    pools = {
+        "TEXT_GEN_WORKERS": (chat.executor, TEXT_GEN_WORKERS_PER_TURN),
+        "BEDROCK_POLICY_WORKERS": (policy.executor, POLICY_WORKERS_PER_TURN),
+    }
+    for name, (executor, per_turn) in pools.items():
+        needed = SERVER_MAX_CONCURRENT_TURNS * per_turn
+        if executor._max_workers < needed:
+            raise ValueError(f"{name}={executor._max_workers} is too small for "
+                             f"SERVER_MAX_CONCURRENT_TURNS={SERVER_MAX_CONCURRENT_TURNS}; "
+                             f"set it to at least {needed} or lower the turn limit")
+
+async def startup():
+    global turn_slots
+    check_worker_pools()
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=SERVER_WORKER_THREADS, thread_name_prefix="server"))
+    turn_slots = asyncio.Semaphore(SERVER_MAX_CONCURRENT_TURNS)
+    logger.info(f"Server started: {SERVER_MAX_CONCURRENT_TURNS} concurrent turns, "
+                f"{SERVER_MAX_QUEUED_TURNS} queued, {SERVER_WORKER_THREADS} worker threads")
+
+def overloaded_response(message):
+    response = main.error_response(503, message)
+    response["headers"]["Retry-After"] = SERVER_RETRY_AFTER_SECONDS
+    return response
+
+async def acquire_turn_slot() -> bool:
+    """
+    Wait for a free turn slot. Returns False if the queue is full or the wait timed out.
+    """
+    global queued_turns
+    if turn_slots.locked() and queued_turns >= SERVER_MAX_QUEUED_TURNS:
+        return False
+    queued_turns += 1
+    try:
+        await asyncio.wait_for(turn_slots.acquire(), timeout=SERVER_QUEUE_TIMEOUT_SECONDS)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        queued_turns -= 1
+
+async def handle_chat(query_params, body, on_event=None):
+    """
+    Run one chat turn through the same pipeline as the Lambda handler.
+
+    Args:
+    query_params (dict): The request's query string parameters.
+    body (bytes): The raw request body.
+    on_event (callable, optional): Called from a worker thread with each stream event of a streamed turn.
+
+    Returns:
+    dict: A Lambda-style response with statusCode, headers and body.
+    """
+    global running_turns
+    simulation_group_id = query_params.get("simulation_group_id", "")
+    session_id = query_params.get("session_id", "")
+    patient_id = query_params.get("patient_id", "")
+    session_name = query_params.get("session_name", "New Chat")
+    if not simulation_group_id or not session_id or not patient_id:
+        return main.error_response(400, "Missing required parameters: simulation_group_id, session_id, or patient_id")
+
+    event = {"queryStringParameters": query_params, "body": body.decode() if body else None}
+
+    if not await acquire_turn_slot():
+        logger.warning(f"Rejecting turn for session {session_id}: server is at capacity")
+        return overloaded_response("Server is at capacity, retry later")
+    running_turns += 1
+    timer = StageTimer()
+    try:
+        with timer.active(), request_deadline(), rate_limit_scope(simulation_group_id):
+            # Cached after the first call, so this only touches memory on the hot path
+            await asyncio.to_thread(main.initialize_constants)
+            # Counters of this turn only; each request task has its own context
+            reset_invocation_stats()
+            return await main.handle_turn_async(
+                event, query_params, simulation_group_id, session_id, patient_id, session_name,
+                timer=timer, on_event=on_event
+            )
+    except Exception as e:
+        logger.error(f"Error handling chat turn: {e}")
+        return main.error_response(500, "Error handling chat turn")
+    finally:
+        running_turns -= 1
+        turn_slots.release()
+        emit_turn_metrics(timer, simulation_group_id, main.BEDROCK_LLM_ID)
+        # Usage rows are written in batches across turns (USAGE_FLUSH_ROWS / USAGE_FLUSH_SECONDS)
+        record_turn_usage(timer, simulation_group_id, patient_id, session_id)
+        await asyncio.to_thread(flush_usage)
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+async def send_response(send, response):
+    headers = [(name.lower().encode(), str(value).encode()) for name, value in response.get("headers", {}).items()]
+    await send({"type": "http.response.start", "status": response["statusCode"], "headers": headers})
+    await send({"type": "http.response.body", "body": response.get("body", "").encode()})
+
+async def stream_chat(send, query_params, body):
+    """
+    Run a streamed chat turn, sending each event as a chunk as soon as it is produced.
+
+    The response starts with the first event, so a turn rejected before generation
+    (bad parameters, no capacity, rate limited) still gets its usual status code.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    on_event = lambda event: loop.call_soon_threadsafe(queue.put_nowait, event)
+    turn = asyncio.create_task(handle_chat(query_params, body, on_event=on_event))
+
+    sent = 0
+    async def send_event(event):
+        nonlocal sent
+        if sent == 0:
+            await send({"type": "http.response.start", "status": 200, "headers": STREAM_HEADERS})
+        await send({"type": "http.response.body", "body": (json.dumps(event) + "\n").encode(), "more_body": True})
+        sent += 1
+
+    while not turn.done():
+        next_event = asyncio.create_task(queue.get())
+        done, _ = await asyncio.wait({turn, next_event}, return_when=asyncio.FIRST_COMPLETED)
+        if next_event in done:
+            await send_event(next_event.result())
+        else:
+            next_event.cancel()
+    while not queue.empty():
+        await send_event(queue.get_nowait())
+
+    response = turn.result()
+    if sent == 0:
+        return await send_response(send, response)
+    if response["statusCode"] == 200:
+        # The body repeats the events already sent; only the rest (the "done" event) is new
+        lines = response["body"].splitlines()[sent:]
+    else:
+        lines = [json.dumps({"type": "error", "status": response["statusCode"], "message": json.loads(response["body"])})]
+    await send({"type": "http.response.body", "body": "".join(line + "\n" for line in lines).encode()})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await startup()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asyncio.to_thread(flush_usage, True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    # Servers that skip the lifespan protocol still get the limits set up
+    if turn_slots is None:
+        await startup()
+
+    path, method = scope["path"], scope["method"]
+    if path == "/health" and method == "GET":
+        response = {
+            "statusCode": 200,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps({"status": "ok", "running_turns": running_turns, "queued_turns": queued_turns}),
+        }
+    elif path == "/chat" and method == "POST":
+        query_params = dict(parse_qsl(scope.get("query_string", b"").decode()))
+        body = await read_body(receive)
+        if query_params.get("stream", "false").lower() == "true":
+            return await stream_chat(send, query_params, body)
+        response = await handle_chat(query_params, body)
+    else:
+        response = main.error_response(404, "Not found")
+    await send_response(send, response)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=os.environ.get("SERVER_HOST", "0.0.0.0"), port=int(os.environ.get("SERVER_PORT", "8080")))
@@ -0,0 +1,120 @@
+"""
+Compare the latency and token cost of student turns in the two STRUCTURED_OUTPUT_MODEs:
+
+    separate - the patient reply from the RAG chain plus a Nova Pro empathy evaluation
+    combined - one structured call returning both, falling back to separate calls when
+               its output does not validate
+
+Every round plays the same scripted conversation once per mode, through the same
+get_response the handler uses, and reports per-turn latency, tokens, cost and how often
+the combined mode fell back. Retrieval is replaced by a fixed patient document so both
+modes see identical context; the question rewrite is not part of the comparison.
+
+Chat history is written to a real DynamoDB table (or DynamoDB Local through
+AWS_ENDPOINT_URL_DYNAMODB), and the sessions are deleted afterwards:
+
+    python structured_output_benchmark.py --table chat-history --rounds 5
+    BEDROCK_STUB=true python structured_output_benchmark.py --table chat-history
+
+Without BEDROCK_STUB this calls (and pays for) Bedrock.
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
+
+from helpers import chat
+from helpers.timing import StageTimer
+from helpers.policy import request_deadline
+from helpers.usage import get_turn_usage
+from helpers.history import get_raw_history
+
+PATIENT_DOCUMENT = """
+Maria is 58 and has had throbbing headaches most afternoons for three weeks. She started
+ibuprofen 400 mg three times a day for knee pain a month ago and takes lisinopril for
+hypertension. Her home blood pressure readings have risen from 128/80 to 152/94. She is
+worried the headaches mean something serious, like a stroke.
+"""
+
+STUDENT_MESSAGES = [
+    "Hi Maria, I'm sorry you've been dealing with these headaches. When do they usually start?",
+    "Don't worry, headaches are never serious.",
+    "Have you started any new medications recently, including anything over the counter?",
+    "I understand why you're worried. Ibuprofen can raise blood pressure, especially with lisinopril. Let's check it today.",
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table", required=True, help="DynamoDB chat history table.")
+    parser.add_argument("--model", default="meta.llama3-70b-instruct-v1:0", help="Model that plays the patient.")
+    parser.add_argument("--rounds", type=int, default=3, help="Conversations per mode.")
+    return parser.parse_args()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def run_conversation(args, llm, retriever) -> list:
+    """
+    Play the scripted conversation in a new session and return one record per student turn.
+    """
+    session_id = str(uuid.uuid4())
+    patient = dict(
+        patient_name="Maria", llm=llm, history_aware_retriever=retriever, table_name=args.table,
+        session_id=session_id, system_prompt="Answer as a worried but cooperative patient.",
+        patient_age="58", patient_prompt="Anxious about her health.", llm_completion=False,
+    )
+    turns = []
+    try:
+        with request_deadline():
+            chat.get_response(query=chat.get_initial_student_query("Maria"), **patient)
+        for message in STUDENT_MESSAGES:
+            timer = StageTimer()
+            start = time.perf_counter()
+            with timer.active(), request_deadline():
+                result = chat.get_response(query=chat.get_student_query(message), **patient)
+            calls = timer.model_calls_snapshot()
+            turns.append({
+                "seconds": time.perf_counter() - start,
+                "usage": get_turn_usage(timer),
+                # A combined turn that fell back made its own empathy call
+                "fallback": any(call["call"] == "empathy" for call in calls),
+                "evaluated": "empathy_evaluation" in result,
+            })
+    finally:
+        get_raw_history(args.table, session_id).clear()
+    return turns
+
+def report(mode: str, turns: list) -> None:
+    seconds = [turn["seconds"] for turn in turns]
+    mean = lambda key: statistics.mean(turn["usage"][key] for turn in turns)
+    print(f"{mode:9s}: {len(turns)} turns, p50 {percentile(seconds, 0.50):.2f}s, "
+          f"p95 {percentile(seconds, 0.95):.2f}s, mean {statistics.mean(seconds):.2f}s; "
+          f"per turn {mean('model_calls'):.1f} calls, {mean('input_tokens'):.0f} in / {mean('output_tokens'):.0f} out tokens, "
+          f"${mean('cost_usd'):.5f}; evaluated {sum(turn['evaluated'] for turn in turns)}"
+          + (f", fell back {sum(turn['fallback'] for turn in turns)}" if mode == "combined" else ""))
+
+def main():
+    args = parse_args()
+    chat.create_dynamodb_history_table(args.table)
+    llm = chat.get_bedrock_llm(args.model)
+    retriever = RunnableLambda(lambda _: [Document(page_content=PATIENT_DOCUMENT)])
+
+    # Modes alternate round by round so warm-up and model load affect both alike
+    results = {"separate": [], "combined": []}
+    for _ in range(args.rounds):
+        for mode in results:
+            chat.STRUCTURED_OUTPUT_MODE = mode
+            results[mode].extend(run_conversation(args, llm, retriever))
+    for mode, turns in results.items():
+        report(mode, turns)
+
+if __name__ == "__main__":
+    main()
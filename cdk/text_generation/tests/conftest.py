@@ -0,0 +1,90 @@
+"""
+Shared setup for the text generation tests.
+
+AWS is replaced by moto for the whole session, and Bedrock by the stubs in
+helpers/stub_clients.py (BEDROCK_STUB=true), so the tests need no credentials, network or
+database. The environment below is set before any source module is imported, since
+main.py and the helpers read their configuration at import time.
+"""
+import os
+import sys
+import json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "layers", "config", "python"))
+
+os.environ.update({
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "REGION": "us-east-1",
+    "SM_DB_CREDENTIALS": "test-db-secret",
+    "RDS_PROXY_ENDPOINT": "localhost",
+    "BEDROCK_LLM_PARAM": "test-llm",
+    "EMBEDDING_MODEL_PARAM": "test-embeddings",
+    "TABLE_NAME_PARAM": "test-table",
+    "AWS_LAMBDA_FUNCTION_NAME": "test-text-generation",
+    "BEDROCK_STUB": "true",
+    "BEDROCK_STUB_LATENCY_SECONDS": "0",
+    "METRICS_ENABLED": "false",
+    "USAGE_PERSIST": "false",
+    "OPENING_TURN_CACHE": "false",
+    "SERVER_MAX_CONCURRENT_TURNS": "2",
+})
+
+from moto import mock_aws
+
+# Started before the source modules create their module-level clients
+aws = mock_aws()
+aws.start()
+
+import boto3
+import pytest
+
+TABLE_NAME = "chat-history"
+MODEL_ID = "meta.llama3-70b-instruct-v1:0"
+
+ssm = boto3.client("ssm", region_name="us-east-1")
+ssm.put_parameter(Name="test-llm", Value=MODEL_ID, Type="String")
+ssm.put_parameter(Name="test-embeddings", Value="amazon.titan-embed-text-v2:0", Type="String")
+ssm.put_parameter(Name="test-table", Value=TABLE_NAME, Type="String")
+boto3.client("secretsmanager", region_name="us-east-1").create_secret(
+    Name="test-db-secret",
+    SecretString=json.dumps({"username": "postgres", "password": "postgres", "port": 5432, "dbname": "postgres"}),
+)
+
+PATIENT_CONTEXT = ("Stay in character.", "Maria", "58", "Worried about her headaches.", True)
+
+@pytest.fixture
+def main(monkeypatch):
+    """
+    The Lambda entry point, with the database-backed lookups replaced by fixed values.
+    """
+    import main
+    from langchain_core.documents import Document
+    from langchain_core.runnables import RunnableLambda
+
+    documents = [Document(page_content="Maria has had afternoon headaches for three weeks.")]
+    monkeypatch.setattr(main, "get_patient_context", lambda simulation_group_id, patient_id: PATIENT_CONTEXT)
+    monkeypatch.setattr(main, "get_vectorstore_config", lambda patient_id: {"collection_name": patient_id})
+    monkeypatch.setattr(
+        main, "get_vectorstore_retriever",
+        lambda llm, vectorstore_config_dict, embeddings: RunnableLambda(lambda inputs: documents)
+    )
+    return main
+
+def chat_event(session_id, message="", stream=False):
+    """
+    Build the API Gateway event of a chat turn.
+    """
+    return {
+        "queryStringParameters": {
+            "simulation_group_id": "group-1",
+            "patient_id": "patient-1",
+            "session_id": session_id,
+            "session_name": "New Chat",
+            "stream": "true" if stream else "false",
+        },
+        "body": json.dumps({"message_content": message}) if message else None,
+    }
@@ -0,0 +1,114 @@
+import json
+import uuid
+import asyncio
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from conftest import chat_event, MODEL_ID
+from helpers import chat, ratelimit
+from helpers.history import get_raw_history, without_empty_reply
+from helpers.stub_clients import StubChatModel
+
+STUDENT_MESSAGE = "When did the headaches start?"
+
+def run_turn(main, session_id, message, stream=False):
+    """
+    Serve a turn through the Lambda handler, or stream it the way server.py does.
+
+    Returns:
+    tuple: The response and the streamed token texts.
+    """
+    event = chat_event(session_id, message, stream=stream)
+    if not stream:
+        return main.handler(event, None), []
+    tokens = []
+    def on_event(stream_event):
+        if stream_event["type"] == "token":
+            tokens.append(stream_event["content"])
+    response = asyncio.run(main.handle_turn_async(
+        event, event["queryStringParameters"], "group-1", session_id, "patient-1", "New Chat", on_event=on_event
+    ))
+    return response, tokens
+
+@pytest.fixture
+def empty_first_reply(monkeypatch):
+    """
+    Make the patient model's first answer empty, as Bedrock occasionally does.
+    """
+    generate = StubChatModel._generate
+    calls = []
+    def first_empty(self, messages, *args, **kwargs):
+        result = generate(self, messages, *args, **kwargs)
+        calls.append(None)
+        if len(calls) == 1:
+            result.generations[0].message.content = ""
+        return result
+    monkeypatch.setattr(StubChatModel, "_generate", first_empty)
+    return calls
+
+@pytest.mark.parametrize("stream", [False, True], ids=["invoke", "stream"])
+def test_empty_reply_is_retried_and_stored_once(main, empty_first_reply, stream):
+    session_id = str(uuid.uuid4())
+    response, _ = run_turn(main, session_id, STUDENT_MESSAGE, stream=stream)
+
+    assert response["statusCode"] == 200
+    assert len(empty_first_reply) == 2
+    messages = get_raw_history(main.TABLE_NAME, session_id).messages
+    assert [message.type for message in messages] == ["human", "ai"]
+    assert messages[1].content
+
+def test_streamed_reply_takes_a_rate_limit_token(main, monkeypatch):
+    acquired = []
+    monkeypatch.setattr(ratelimit, "acquire", lambda model_id, max_wait: acquired.append(model_id) or True)
+    response, _ = run_turn(main, str(uuid.uuid4()), STUDENT_MESSAGE, stream=True)
+
+    assert response["statusCode"] == 200
+    assert MODEL_ID in acquired
+
+DIAGNOSED_REPLY = (
+    "The headaches come every afternoon. My doctor mentioned my blood pressure. "
+    "Yes, I think you're right that it's my blood pressure medication. PROPER DIAGNOSIS ACHIEVED"
+)
+
+@pytest.mark.parametrize("reply", [
+    DIAGNOSED_REPLY,
+    DIAGNOSED_REPLY.replace("medication.", "medication?"),
+    "Hello. Dr. Lee sent me. It hurts! Is it migraine?\nPROPER DIAGNOSIS ACHIEVED, well done.",
+    "PROPER DIAGNOSIS ACHIEVED",
+    chat.COMPLETION_SENTENCE.strip(),
+], ids=["achieved", "question", "abbreviations", "marker-only", "no-marker"])
+def test_marker_filter_streams_exactly_the_final_reply(reply):
+    final = chat.get_llm_output(reply, True)["llm_output"]
+    for size in (1, 4, len(reply)):
+        marker_filter = chat.DiagnosisMarkerFilter(True)
+        streamed = ""
+        for start in range(0, len(reply), size):
+            streamed += marker_filter.feed(reply[start:start + size])
+            assert final.startswith(streamed)
+            assert chat.DIAGNOSIS_MARKER not in streamed
+        assert streamed + marker_filter.finish(final) == final
+
+def test_streamed_and_unstreamed_diagnosis_replies_match(main, monkeypatch):
+    generate = StubChatModel._generate
+    def diagnosed(self, messages, *args, **kwargs):
+        result = generate(self, messages, *args, **kwargs)
+        result.generations[0].message.content = DIAGNOSED_REPLY
+        return result
+    monkeypatch.setattr(StubChatModel, "_generate", diagnosed)
+
+    unstreamed, _ = run_turn(main, str(uuid.uuid4()), STUDENT_MESSAGE)
+    streamed, tokens = run_turn(main, str(uuid.uuid4()), STUDENT_MESSAGE, stream=True)
+
+    body = json.loads(unstreamed["body"])
+    done = json.loads(streamed["body"].splitlines()[-1])
+    assert body["llm_verdict"] and done["llm_verdict"]
+    assert done["llm_output"] == body["llm_output"]
+    assert body["llm_output"].endswith("".join(tokens))
+    assert "medication" not in "".join(tokens)
+
+def test_without_empty_reply_drops_only_the_empty_exchange():
+    exchange = [HumanMessage(content="Hello"), AIMessage(content="Hi")]
+    assert without_empty_reply(exchange) == exchange
+    assert without_empty_reply([HumanMessage(content="Hello"), AIMessage(content=" ")]) == []
+    assert without_empty_reply([HumanMessage(content="Hello")]) == [HumanMessage(content="Hello")]
@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import uuid
+
+import boto3
+import pytest
+
+from conftest import chat_event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "lambda", "deleteLastMessage"))
+
+@pytest.fixture
+def delete_last_message(main, monkeypatch):
+    """
+    The deleteLastMessage function, with the RDS half of the delete stubbed out.
+    """
+    import deleteLastMessage
+    monkeypatch.setattr(deleteLastMessage, "finish_rds_delete", lambda session_id: {"statusCode": 200})
+    return deleteLastMessage
+
+def delete_event(session_id):
+    return {"queryStringParameters": {"session_id": session_id}}
+
+def test_deleting_the_first_exchange_lets_the_next_turn_name_the_session(main, delete_last_message):
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+    first = json.loads(main.handler(chat_event(session_id, "Hello Maria, what brings you in?"), None)["body"])
+    assert first["session_renamed"]
+
+    assert delete_last_message.lambda_handler(delete_event(session_id), None)["statusCode"] == 200
+
+    again = json.loads(main.handler(chat_event(session_id, "When did the headaches start?"), None)["body"])
+    assert again["session_renamed"]
+
+def test_deleting_the_opening_turn_leaves_the_counter_at_zero(main, delete_last_message):
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+    assert delete_last_message.lambda_handler(delete_event(session_id), None)["statusCode"] == 200
+
+    item = boto3.client("dynamodb").get_item(TableName=main.TABLE_NAME, Key={"SessionId": {"S": f"{session_id}#meta"}})
+    assert "Item" not in item
+
+def test_stale_message_count_is_corrected_instead_of_conflicting(main, delete_last_message):
+    from test_history import legacy_item, get_message_count
+
+    session_id = str(uuid.uuid4())
+    legacy_item(main.TABLE_NAME, session_id, 3)
+    # As left by an append that counted from zero on top of an existing list
+    boto3.client("dynamodb").update_item(
+        TableName=main.TABLE_NAME, Key={"SessionId": {"S": session_id}},
+        UpdateExpression="SET MessageCount = :two", ExpressionAttributeValues={":two": {"N": "2"}},
+    )
+
+    assert delete_last_message.lambda_handler(delete_event(session_id), None)["statusCode"] == 200
+    assert get_message_count(main.TABLE_NAME, session_id) == 4
+    assert delete_last_message.lambda_handler(delete_event(session_id), None)["statusCode"] == 200
+    assert get_message_count(main.TABLE_NAME, session_id) == 2
+
+def test_message_backend_conflict_returns_409(main, delete_last_message, monkeypatch):
+    from helpers import chat, history
+    from test_history import exchange
+
+    monkeypatch.setattr(chat, "HISTORY_BACKEND", "message")
+    monkeypatch.setattr(delete_last_message, "HISTORY_BACKEND", "message")
+    chat.create_dynamodb_history_table(main.TABLE_NAME)
+    session_id = str(uuid.uuid4())
+    raw_history = history.MessageTableChatMessageHistory(main.TABLE_NAME, session_id)
+    raw_history.add_messages(exchange(0))
+    raw_history.add_messages(exchange(1))
+
+    # The newest message disappears between the query and the transaction
+    query = delete_last_message.dynamodb_client.query
+    def query_then_delete(**kwargs):
+        response = query(**kwargs)
+        newest = response["Items"][0]
+        delete_last_message.dynamodb_client.delete_item(
+            TableName=kwargs["TableName"], Key={"SessionId": newest["SessionId"], "Seq": newest["Seq"]}
+        )
+        return response
+    with monkeypatch.context() as patch:
+        patch.setattr(delete_last_message.dynamodb_client, "query", query_then_delete)
+        assert delete_last_message.lambda_handler(delete_event(session_id), None)["statusCode"] == 409
+    assert len(raw_history.messages) == 3
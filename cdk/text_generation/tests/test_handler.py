@@ -0,0 +1,268 @@
+import json
+import uuid
+
+import pytest
+
+from conftest import chat_event
+
+STUDENT_MESSAGE = "Hi Maria, I'm sorry you're in pain. When did the headaches start?"
+
+def test_turn_returns_reply_and_empathy(main):
+    session_id = str(uuid.uuid4())
+
+    opening = main.handler(chat_event(session_id), None)
+    assert opening["statusCode"] == 200
+    assert json.loads(opening["body"])["llm_output"]
+
+    response = main.handler(chat_event(session_id, STUDENT_MESSAGE), None)
+    assert response["statusCode"] == 200
+    body = json.loads(response["body"])
+    assert body["llm_output"].startswith("**Empathy Coach:**")
+    assert body["empathy_evaluation"]["empathy_score"] == "good"
+
+def test_lambda_answers_a_stream_request_with_json(main):
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+
+    # Only server.py streams; the Lambda handler serves the usual JSON body
+    response = main.handler(chat_event(session_id, STUDENT_MESSAGE, stream=True), None)
+    assert response["statusCode"] == 200
+    assert response["headers"]["Content-Type"] == "application/json"
+    assert json.loads(response["body"])["empathy_evaluation"]["empathy_score"] == "good"
+
+def test_turn_writes_history_once(main):
+    from helpers.history import get_raw_history
+
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+    main.handler(chat_event(session_id, STUDENT_MESSAGE), None)
+
+    messages = get_raw_history(main.TABLE_NAME, session_id).messages
+    assert [message.type for message in messages] == ["human", "ai", "human", "ai"]
+
+def test_missing_parameters_are_rejected(main):
+    response = main.handler({"queryStringParameters": {"session_id": "s"}}, None)
+    assert response["statusCode"] == 400
+
+@pytest.mark.parametrize("backend", ["item", "message"])
+def test_prewarm_caches_the_opening_turn_without_leaving_history(main, monkeypatch, backend):
+    import boto3
+    from helpers import chat, history
+
+    monkeypatch.setattr(main, "OPENING_TURN_CACHE", True)
+    monkeypatch.setattr(chat, "HISTORY_BACKEND", backend)
+    monkeypatch.setattr(history, "HISTORY_BACKEND", backend)
+    chat.opening_turn_cache.clear()
+    chat.create_dynamodb_history_table(main.TABLE_NAME)
+
+    response = main.handler({"action": "prewarm_opening_turn", "simulation_group_id": "group-1", "patient_id": "patient-1"}, None)
+    assert response["statusCode"] == 200
+
+    dynamodb = boto3.client("dynamodb", region_name="us-east-1")
+    tables = [main.TABLE_NAME] + ([history.get_message_table_name(main.TABLE_NAME)] if backend == "message" else [])
+    for table in tables:
+        items = dynamodb.scan(TableName=table)["Items"]
+        assert not [item for item in items if item["SessionId"]["S"].startswith("prewarm-")]
+    assert dynamodb.scan(TableName=f"{main.TABLE_NAME}-OpeningTurns")["Items"]
+
+    # A student's opening turn is now served from the cache, without a model call
+    chat.opening_turn_cache.clear()
+    monkeypatch.setattr(chat, "build_conversational_rag_chain", None)
+    opening = main.handler(chat_event(str(uuid.uuid4())), None)
+    assert opening["statusCode"] == 200
+    assert json.loads(opening["body"])["llm_output"]
+
+def test_failed_first_turn_leaves_the_session_unnamed(main, monkeypatch):
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+
+    def unavailable(**kwargs):
+        raise main.RateLimitExceeded("No capacity")
+    with monkeypatch.context() as patch:
+        patch.setattr(main, "get_response", unavailable)
+        assert main.handler(chat_event(session_id, STUDENT_MESSAGE), None)["statusCode"] == 429
+
+    body = json.loads(main.handler(chat_event(session_id, STUDENT_MESSAGE), None)["body"])
+    assert body["session_renamed"] and not body["session_name_pending"]
+    assert body["session_name"] != "New Chat"
+
+    body = json.loads(main.handler(chat_event(session_id, "And the dizziness?"), None)["body"])
+    assert not body["session_renamed"]
+
+def test_llm_naming_marks_the_name_pending(main, monkeypatch):
+    requests = []
+    monkeypatch.setattr(main, "SESSION_NAMING_MODE", "llm")
+    monkeypatch.setattr(main, "request_llm_session_name", lambda *args: requests.append(args))
+    session_id = str(uuid.uuid4())
+
+    body = json.loads(main.handler(chat_event(session_id, STUDENT_MESSAGE), None)["body"])
+    assert body["session_renamed"] and body["session_name_pending"]
+    assert requests[0][0] == session_id
+    assert requests[0][3] == body["session_name"]
+
+@pytest.mark.parametrize("message, name", [
+    ("Hi, how are you feeling today?", "How are you feeling today"),
+    ("What brings you in?", "What brings you in"),
+    ("Hello!", "New Chat"),
+], ids=["greeting", "stopwords", "greeting-only"])
+def test_first_exchange_is_named_after_short_openers(main, message, name):
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+
+    body = json.loads(main.handler(chat_event(session_id, message), None)["body"])
+    assert body["session_renamed"] and body["session_name"] == name
+
+def test_greeting_only_opener_is_named_by_the_llm(main, monkeypatch):
+    requests = []
+    monkeypatch.setattr(main, "SESSION_NAMING_MODE", "llm")
+    monkeypatch.setattr(main, "request_llm_session_name", lambda *args: requests.append(args))
+
+    body = json.loads(main.handler(chat_event(str(uuid.uuid4()), "Hello!"), None)["body"])
+    assert body["session_renamed"] and body["session_name_pending"]
+    assert requests[0][3] == "New Chat"
+
+def test_session_without_turn_counter_is_not_renamed(main):
+    import boto3
+    from helpers.history import get_meta_key
+
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+    main.handler(chat_event(session_id, STUDENT_MESSAGE), None)
+    # A session from before the counter existed: history, but no StudentTurns
+    boto3.client("dynamodb", region_name="us-east-1").delete_item(TableName=main.TABLE_NAME, Key=get_meta_key(session_id))
+
+    body = json.loads(main.handler(chat_event(session_id, "And the dizziness?"), None)["body"])
+    assert not body["session_renamed"]
+
+class RecordingConnection:
+    """
+    A database connection that records the statements executed on it.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement, params):
+        self.statements.append(params)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+def test_background_naming_stores_the_fallback_when_the_llm_fails(main, monkeypatch):
+    from contextlib import contextmanager
+
+    connection = RecordingConnection()
+    monkeypatch.setattr(main, "db_connection", contextmanager(lambda *args: (yield connection)))
+    def failing(*args):
+        raise main.RateLimitExceeded("No capacity")
+    monkeypatch.setattr(main, "generate_llm_session_name", failing)
+
+    response = main.handler({
+        "action": "name_session", "session_id": "session-1", "student_message": STUDENT_MESSAGE,
+        "llm_message": "They started three weeks ago.", "fallback_name": "Headache Onset",
+    }, None)
+    assert response["statusCode"] == 200
+    assert connection.statements == [("Headache Onset", "session-1")]
+
+class PatientTable:
+    """
+    A database connection serving one simulation group and patient, with config_version bumped on edit.
+    """
+
+    def __init__(self):
+        self.context = ["Stay in character.", "Maria", 58, "Worried about her headaches.", True]
+        self.version = 0
+        self.queries = []
+
+    def edit(self, **fields):
+        for name, value in fields.items():
+            self.context[["system_prompt", "patient_name", "patient_age", "patient_prompt"].index(name)] = value
+        self.version += 1
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement, params):
+        self.queries.append("p.patient_prompt" in statement)
+        self.row = (*self.context, 0, self.version) if self.queries[-1] else (0, self.version)
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+def test_patient_context_cache_sees_edits(monkeypatch):
+    from contextlib import contextmanager
+    import main
+
+    table = PatientTable()
+    monkeypatch.setattr(main, "db_connection", contextmanager(lambda *args: (yield table)))
+    main.patient_context_cache.clear()
+
+    assert main.get_patient_context("group-1", "patient-1")[3] == "Worried about her headaches."
+    assert main.get_patient_context("group-1", "patient-1")[3] == "Worried about her headaches."
+    table.edit(patient_prompt="Now also reports dizziness.")
+    assert main.get_patient_context("group-1", "patient-1")[3] == "Now also reports dizziness."
+    # Full read, version check only, version check then full read
+    assert table.queries == [True, False, False, True]
+
+@pytest.fixture
+def combined_mode(main, monkeypatch):
+    from helpers import chat
+
+    evaluations = []
+    separate = chat.evaluate_empathy
+    monkeypatch.setattr(chat, "STRUCTURED_OUTPUT_MODE", "combined")
+    monkeypatch.setattr(chat, "evaluate_empathy", lambda *args: evaluations.append(args) or separate(*args))
+    return evaluations
+
+def test_combined_turn_replies_and_evaluates_in_one_call(main, combined_mode, monkeypatch):
+    from helpers import chat
+    from helpers.history import get_raw_history
+    from helpers.stub_clients import STUB_REPLY
+
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+
+    builds = []
+    build = chat.build_conversational_rag_chain
+    monkeypatch.setattr(chat, "build_conversational_rag_chain",
+                        lambda *args, **kwargs: builds.append(kwargs.get("structured_output", False)) or build(*args, **kwargs))
+    body = json.loads(main.handler(chat_event(session_id, STUDENT_MESSAGE), None)["body"])
+
+    assert body["empathy_evaluation"]["empathy_score"] == "good"
+    assert not combined_mode
+    # Only the structured chain is built when the combined call succeeds
+    assert builds == [True]
+    messages = get_raw_history(main.TABLE_NAME, session_id).messages
+    assert [message.type for message in messages] == ["human", "ai", "human", "ai"]
+    assert messages[-1].content == STUB_REPLY
+
+def test_invalid_combined_output_falls_back_to_separate_calls(main, combined_mode, monkeypatch):
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from helpers.history import get_raw_history
+    from helpers.stub_clients import StubChatModel
+
+    generate = StubChatModel._generate
+    def unstructured(self, messages, *args, **kwargs):
+        if '"empathy_score"' in "".join(str(message.content) for message in messages):
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content="Not JSON at all"))])
+        return generate(self, messages, *args, **kwargs)
+    monkeypatch.setattr(StubChatModel, "_generate", unstructured)
+
+    session_id = str(uuid.uuid4())
+    main.handler(chat_event(session_id), None)
+    body = json.loads(main.handler(chat_event(session_id, STUDENT_MESSAGE), None)["body"])
+
+    assert body["empathy_evaluation"]["empathy_score"] == "good"
+    assert len(combined_mode) == 1
+    messages = get_raw_history(main.TABLE_NAME, session_id).messages
+    assert [message.type for message in messages] == ["human", "ai", "human", "ai"]
@@ -0,0 +1,158 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from helpers import history, policy
+
+def exchange(number):
+    return [HumanMessage(content=f"Student line {number}"), AIMessage(content=f"Patient line {number}")]
+
+class SummaryModel:
+    """
+    A model that records the prompts it is asked to summarize.
+    """
+    model_id = "summary-model"
+
+    def __init__(self):
+        self.prompts = []
+
+    def invoke(self, prompt):
+        self.prompts.append(prompt)
+        return AIMessage(content=f"Summary {len(self.prompts)}")
+
+class WriteOnlyHistory:
+    """
+    Stands in for the raw history after the window was loaded, so any re-read fails.
+    """
+
+    def __init__(self, raw_history):
+        self.raw_history = raw_history
+
+    def add_messages(self, messages):
+        self.raw_history.add_messages(messages)
+
+def wait_for_summaries():
+    # The test executor has one worker, so this runs after every refresh already submitted
+    history.summary_executor.submit(lambda: None).result()
+
+@pytest.fixture
+def summary_history(main, monkeypatch):
+    monkeypatch.setattr(history, "CHAT_HISTORY_LAST_N_TURNS", 1)
+    monkeypatch.setattr(history, "CHAT_HISTORY_SUMMARY_BATCH", 2)
+    monkeypatch.setattr(history, "summary_executor", ThreadPoolExecutor(max_workers=1))
+    model = SummaryModel()
+    windowed = history.WindowedChatMessageHistory(main.TABLE_NAME, str(uuid.uuid4()), llm=model, strategy="summary")
+    return windowed, model
+
+def test_summary_covers_only_messages_outside_the_window(summary_history):
+    windowed, model = summary_history
+    for number in range(3):
+        windowed.raw_history.add_messages(exchange(number))
+
+    windowed.load_window()
+    windowed.raw_history = WriteOnlyHistory(windowed.raw_history)
+    windowed.add_messages(exchange(3))
+    wait_for_summaries()
+
+    assert len(model.prompts) == 1
+    assert "Student line 2" in model.prompts[0]
+    assert "Student line 3" not in model.prompts[0]
+    assert windowed.get_summary() == ("Summary 1", 6)
+    assert "summary" in policy.get_breaker_states()
+
+def test_summary_waits_for_a_full_batch(summary_history, monkeypatch):
+    monkeypatch.setattr(history, "CHAT_HISTORY_SUMMARY_BATCH", 4)
+    windowed, model = summary_history
+    windowed.raw_history.add_messages(exchange(0))
+
+    windowed.load_window()
+    windowed.add_messages(exchange(1))
+    wait_for_summaries()
+
+    assert model.prompts == []
+    assert windowed.get_summary() == ("", 0)
+
+def test_window_starts_with_the_stored_summary(summary_history):
+    windowed, model = summary_history
+    for number in range(4):
+        windowed.add_messages(exchange(number))
+        wait_for_summaries()
+
+    window = windowed.load_window()
+    assert window[0].content.startswith("Summary of our conversation so far: Summary")
+    assert [message.content for message in window[2:]] == ["Student line 3", "Patient line 3"]
+
+@pytest.fixture(params=["item", "message"])
+def raw_history(main, monkeypatch, request):
+    from helpers import chat
+    monkeypatch.setattr(chat, "HISTORY_BACKEND", request.param)
+    monkeypatch.setattr(history, "HISTORY_BACKEND", request.param)
+    chat.create_dynamodb_history_table(main.TABLE_NAME)
+    return history.get_raw_history(main.TABLE_NAME, str(uuid.uuid4()))
+
+def test_backend_round_trip(raw_history):
+    raw_history.add_messages(exchange(0))
+    raw_history.add_messages(exchange(1))
+    assert [message.content for message in raw_history.messages] == [
+        "Student line 0", "Patient line 0", "Student line 1", "Patient line 1"
+    ]
+    raw_history.clear()
+    assert raw_history.messages == []
+
+def test_backend_skips_an_exchange_with_an_empty_reply(raw_history):
+    raw_history.add_messages(exchange(0))
+    raw_history.add_messages([HumanMessage(content="Are you there?"), AIMessage(content="")])
+    assert len(raw_history.messages) == 2
+
+def legacy_item(table_name, session_id, turns):
+    """
+    Write a session the way the original layout did: a History list without MessageCount.
+    """
+    import boto3
+    from langchain_core.messages import message_to_dict
+
+    messages = [message_to_dict(message) for number in range(turns) for message in exchange(number)]
+    boto3.client("dynamodb").put_item(
+        TableName=table_name,
+        Item={"SessionId": {"S": session_id}, "History": history.serializer.serialize(messages)},
+    )
+
+def get_message_count(table_name, session_id):
+    import boto3
+    item = boto3.client("dynamodb").get_item(TableName=table_name, Key={"SessionId": {"S": session_id}})["Item"]
+    return int(item["MessageCount"]["N"])
+
+def test_first_append_to_a_legacy_item_seeds_the_count(main):
+    session_id = str(uuid.uuid4())
+    legacy_item(main.TABLE_NAME, session_id, 2)
+
+    raw_history = history.ListItemChatMessageHistory(main.TABLE_NAME, session_id)
+    raw_history.add_messages(exchange(2))
+    assert len(raw_history.messages) == 6
+    assert get_message_count(main.TABLE_NAME, session_id) == 6
+
+    raw_history.add_messages(exchange(3))
+    assert get_message_count(main.TABLE_NAME, session_id) == 8
+
+def test_message_backend_delete_is_all_or_nothing(main, monkeypatch):
+    from helpers import chat
+    monkeypatch.setattr(chat, "HISTORY_BACKEND", "message")
+    chat.create_dynamodb_history_table(main.TABLE_NAME)
+    raw_history = history.MessageTableChatMessageHistory(main.TABLE_NAME, str(uuid.uuid4()))
+    for number in range(2):
+        raw_history.add_messages(exchange(number))
+
+    assert raw_history.delete_last_exchange()
+    assert [message.content for message in raw_history.messages] == ["Student line 0", "Patient line 0"]
+
+    # Another request deletes the newest message between the query and the transaction
+    items = raw_history.query(limit=2, newest_first=True)
+    history.dynamodb_client.delete_item(
+        TableName=raw_history.table_name, Key={"SessionId": items[0]["SessionId"], "Seq": items[0]["Seq"]}
+    )
+    with monkeypatch.context() as patch:
+        patch.setattr(raw_history, "query", lambda **kwargs: items)
+        assert not raw_history.delete_last_exchange()
+    assert [message.content for message in raw_history.messages] == ["Student line 0"]
@@ -0,0 +1,90 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from helpers import policy, ratelimit
+
+@pytest.fixture(autouse=True)
+def fresh_policy(monkeypatch):
+    monkeypatch.setattr(policy, "breakers", {})
+    monkeypatch.setattr(policy, "latencies", {})
+    monkeypatch.setattr(policy, "BEDROCK_BACKOFF_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(ratelimit, "limiter", None)
+
+def throttled(failures):
+    """
+    A model call that is throttled failures times and then answers.
+    """
+    calls = []
+    def invoke():
+        calls.append(None)
+        if len(calls) <= failures:
+            raise ValueError("An error occurred (ThrottlingException) when calling the InvokeModel operation")
+        return "answer"
+    return invoke, calls
+
+def test_retries_throttling_until_success():
+    invoke, calls = throttled(2)
+    with policy.request_deadline():
+        assert policy.call_with_policy("generation", invoke) == "answer"
+    assert len(calls) == 3
+
+def test_does_not_retry_other_errors():
+    def invoke():
+        raise KeyError("bad request")
+    with policy.request_deadline(), pytest.raises(KeyError):
+        policy.call_with_policy("generation", invoke)
+
+def test_retries_unacceptable_results():
+    results = iter(["", "", "answer"])
+    with policy.request_deadline():
+        assert policy.call_with_policy("generation", lambda: next(results), accept=bool) == "answer"
+
+def test_deadline_stops_a_slow_call(monkeypatch):
+    monkeypatch.setattr(policy, "DEFAULT_DEADLINE_SECONDS", 0.2)
+    with policy.request_deadline(), pytest.raises(policy.DeadlineExceeded):
+        policy.call_with_policy("generation", time.sleep, args=(1,))
+
+def test_breaker_opens_after_consecutive_failures(monkeypatch):
+    monkeypatch.setattr(policy, "BEDROCK_MAX_ATTEMPTS", 1)
+    invoke, calls = throttled(100)
+    with policy.request_deadline():
+        for _ in range(policy.BEDROCK_BREAKER_THRESHOLD):
+            with pytest.raises(ValueError):
+                policy.call_with_policy("empathy", invoke)
+        with pytest.raises(policy.CircuitOpenError):
+            policy.call_with_policy("empathy", invoke)
+    assert len(calls) == policy.BEDROCK_BREAKER_THRESHOLD
+    assert policy.get_breaker_states() == {"empathy": "open"}
+
+def test_nested_calls_do_not_deadlock_a_full_executor(monkeypatch):
+    # One worker: the outer call occupies it, so a nested call submitted to the same
+    # executor would wait forever
+    monkeypatch.setattr(policy, "executor", ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(policy, "DEFAULT_DEADLINE_SECONDS", 5)
+
+    def generate():
+        rewritten = policy.call_with_policy("rewrite", lambda: "rewritten question", hedge=True)
+        return f"reply to {rewritten}"
+
+    with policy.request_deadline():
+        assert policy.call_with_policy("generation", generate) == "reply to rewritten question"
+    assert not policy.on_policy_worker()
+
+def test_nested_calls_keep_their_retries(monkeypatch):
+    monkeypatch.setattr(policy, "executor", ThreadPoolExecutor(max_workers=1))
+    invoke, calls = throttled(1)
+    with policy.request_deadline():
+        assert policy.call_with_policy("generation", policy.call_with_policy, args=("rewrite", invoke)) == "answer"
+    assert len(calls) == 2
+
+def test_slow_reply_raises_deadline_exceeded(monkeypatch):
+    from helpers import chat
+
+    monkeypatch.setattr(chat, "RESPONSE_TIMEOUT_SECONDS", 0.1)
+    monkeypatch.setattr(chat, "evaluate_empathy", lambda *args: None)
+    monkeypatch.setattr(chat, "get_nova_client", lambda: None)
+    monkeypatch.setattr(chat, "generate_non_empty_response", lambda *args: time.sleep(0.5) or "late")
+    with pytest.raises(policy.DeadlineExceeded):
+        chat.run_concurrently(None, "query", "session", "context")
@@ -0,0 +1,98 @@
+import boto3
+import pytest
+
+from helpers import ratelimit
+
+KEY = ("group-1", "meta.llama3-70b-instruct-v1:0")
+NOW = 1_700_000_000.25
+
+class CountingClient:
+    """
+    Wraps a DynamoDB client and counts the update_item calls made through it.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.exceptions = client.exceptions
+        self.updates = 0
+
+    def update_item(self, **kwargs):
+        self.updates += 1
+        return self.client.update_item(**kwargs)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [NOW]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    return now
+
+@pytest.fixture(params=["local", "dynamodb"])
+def limiter(request, clock):
+    if request.param == "local":
+        return ratelimit.LocalRateLimiter(rate=2, window=1)
+    table_name = f"chat-history-{request.node.name}-RateLimits"
+    dynamodb = boto3.client("dynamodb", region_name="us-east-1")
+    dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[{"AttributeName": "BucketId", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "BucketId", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    limiter = ratelimit.DynamoDBRateLimiter(table_name, rate=2, window=1)
+    limiter.client = CountingClient(limiter.client)
+    return limiter
+
+def test_tokens_fill_the_current_window_then_later_ones(limiter):
+    delays = [limiter.reserve(KEY, 10) for _ in range(5)]
+    assert delays == [0.0, 0.0, 0.75, 0.75, 1.75]
+
+def test_no_token_beyond_the_callers_wait(limiter):
+    assert limiter.reserve(KEY, 0) == 0.0
+    assert limiter.reserve(KEY, 0) == 0.0
+    assert limiter.reserve(KEY, 0.5) is None
+    assert limiter.reserve(KEY, 1) == 0.75
+
+def test_unused_capacity_is_not_carried_forward(limiter, clock):
+    limiter.reserve(KEY, 10)
+    clock[0] += 30
+    assert [limiter.reserve(KEY, 10) for _ in range(3)] == [0.0, 0.0, 0.75]
+
+def test_buckets_are_separate_per_group_and_model(limiter):
+    limiter.reserve(KEY, 0)
+    limiter.reserve(KEY, 0)
+    assert limiter.reserve(("group-2", KEY[1]), 0) == 0.0
+    assert limiter.reserve((KEY[0], "amazon.nova-pro-v1:0"), 0) == 0.0
+
+def test_dynamodb_reserves_a_distant_window_in_one_write(clock):
+    limiter = ratelimit.DynamoDBRateLimiter("chat-history-distant-RateLimits", rate=2, window=1)
+    boto3.client("dynamodb", region_name="us-east-1").create_table(
+        TableName=limiter.table_name,
+        KeySchema=[{"AttributeName": "BucketId", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "BucketId", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    limiter.client = CountingClient(limiter.client)
+    # The first reservation creates the counter; each one after is a single conditional ADD
+    limiter.reserve(KEY, 100)
+    for _ in range(39):
+        limiter.reserve(KEY, 100)
+    limiter.client.updates = 0
+    assert limiter.reserve(KEY, 100) == 19.75
+    assert limiter.client.updates == 1
+
+def test_dynamodb_gives_up_after_the_attempt_limit(clock, monkeypatch):
+    class RacingClient(CountingClient):
+        """
+        Every conditional write loses to another container that moved the counter first.
+        """
+        def update_item(self, **kwargs):
+            self.updates += 1
+            raise self.exceptions.ConditionalCheckFailedException(
+                {"Error": {"Code": "ConditionalCheckFailedException"}, "Item": {"Tickets": {"N": "0"}}},
+                "UpdateItem",
+            )
+
+    limiter = ratelimit.DynamoDBRateLimiter("unused", rate=2, window=1)
+    limiter.client = RacingClient(limiter.client)
+    assert limiter.reserve(KEY, 10) is None
+    assert limiter.client.updates == 2 * ratelimit.RATE_LIMIT_MAX_ATTEMPTS
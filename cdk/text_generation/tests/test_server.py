@@ -0,0 +1,92 @@
+import os
+import json
+import asyncio
+import uuid
+from urllib.parse import urlencode
+
+import pytest
+
+from conftest import chat_event
+
+@pytest.fixture
+def server(main, monkeypatch):
+    import server
+    # The semaphore belongs to the event loop of the test that created it
+    monkeypatch.setattr(server, "turn_slots", None)
+    return server
+
+def post_chat(server, query_params, message):
+    """
+    Send a POST /chat through the ASGI app and return the messages it sent back.
+    """
+    scope = {"type": "http", "path": "/chat", "method": "POST", "query_string": urlencode(query_params).encode()}
+    body = json.dumps({"message_content": message}).encode()
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(server.app(scope, receive, send))
+    return sent
+
+def test_streamed_turn_is_sent_in_chunks(server):
+    query_params = chat_event(str(uuid.uuid4()), stream=True)["queryStringParameters"]
+    sent = post_chat(server, query_params, "When did the headaches start?")
+
+    assert sent[0]["status"] == 200
+    chunks = sent[1:]
+    assert len(chunks) > 1
+    assert all(chunk["more_body"] for chunk in chunks[:-1])
+    assert not chunks[-1].get("more_body", False)
+
+    events = [json.loads(line) for chunk in chunks for line in chunk["body"].decode().splitlines()]
+    assert events[0]["type"] in ("token", "empathy")
+    assert events[-1]["type"] == "done"
+    assert [event["type"] for event in events].count("done") == 1
+    tokens = "".join(event["content"] for event in events if event["type"] == "token")
+    assert events[-1]["llm_output"].endswith(tokens)
+
+def test_unstreamed_turn_is_one_body(server):
+    query_params = chat_event(str(uuid.uuid4()))["queryStringParameters"]
+    sent = post_chat(server, query_params, "When did the headaches start?")
+
+    assert sent[0]["status"] == 200
+    assert len(sent) == 2
+    assert json.loads(sent[1]["body"])["llm_output"]
+
+def test_streamed_turn_rejected_before_generation_keeps_its_status(server):
+    sent = post_chat(server, {"session_id": "s", "stream": "true"}, "Hello")
+    assert sent[0]["status"] == 400
+
+def test_worker_pools_are_sized_from_the_turn_limit(server):
+    assert os.environ["TEXT_GEN_WORKERS"] == str(server.SERVER_MAX_CONCURRENT_TURNS * server.TEXT_GEN_WORKERS_PER_TURN)
+    assert os.environ["BEDROCK_POLICY_WORKERS"] == str(server.SERVER_MAX_CONCURRENT_TURNS * server.POLICY_WORKERS_PER_TURN)
+    server.check_worker_pools()
+
+def test_startup_rejects_a_text_gen_pool_too_small_for_the_turn_limit(server, monkeypatch):
+    monkeypatch.setattr(server, "SERVER_MAX_CONCURRENT_TURNS", 16)
+    with pytest.raises(ValueError, match="TEXT_GEN_WORKERS"):
+        asyncio.run(server.startup())
+
+def test_each_turn_counts_its_own_cache_lookups(server, monkeypatch):
+    from langchain_core.documents import Document
+    from langchain_core.runnables import RunnableLambda
+    from helpers import retrieval
+
+    seen = []
+    def retrieve(inputs):
+        retrieval.record("retrieval", True, 0.0)
+        seen.append(retrieval.get_invocation_stats()["retrieval_hits"])
+        return [Document(page_content="Maria has had afternoon headaches for three weeks.")]
+    monkeypatch.setattr(
+        server.main, "get_vectorstore_retriever",
+        lambda llm, vectorstore_config_dict, embeddings: RunnableLambda(retrieve)
+    )
+
+    for _ in range(2):
+        query_params = chat_event(str(uuid.uuid4()))["queryStringParameters"]
+        assert post_chat(server, query_params, "When did the headaches start?")[0]["status"] == 200
+    assert seen == [1, 1]
@@ -0,0 +1,99 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+import pytest
+
+from conftest import chat_event
+from helpers import usage
+from helpers.timing import StageTimer
+
+class UsageConnection:
+    """
+    A database connection that records the batches of usage rows written to it.
+    """
+
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+
+    def cursor(self):
+        return self
+
+    def executemany(self, statement, rows):
+        if self.fail:
+            raise ConnectionError("Database unreachable")
+        self.batches.append(list(rows))
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def connection(monkeypatch):
+    import db_pool
+
+    connection = UsageConnection()
+    monkeypatch.setattr(db_pool, "db_connection", contextmanager(lambda *args: (yield connection)))
+    monkeypatch.setattr(usage, "USAGE_PERSIST", True)
+    monkeypatch.setattr(usage, "USAGE_FLUSH_ROWS", 3)
+    monkeypatch.setattr(usage, "USAGE_FLUSH_SECONDS", 3600)
+    monkeypatch.setattr(usage, "pending_rows", [])
+    monkeypatch.setattr(usage, "pending_since", None)
+    return connection
+
+def record_turn(calls=1):
+    timer = StageTimer()
+    for _ in range(calls):
+        timer.add_model_call({
+            "model_id": "meta.llama3-70b-instruct-v1:0", "call": "generation",
+            "input_tokens": 100, "output_tokens": 20, "latency_ms": 500.0, "cost_usd": 0.0003,
+            "recorded_at": time.time(),
+        })
+    usage.record_turn_usage(timer, str(uuid.uuid4()), str(uuid.uuid4()), str(uuid.uuid4()))
+
+def test_rows_wait_for_the_row_threshold(connection):
+    record_turn(2)
+    assert usage.flush_usage() == 0
+    assert not connection.batches
+
+    record_turn()
+    assert usage.flush_usage() == 3
+    assert [len(batch) for batch in connection.batches] == [3]
+    assert not usage.pending_rows
+
+def test_rows_are_written_once_the_oldest_is_due(connection, monkeypatch):
+    record_turn()
+    monkeypatch.setattr(usage, "USAGE_FLUSH_SECONDS", 0)
+    assert usage.flush_usage() == 1
+
+def test_force_writes_below_the_thresholds(connection):
+    record_turn()
+    assert usage.flush_usage(force=True) == 1
+
+def test_failed_write_keeps_at_most_the_pending_limit(connection, monkeypatch):
+    monkeypatch.setattr(usage, "USAGE_MAX_PENDING_ROWS", 4)
+    connection.fail = True
+    record_turn(3)
+    assert usage.flush_usage() == 0
+    record_turn(3)
+    assert usage.flush_usage() == 0
+    assert len(usage.pending_rows) == 4
+
+def test_rows_keep_the_time_of_the_call(connection):
+    timer = StageTimer()
+    with timer.active():
+        usage.record_model_call("meta.llama3-70b-instruct-v1:0", 100, 20, 0.5, call="generation")
+    called = time.time()
+    usage.record_turn_usage(timer, str(uuid.uuid4()), str(uuid.uuid4()), str(uuid.uuid4()))
+    time.sleep(0.05)
+    assert usage.flush_usage(force=True) == 1
+    assert abs(connection.batches[0][0][-1].timestamp() - called) < 0.05
+
+def test_handler_forces_a_flush_every_invocation(main, monkeypatch):
+    flushes = []
+    monkeypatch.setattr(main, "flush_usage", lambda *args, **kwargs: flushes.append((args, kwargs)))
+    assert main.handler(chat_event(str(uuid.uuid4())), None)["statusCode"] == 200
+    assert flushes == [((), {"force": True})]
@@ -0,0 +1,11 @@
+import pytest
+
+from helpers import helper
+
+def test_get_vectorstore_raises_the_underlying_error(monkeypatch):
+    def unreachable(connection_string):
+        raise ConnectionError("could not connect to server")
+    monkeypatch.setattr(helper, "get_engine", unreachable)
+
+    with pytest.raises(ConnectionError, match="could not connect"):
+        helper.get_vectorstore("patient-1", None, "postgres", "postgres", "secret", "localhost", 5432)
@@ -420,17 +420,24 @@ const StudentChat = ({ group, patient, setPatient, setGroup }) => {
           group.simulation_group_id
         )}&llm_verdict=${encodeURIComponent(textGenData.llm_verdict)}`;
 
+        // Only store a name this turn generated; a pending name is stored by the
+        // text generation function once the LLM has named the session
+        const storeSessionName =
+          textGenData.session_renamed && !textGenData.session_name_pending;
+
         return Promise.all([
-          fetch(updateSessionName, {
-            method: "PUT",
-            headers: {
-              Authorization: authToken,
-              "Content-Type": "application/json",
-            },
-            body: JSON.stringify({
-              session_name: textGenData.session_name,
-            }),
-          }),
+          storeSessionName
+            ? fetch(updateSessionName, {
+                method: "PUT",
+                headers: {
+                  Authorization: authToken,
+                  "Content-Type": "application/json",
+                },
+                body: JSON.stringify({
+                  session_name: textGenData.session_name,
+                }),
+              })
+            : { ok: true },
           fetch(updatePatientScore, {
             method: "POST",
             headers: {